@@ -14,14 +14,13 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from django.apps import AppConfig
 
-from django.db import DEFAULT_DB_ALIAS, connections
 
+class BosConfig(AppConfig):
+    name = 'bos'
 
-def create_view_as(table_name, queryset, using=DEFAULT_DB_ALIAS):
-    compiler = queryset.query.get_compiler(using=using)
-    sql, params = compiler.as_sql()
-    connection = connections[DEFAULT_DB_ALIAS]
-    sql = "CREATE VIEW " + connection.ops.quote_name(table_name) + " AS " + sql
-    with connection.cursor() as cursor:
-        cursor.execute(sql, params)
+    def ready(self):
+        from bos.instrumentation import REQUEST_METRICS_ENABLED, time_serializers
+        if REQUEST_METRICS_ENABLED:
+            time_serializers()
@@ -3,9 +3,18 @@ from django.utils.timezone import make_aware
 
 from rest_framework import authentication
 
+from bos.cache import get_cached_mobile_token_user, cache_mobile_token_user
 from users.models import MobileAuthToken
 
 
+def get_mobile_token(request):
+    token_header = request.META.get('HTTP_AUTHORIZATION', None)
+    try:
+        return token_header.split(' ')[1]
+    except Exception:
+        return None
+
+
 class MobileAuthentication(authentication.BaseAuthentication):
     """
     Custom authentication class for validating tokens sent from android apps.
@@ -14,16 +23,17 @@ class MobileAuthentication(authentication.BaseAuthentication):
     """
 
     def authenticate(self, request):
-        token_header = request.META.get('HTTP_AUTHORIZATION', None)
-        try:
-            token = token_header.split(' ')[1]
-        except Exception:
-            return None, None
-
+        token = get_mobile_token(request)
         if token:
-            auth_token = MobileAuthToken.objects.filter(token=token, expiry_date__gt=make_aware(datetime.now())).first()
+            user = get_cached_mobile_token_user(token)
+            if user:
+                return user, None
+
+            auth_token = MobileAuthToken.objects.select_related('user', 'user__ngo') \
+                .filter(token=token, expiry_date__gt=make_aware(datetime.now())).first()
             if auth_token:
                 # print("Token exists")
+                cache_mobile_token_user(token, auth_token.user, auth_token.expiry_date)
                 return auth_token.user, None
             # else:
                 # print("Auth Token not found")
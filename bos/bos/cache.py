@@ -0,0 +1,146 @@
+#  Copyright (c) 2019 Maverick Labs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as,
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.timezone import make_aware
+
+
+class LRUCache:
+    """
+    Thread safe in-process least recently used cache where every entry expires after its own timeout.
+    """
+
+    def __init__(self, max_size, timeout):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        if timeout <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + timeout)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+MOBILE_TOKEN_CACHE_SIZE = getattr(settings, "MOBILE_TOKEN_CACHE_SIZE", 10000)
+MOBILE_TOKEN_CACHE_TIMEOUT = getattr(settings, "MOBILE_TOKEN_CACHE_TIMEOUT", 300)
+# Alias of a django cache shared between processes, e.g. memcached or redis. When set it is the only tier, so
+# revoking a token in one worker reaches all of them. When None tokens are cached in process, which only
+# suits a single process: other workers keep accepting a revoked token for up to MOBILE_TOKEN_CACHE_TIMEOUT.
+MOBILE_TOKEN_CACHE_BACKEND = getattr(settings, "MOBILE_TOKEN_CACHE_BACKEND", None)
+MOBILE_TOKEN_CACHE_KEY_PREFIX = 'mobile_auth_token:'
+# Saves of only these user fields leave cached token users in place, logins write last_login
+MOBILE_TOKEN_USER_IGNORED_FIELDS = frozenset(['last_login'])
+
+mobile_token_cache = LRUCache(MOBILE_TOKEN_CACHE_SIZE, MOBILE_TOKEN_CACHE_TIMEOUT)
+
+
+def _mobile_token_cache_key(token):
+    return MOBILE_TOKEN_CACHE_KEY_PREFIX + hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def _shared_mobile_token_cache():
+    if MOBILE_TOKEN_CACHE_BACKEND is None:
+        return None
+    return caches[MOBILE_TOKEN_CACHE_BACKEND]
+
+
+def _field_values(instance):
+    return tuple(getattr(instance, field.attname) for field in instance._meta.concrete_fields)
+
+
+def _user_from_field_values(user_values, ngo_values):
+    user_model = get_user_model()
+    user = user_model.from_db(DEFAULT_DB_ALIAS, [field.attname for field in user_model._meta.concrete_fields],
+                              user_values)
+    if ngo_values is not None:
+        ngo_model = user_model._meta.get_field('ngo').related_model
+        user.ngo = ngo_model.from_db(DEFAULT_DB_ALIAS, [field.attname for field in ngo_model._meta.concrete_fields],
+                                     ngo_values)
+    return user
+
+
+def get_cached_mobile_token_user(token):
+    cache_key = _mobile_token_cache_key(token)
+    shared_cache = _shared_mobile_token_cache()
+    entry = mobile_token_cache.get(cache_key) if shared_cache is None else shared_cache.get(cache_key)
+    if entry is None:
+        return None
+    # Only field values are cached, every request gets its own user and ngo instances
+    user = _user_from_field_values(*entry)
+    if not user.is_active:
+        return None
+    return user
+
+
+def cache_mobile_token_user(token, user, expiry_date):
+    if not user.is_active:
+        return
+    cache_key = _mobile_token_cache_key(token)
+    timeout = min(MOBILE_TOKEN_CACHE_TIMEOUT, (expiry_date - make_aware(datetime.now())).total_seconds())
+    if timeout <= 0:
+        return
+    entry = (_field_values(user), _field_values(user.ngo) if user.ngo_id is not None else None)
+    shared_cache = _shared_mobile_token_cache()
+    if shared_cache is None:
+        mobile_token_cache.set(cache_key, entry, timeout)
+    else:
+        shared_cache.set(cache_key, entry, int(timeout))
+
+
+def invalidate_mobile_tokens(tokens):
+    cache_keys = [_mobile_token_cache_key(token) for token in tokens]
+    shared_cache = _shared_mobile_token_cache()
+    if shared_cache is None:
+        for cache_key in cache_keys:
+            mobile_token_cache.delete(cache_key)
+    elif cache_keys:
+        shared_cache.delete_many(cache_keys)
@@ -34,9 +34,15 @@ LENGTH_NOTE_FIELD = 500
 LENGTH_RESET_PASSWORD_TOKEN = 10
 LENGTH_USERNAME = 10
 FIELD_LENGTH_NAME = 50
+LENGTH_IDEMPOTENCY_KEY = 100
 METHOD_POST = 'POST'
 METHOD_GET = 'GET'
 MESSAGE_KEY = 'message'
+BULK_READINGS_MAX_COUNT = 10000
+BULK_CREATE_BATCH_SIZE = 1000
+EXPORT_FORMAT_CSV = 'csv'
+EXPORT_FORMAT_PARQUET = 'parquet'
+READING_BOOLEAN_VALUES = {'true': True, 'yes': True, '1': True, 'false': False, 'no': False, '0': False}
 
 
 class DisableCSRFMiddleware(object):
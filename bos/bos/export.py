@@ -0,0 +1,99 @@
+#  Copyright (c) 2019 Maverick Labs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as,
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import csv
+from itertools import islice
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+EXPORT_BATCH_SIZE = 10000
+
+EXPORT_STRING = 'string'
+EXPORT_FLOAT = 'float'
+EXPORT_BOOLEAN = 'boolean'
+EXPORT_TIMESTAMP = 'timestamp'
+PARQUET_TYPES = {
+    EXPORT_STRING: pa.string(),
+    EXPORT_FLOAT: pa.float64(),
+    EXPORT_BOOLEAN: pa.bool_(),
+    EXPORT_TIMESTAMP: pa.timestamp('us', tz='UTC'),
+}
+
+
+class _StreamBuffer(object):
+    """
+    Write only file handed to the parquet writer. Written bytes are drained after
+    every row group while tell() keeps counting, as the footer stores offsets.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class _Echo(object):
+    def write(self, value):
+        return value
+
+
+def stream_csv(columns, rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow([name for name, _ in columns])
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def stream_parquet(columns, rows, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Writes rows as one parquet row group per batch and yields the bytes of each,
+    so only one batch is held in memory whatever the number of rows.
+    Columns are (name, type) pairs, type being one of the EXPORT_* types.
+    """
+    schema = pa.schema([pa.field(name, PARQUET_TYPES[column_type]) for name, column_type in columns])
+    buffer = _StreamBuffer()
+    writer = pq.ParquetWriter(pa.PythonFile(buffer, mode='w'), schema)
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+        arrays = [pa.array([row[index] for row in batch], type=field.type) for index, field in enumerate(schema)]
+        writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+        yield buffer.drain()
+    writer.close()
+    yield buffer.drain()
@@ -0,0 +1,237 @@
+#  Copyright (c) 2019 Maverick Labs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as,
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+import random
+import threading
+import time
+from collections import defaultdict, Counter
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+from django.http import HttpResponse, HttpResponseForbidden
+from rest_framework.serializers import BaseSerializer
+
+from bos.response_cache import response_cache_metrics
+
+REQUEST_METRICS_ENABLED = getattr(settings, "REQUEST_METRICS_ENABLED", True)
+# Addresses allowed to scrape the metrics endpoint
+REQUEST_METRICS_ALLOWED_IPS = getattr(settings, "REQUEST_METRICS_ALLOWED_IPS", ['127.0.0.1'])
+SLOW_REQUEST_THRESHOLD = getattr(settings, "SLOW_REQUEST_THRESHOLD", 1.0)
+SLOW_REQUEST_SAMPLE_RATE = getattr(settings, "SLOW_REQUEST_SAMPLE_RATE", 1.0)
+SLOW_REQUEST_LOGGED_QUERIES = getattr(settings, "SLOW_REQUEST_LOGGED_QUERIES", 10)
+REQUEST_DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+slow_request_logger = logging.getLogger('bos.slow_requests')
+
+_request_state = threading.local()
+_END_OF_CONTENT = object()
+
+
+class RequestStats(object):
+    def __init__(self):
+        self.queries = []
+        self.query_templates = Counter()
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.serializer_depth = 0
+
+    @property
+    def duplicate_query_count(self):
+        # Queries repeating the SQL of an earlier one with any parameters, N+1 queries show up here
+        return sum(count - 1 for count in self.query_templates.values())
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.monotonic()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.monotonic() - start
+            self.db_time += duration
+            self.queries.append((duration, sql, params))
+            self.query_templates[sql] += 1
+
+
+class RouteMetrics(object):
+    def __init__(self):
+        self.count = 0
+        self.wall_time = 0.0
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.query_count = 0
+        self.duplicate_query_count = 0
+        self.buckets = [0] * len(REQUEST_DURATION_BUCKETS)
+
+
+route_metrics = defaultdict(RouteMetrics)
+_route_metrics_lock = threading.Lock()
+
+
+def _timed_serializer_data(data_property):
+    def data(self):
+        stats = getattr(_request_state, 'stats', None)
+        if stats is None:
+            return data_property.fget(self)
+        # Only the outermost serializer is timed, without the queries its lazy querysets run
+        stats.serializer_depth += 1
+        start = time.monotonic()
+        db_time = stats.db_time
+        try:
+            return data_property.fget(self)
+        finally:
+            stats.serializer_depth -= 1
+            if stats.serializer_depth == 0:
+                stats.serializer_time += time.monotonic() - start - (stats.db_time - db_time)
+    return property(data)
+
+
+def time_serializers():
+    # Called once from BosConfig.ready(), ListSerializer and Serializer both go through BaseSerializer.data
+    BaseSerializer.data = _timed_serializer_data(BaseSerializer.data)
+
+
+@contextmanager
+def _measuring(stats):
+    _request_state.stats = stats
+    try:
+        with connection.execute_wrapper(stats):
+            yield
+    finally:
+        _request_state.stats = None
+
+
+def _route(request):
+    resolver_match = getattr(request, 'resolver_match', None)
+    if resolver_match is None:
+        return 'unmatched'
+    # DRF router names are <basename>-<action>, e.g. users-resources or Measurement-list
+    return resolver_match.view_name or resolver_match._func_path
+
+
+def _record(route, method, wall_time, stats):
+    with _route_metrics_lock:
+        metrics = route_metrics[(route, method)]
+        metrics.count += 1
+        metrics.wall_time += wall_time
+        metrics.db_time += stats.db_time
+        metrics.serializer_time += stats.serializer_time
+        metrics.query_count += len(stats.queries)
+        metrics.duplicate_query_count += stats.duplicate_query_count
+        for index, bucket in enumerate(REQUEST_DURATION_BUCKETS):
+            if wall_time <= bucket:
+                metrics.buckets[index] += 1
+
+
+def _log_slow_request(request, route, status_code, wall_time, stats):
+    slowest_queries = sorted(stats.queries, key=lambda query: query[0], reverse=True)[:SLOW_REQUEST_LOGGED_QUERIES]
+    duplicated_queries = [(count, sql) for sql, count in stats.query_templates.most_common(SLOW_REQUEST_LOGGED_QUERIES)
+                          if count > 1]
+    lines = ['%s %s (%s) %d in %.3fs, db %.3fs in %d queries (%d duplicates), serializers %.3fs' % (
+        request.method, request.get_full_path(), route, status_code, wall_time, stats.db_time, len(stats.queries),
+        stats.duplicate_query_count, stats.serializer_time)]
+    lines += ['  %.3fs %s %r' % query for query in slowest_queries]
+    lines += ['  %d times %s' % query for query in duplicated_queries]
+    slow_request_logger.warning('\n'.join(lines))
+
+
+class RequestMetricsMiddleware(object):
+    """
+    Records wall time, database time, query count, duplicate query count and
+    serializer time of every request per route, for metrics_view, and logs a sample
+    of the requests slower than SLOW_REQUEST_THRESHOLD with their slowest queries.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not REQUEST_METRICS_ENABLED:
+            return self.get_response(request)
+
+        stats = RequestStats()
+        start = time.monotonic()
+        with _measuring(stats):
+            response = self.get_response(request)
+        if response.streaming:
+            response.streaming_content = self._measured_streaming_content(request, response,
+                                                                          response.streaming_content, stats, start)
+        else:
+            self._finish(request, response, stats, start)
+        return response
+
+    def _measured_streaming_content(self, request, response, streaming_content, stats, start):
+        # Streamed bodies run their queries while the server iterates them, after __call__ returned
+        streaming_content = iter(streaming_content)
+        try:
+            while True:
+                with _measuring(stats):
+                    chunk = next(streaming_content, _END_OF_CONTENT)
+                if chunk is _END_OF_CONTENT:
+                    return
+                yield chunk
+        finally:
+            self._finish(request, response, stats, start)
+
+    def _finish(self, request, response, stats, start):
+        wall_time = time.monotonic() - start
+        route = _route(request)
+        _record(route, request.method, wall_time, stats)
+        if wall_time >= SLOW_REQUEST_THRESHOLD and random.random() < SLOW_REQUEST_SAMPLE_RATE:
+            _log_slow_request(request, route, response.status_code, wall_time, stats)
+
+
+def _labels(**labels):
+    return ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for name, value in labels.items())
+
+
+def metrics_text():
+    lines = []
+    with _route_metrics_lock:
+        metrics = {key: (value.count, value.wall_time, value.db_time, value.serializer_time, value.query_count,
+                         value.duplicate_query_count, list(value.buckets)) for key, value in route_metrics.items()}
+
+    lines.append('# TYPE bos_request_duration_seconds histogram')
+    for (route, method), (count, wall_time, _, _, _, _, buckets) in sorted(metrics.items()):
+        for bucket, bucket_count in zip(REQUEST_DURATION_BUCKETS, buckets):
+            lines.append('bos_request_duration_seconds_bucket{%s} %d' % (
+                _labels(route=route, method=method, le=bucket), bucket_count))
+        lines.append('bos_request_duration_seconds_bucket{%s} %d' % (
+            _labels(route=route, method=method, le='+Inf'), count))
+        lines.append('bos_request_duration_seconds_sum{%s} %f' % (_labels(route=route, method=method), wall_time))
+        lines.append('bos_request_duration_seconds_count{%s} %d' % (_labels(route=route, method=method), count))
+
+    for name, index, value_format in (('bos_request_db_seconds_total', 2, '%f'),
+                                      ('bos_request_serializer_seconds_total', 3, '%f'),
+                                      ('bos_request_queries_total', 4, '%d'),
+                                      ('bos_request_duplicate_queries_total', 5, '%d')):
+        lines.append('# TYPE %s counter' % name)
+        for (route, method), values in sorted(metrics.items()):
+            lines.append(('%s{%s} ' + value_format) % (name, _labels(route=route, method=method), values[index]))
+
+    cache_metrics = response_cache_metrics()
+    for name, field in (('bos_response_cache_hits_total', 'hits'), ('bos_response_cache_misses_total', 'misses')):
+        lines.append('# TYPE %s counter' % name)
+        for endpoint, values in sorted(cache_metrics.items()):
+            lines.append('%s{%s} %d' % (name, _labels(endpoint=endpoint), values[field]))
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    # Metrics are kept per process, each worker has to be scraped on its own
+    if request.META.get('REMOTE_ADDR') not in REQUEST_METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+    return HttpResponse(metrics_text(), content_type='text/plain; version=0.0.4')
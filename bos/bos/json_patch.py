@@ -0,0 +1,214 @@
+#  Copyright (c) 2019 Maverick Labs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as,
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import json
+import re
+
+from django.db import connection
+from django.utils import timezone
+from django.utils.translation import gettext as _
+from rest_framework.parsers import JSONParser
+
+from bos.constants import MESSAGE_KEY
+from bos.exceptions import ValidationException
+
+JSON_PATCH_MEDIA_TYPE = 'application/json-patch+json'
+MERGE_PATCH_MEDIA_TYPE = 'application/merge-patch+json'
+JSON_PATCH_MAX_OPERATIONS = 1000
+JSON_PATCH_OPERATIONS = ('add', 'remove', 'replace', 'move', 'copy', 'test')
+ARRAY_INDEX_REGEX = re.compile(r'^(0|[1-9][0-9]*)$')
+IF_MATCH_REGEX = re.compile(r'^(W/)?"?(\d+)"?$')
+
+
+class JSONPatchParser(JSONParser):
+    media_type = JSON_PATCH_MEDIA_TYPE
+
+
+class MergePatchParser(JSONParser):
+    media_type = MERGE_PATCH_MEDIA_TYPE
+
+
+class JSONPatchConflict(Exception):
+    # The document was changed since the version the patch was made against
+    pass
+
+
+class JSONPatchFailed(Exception):
+    # A path of the patch does not exist in the document or a test operation failed
+    pass
+
+
+def if_match_version(request):
+    match = IF_MATCH_REGEX.match(request.META.get('HTTP_IF_MATCH', '').strip())
+    return int(match.group(2)) if match else None
+
+
+def parse_json_pointer(pointer):
+    if not isinstance(pointer, str) or (pointer and not pointer.startswith('/')):
+        raise ValidationException({MESSAGE_KEY: _('Invalid JSON pointer %s') % pointer})
+    return [token.replace('~1', '/').replace('~0', '~') for token in pointer.split('/')[1:]]
+
+
+# A patch is applied as a chain of steps, each one a SELECT over the previous step
+# returning the patched document as doc and a value carried to the next step, used by
+# move and copy. A step that cannot be applied returns a NULL doc, which jsonb
+# functions propagate to the end of the chain.
+
+
+def _get(path):
+    if not path:
+        return 'doc', []
+    return 'doc #> %s::text[]', [path]
+
+
+def _set(path, value_sql, value_params):
+    if not path:
+        return value_sql, value_params
+    return 'jsonb_set(doc, %s::text[], ' + value_sql + ', true)', [path] + value_params
+
+
+def _add(path, value_sql, value_params):
+    if not path:
+        return value_sql, value_params
+    parent, last = path[:-1], path[-1]
+    parent_sql, parent_params = _get(parent)
+    sql = 'CASE jsonb_typeof(' + parent_sql + ") WHEN 'object' THEN jsonb_set(doc, %s::text[], " + value_sql + \
+          ', true)'
+    params = parent_params + [path] + value_params
+    if last == '-':
+        append_sql, append_params = _set(parent, parent_sql + ' || jsonb_build_array(' + value_sql + ')',
+                                         parent_params + value_params)
+        sql += " WHEN 'array' THEN " + append_sql
+        params += append_params
+    elif ARRAY_INDEX_REGEX.match(last):
+        sql += " WHEN 'array' THEN CASE WHEN %s <= jsonb_array_length(" + parent_sql + \
+               ') THEN jsonb_insert(doc, %s::text[], ' + value_sql + ') END'
+        params += [int(last)] + parent_params + [path] + value_params
+    return sql + ' END', params
+
+
+def _exists(path, sql, params):
+    path_sql, path_params = _get(path)
+    return 'CASE WHEN ' + path_sql + ' IS NOT NULL THEN ' + sql + ' END', path_params + params
+
+
+def _step(doc, value=('NULL::jsonb', [])):
+    return doc[0], value[0], doc[1] + value[1]
+
+
+def _operation_steps(operation):
+    if not isinstance(operation, dict) or operation.get('op', None) not in JSON_PATCH_OPERATIONS:
+        raise ValidationException({MESSAGE_KEY: _('Invalid JSON patch operation %s') % json.dumps(operation)})
+    op = operation['op']
+    path = parse_json_pointer(operation.get('path', None))
+    if op in ('add', 'replace', 'test'):
+        if 'value' not in operation:
+            raise ValidationException({MESSAGE_KEY: _('Missing value in JSON patch operation %s') % op})
+        value = ('%s::jsonb', [json.dumps(operation['value'])])
+    if op in ('move', 'copy'):
+        from_path = parse_json_pointer(operation.get('from', None))
+
+    if op == 'add':
+        return [_step(_add(path, *value))]
+    if op == 'remove':
+        if not path:
+            raise ValidationException({MESSAGE_KEY: _('The whole document cannot be removed')})
+        return [_step(_exists(path, 'doc #- %s::text[]', [path]))]
+    if op == 'replace':
+        if not path:
+            return [_step(value)]
+        return [_step(_exists(path, 'jsonb_set(doc, %s::text[], ' + value[0] + ', false)', [path] + value[1]))]
+    if op == 'test':
+        path_sql, path_params = _get(path)
+        return [_step(('CASE WHEN ' + path_sql + ' = ' + value[0] + ' THEN doc END', path_params + value[1]))]
+
+    if from_path == path:
+        return [_step(_exists(path, 'doc', []))]
+    if op == 'move' and path[:len(from_path)] == from_path:
+        raise ValidationException({MESSAGE_KEY: _('A value cannot be moved into itself')})
+    from_sql, from_params = _get(from_path)
+    # The value is read by the first step and added by the second, only when it exists
+    if op == 'move':
+        first_step = _step(_exists(from_path, 'doc #- %s::text[]', [from_path]), (from_sql, from_params))
+    else:
+        first_step = _step(('doc', []), (from_sql, from_params))
+    add_sql, add_params = _add(path, 'value', [])
+    return [first_step, _step(('CASE WHEN value IS NOT NULL THEN ' + add_sql + ' END', add_params))]
+
+
+def json_patch_steps(operations):
+    # RFC 6902
+    if not isinstance(operations, list) or len(operations) > JSON_PATCH_MAX_OPERATIONS:
+        raise ValidationException({MESSAGE_KEY: _('A JSON patch is a list of at most %d operations')
+                                                % JSON_PATCH_MAX_OPERATIONS})
+    steps = []
+    for operation in operations:
+        steps += _operation_steps(operation)
+    return steps
+
+
+def merge_patch_steps(patch, path=None):
+    # RFC 7386, objects are merged member by member and null removes a member
+    path = path or []
+    if not isinstance(patch, dict):
+        return [_step(_set(path, '%s::jsonb', [json.dumps(patch)]))]
+
+    path_sql, path_params = _get(path)
+    steps = [_step(_set(path, 'CASE WHEN jsonb_typeof(' + path_sql + ") = 'object' THEN " + path_sql +
+                        " ELSE '{}'::jsonb END", path_params + path_params))]
+    for key, value in patch.items():
+        if value is None:
+            steps.append(_step(('doc #- %s::text[]', [path + [key]])))
+        else:
+            steps += merge_patch_steps(value, path + [key])
+    if len(steps) > JSON_PATCH_MAX_OPERATIONS:
+        raise ValidationException({MESSAGE_KEY: _('A JSON patch is a list of at most %d operations')
+                                                % JSON_PATCH_MAX_OPERATIONS})
+    return steps
+
+
+def patch_steps_from_request(request):
+    if request.content_type.startswith(MERGE_PATCH_MEDIA_TYPE) or not isinstance(request.data, list):
+        return merge_patch_steps(request.data)
+    return json_patch_steps(request.data)
+
+
+def apply_json_patch(model, instance_id, version, steps):
+    """
+    Patches the data column of a row in a single UPDATE, when its version is still
+    version, and returns the new version. Meant to run in a transaction.
+    """
+    table = connection.ops.quote_name(model._meta.db_table)
+    ctes = ['s0 AS (SELECT data AS doc, NULL::jsonb AS value FROM {table} WHERE id = %s AND version = %s '
+            'FOR UPDATE)'.format(table=table)]
+    params = [instance_id, version]
+    for index, (doc_sql, value_sql, step_params) in enumerate(steps):
+        ctes.append('s{index} AS (SELECT {doc} AS doc, {value} AS value FROM s{previous})'.format(
+            index=index + 1, doc=doc_sql, value=value_sql, previous=index))
+        params += step_params
+    last_step = 's%d' % len(steps)
+    sql = 'WITH {ctes} UPDATE {table} SET data = {last_step}.doc, version = {table}.version + 1, ' \
+          'last_modification_time = %s FROM {last_step} WHERE {table}.id = %s AND {last_step}.doc IS NOT NULL ' \
+          'RETURNING {table}.version'.format(ctes=', '.join(ctes), table=table, last_step=last_step)
+    params += [timezone.now(), instance_id]
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        row = cursor.fetchone()
+    if row:
+        return row[0]
+    if model.objects.filter(id=instance_id, version=version).exists():
+        raise JSONPatchFailed()
+    raise JSONPatchConflict()
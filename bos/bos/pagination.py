@@ -13,10 +13,118 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import binascii
+import json
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils.translation import gettext_lazy as _
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param, remove_query_param
+
+PAGINATION_MODE_CURSOR = 'cursor'
 
 
 class BOSPageNumberPagination(PageNumberPagination):
+    """
+    Page number pagination with an opt-in keyset mode.
+
+    Passing ?pagination=cursor (or a ?cursor= returned by a previous page) orders the
+    queryset by (creation_time, id), or by id for models without creation_time, and
+    seeks past the last row of the previous page instead of using OFFSET. Cursor
+    pages do not run a COUNT(*) and only link to the next page.
+    ?ordering=-creation_time walks the rows newest first.
+    """
     max_page_size = 10000
     page_query_param = 'page'
     page_size_query_param = 'page_size'
+    pagination_mode_query_param = 'pagination'
+    cursor_query_param = 'cursor'
+    cursor_page_size = 100
+    invalid_cursor_message = _('Invalid cursor')
+
+    cursor_mode = False
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.cursor_mode = request.query_params.get(self.pagination_mode_query_param) == PAGINATION_MODE_CURSOR \
+                           or self.cursor_query_param in request.query_params
+        if not self.cursor_mode:
+            return super().paginate_queryset(queryset, request, view)
+        return self.paginate_queryset_by_cursor(queryset, request)
+
+    def get_paginated_response(self, data):
+        if not self.cursor_mode:
+            return super().get_paginated_response(data)
+        return Response(OrderedDict([
+            ('next', self.get_next_cursor_link()),
+            ('results', data)
+        ]))
+
+    def paginate_queryset_by_cursor(self, queryset, request):
+        self.request = request
+        self.page_size = self.get_page_size(request) or self.cursor_page_size
+        self.descending = request.query_params.get('ordering') == '-creation_time'
+        self.ordering_fields = get_keyset_fields(queryset.model)
+
+        queryset = queryset.order_by(*[('-' if self.descending else '') + field for field in self.ordering_fields])
+        encoded_cursor = request.query_params.get(self.cursor_query_param)
+        if encoded_cursor:
+            queryset = queryset.filter(self.keyset_filter(self.decode_cursor(encoded_cursor)))
+
+        # One extra row tells whether there is a next page without counting
+        results = list(queryset[:self.page_size + 1])
+        self.has_next = len(results) > self.page_size
+        self.page_results = results[:self.page_size]
+        return self.page_results
+
+    def keyset_filter(self, position):
+        lookup = 'lt' if self.descending else 'gt'
+        keyset_filter = Q()
+        for index in reversed(range(len(self.ordering_fields))):
+            equal_filters = {field: position[field] for field in self.ordering_fields[:index]}
+            field = self.ordering_fields[index]
+            keyset_filter = Q(**{'%s__%s' % (field, lookup): position[field]}, **equal_filters) | keyset_filter
+        return keyset_filter
+
+    def get_next_cursor_link(self):
+        if not self.has_next:
+            return None
+        last = self.page_results[-1]
+        position = [getattr(last, field) for field in self.ordering_fields]
+        url = remove_query_param(self.request.build_absolute_uri(), self.page_query_param)
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(position))
+
+    def encode_cursor(self, position):
+        position = [value.isoformat() if hasattr(value, 'isoformat') else value for value in position]
+        return b64encode(json.dumps(position).encode('ascii'), altchars=b'-_').decode('ascii')
+
+    def decode_cursor(self, encoded_cursor):
+        try:
+            position = json.loads(b64decode(encoded_cursor.encode('ascii'), altchars=b'-_').decode('ascii'))
+        except (TypeError, ValueError, UnicodeError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(position, list) or len(position) != len(self.ordering_fields):
+            raise NotFound(self.invalid_cursor_message)
+
+        decoded_position = dict(zip(self.ordering_fields, position))
+        try:
+            if 'creation_time' in decoded_position:
+                decoded_position['creation_time'] = parse_datetime(decoded_position['creation_time'])
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if decoded_position.get('creation_time', True) is None or type(decoded_position['id']) is not int:
+            raise NotFound(self.invalid_cursor_message)
+        return decoded_position
+
+
+def get_keyset_fields(model):
+    try:
+        model._meta.get_field('creation_time')
+    except FieldDoesNotExist:
+        return ['id']
+    return ['creation_time', 'id']
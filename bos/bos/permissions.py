@@ -14,8 +14,16 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.models import Permission
+from django.core.cache import caches
+from django.db.models import Q
 from rest_framework import permissions
 
+from bos.cache import LRUCache
+
 # BOS_ADMIN
 PERMISSION_BOS_ADMIN = ('bos_admin', 'bos admin', 'users.bos_admin')
 
@@ -201,10 +209,71 @@ DEFAULT_PERMISSIONS_COACH = [PERMISSION_CAN_VIEW_CURRICULUM,
                              ] + PERMISSIONS_ATHLETE
 
 
+ALL_PERMISSIONS = [PERMISSION_BOS_ADMIN] + DEFAULT_PERMISSIONS_BOS_NGO_ADMIN
+# Every permission checked by the app owns one bit, so the permissions of a user fit in a single integer
+PERMISSION_BITS = {permission[2]: 1 << index for index, permission in enumerate(ALL_PERMISSIONS)}
+ALL_PERMISSION_BITS = (1 << len(ALL_PERMISSIONS)) - 1
+
+PERMISSION_CACHE_SIZE = getattr(settings, "PERMISSION_CACHE_SIZE", 10000)
+PERMISSION_CACHE_TIMEOUT = getattr(settings, "PERMISSION_CACHE_TIMEOUT", 300)
+# Alias of a django cache shared between processes, e.g. memcached or redis, holding the permissions version.
+# A per process cache would only see its own bumps, so permissions are not cached when None.
+PERMISSION_CACHE_BACKEND = getattr(settings, "PERMISSION_CACHE_BACKEND", None)
+# A lost bump still reaches every process once the version expires
+PERMISSIONS_VERSION_TIMEOUT = getattr(settings, "PERMISSIONS_VERSION_TIMEOUT", 3600)
+PERMISSIONS_VERSION_CACHE_KEY = 'permissions_version'
+
+permission_cache = LRUCache(PERMISSION_CACHE_SIZE, PERMISSION_CACHE_TIMEOUT)
+
+
+def get_permissions_version():
+    if PERMISSION_CACHE_BACKEND is None:
+        return None
+    return caches[PERMISSION_CACHE_BACKEND].get_or_set(PERMISSIONS_VERSION_CACHE_KEY, lambda: uuid.uuid4().hex,
+                                                       PERMISSIONS_VERSION_TIMEOUT)
+
+
+def invalidate_permission_cache():
+    if PERMISSION_CACHE_BACKEND is not None:
+        caches[PERMISSION_CACHE_BACKEND].set(PERMISSIONS_VERSION_CACHE_KEY, uuid.uuid4().hex,
+                                             PERMISSIONS_VERSION_TIMEOUT)
+    permission_cache.clear()
+
+
+def get_permission_bits(user):
+    if not user or not user.is_active:
+        return 0
+    if user.is_superuser:
+        return ALL_PERMISSION_BITS
+
+    permissions_version = get_permissions_version()
+    cached_permission_bits = permission_cache.get(user.id) if permissions_version is not None else None
+    if cached_permission_bits is not None and cached_permission_bits[0] == permissions_version:
+        return cached_permission_bits[1]
+
+    # User and group permissions in one query, bypassing the per instance cache of the auth backend
+    user_permissions = Permission.objects.filter(Q(user=user) | Q(group__user=user)) \
+        .values_list('content_type__app_label', 'codename').distinct()
+    permission_bits = 0
+    for app_label, codename in user_permissions:
+        permission_bits |= PERMISSION_BITS.get('%s.%s' % (app_label, codename), 0)
+    if permissions_version is not None:
+        permission_cache.set(user.id, (permissions_version, permission_bits))
+    return permission_bits
+
+
 def has_permission(request, permission):
-    if request.user and request.user.has_perm(permission[2]):
-        return True
-    return False
+    if not request.user:
+        return False
+    permission_bit = PERMISSION_BITS.get(permission[2], None)
+    if permission_bit is None:
+        return request.user.has_perm(permission[2])
+
+    permission_bits = getattr(request, '_permission_bits', None)
+    if permission_bits is None:
+        permission_bits = get_permission_bits(request.user)
+        request._permission_bits = permission_bits
+    return permission_bits & permission_bit != 0
 
 
 class CanAddMeasurement(permissions.BasePermission):
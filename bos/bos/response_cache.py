@@ -0,0 +1,95 @@
+#  Copyright (c) 2019 Maverick Labs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as,
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import hashlib
+import threading
+from collections import Counter
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.response import Response
+
+from bos.permissions import has_permission
+from bos.versions import collection_versions, request_variant, NGO_FROM_KEY, NGO_FROM_USER
+
+RESPONSE_CACHE_TIMEOUT = getattr(settings, "RESPONSE_CACHE_TIMEOUT", 3600)
+# Alias of the django cache holding responses, shared between processes, e.g. memcached or redis, or file based
+# in tests. Disabled when None.
+RESPONSE_CACHE_BACKEND = getattr(settings, "RESPONSE_CACHE_BACKEND", None)
+RESPONSE_CACHE_KEY_PREFIX = 'response:'
+
+response_cache_hits = Counter()
+response_cache_misses = Counter()
+_response_cache_metrics_lock = threading.Lock()
+
+
+def response_cache_metrics():
+    with _response_cache_metrics_lock:
+        return {endpoint: {'hits': response_cache_hits[endpoint], 'misses': response_cache_misses[endpoint]}
+                for endpoint in set(response_cache_hits) | set(response_cache_misses)}
+
+
+def _count_response_cache_lookup(counter, endpoint):
+    with _response_cache_metrics_lock:
+        counter[endpoint] += 1
+
+
+def _response_cache_key(request, etag):
+    key = '|'.join([etag, request.get_host(), request.path, request_variant(request)])
+    return RESPONSE_CACHE_KEY_PREFIX + hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def cached_response(collections, ngo_from=NGO_FROM_USER, permission=None):
+    """
+    Decorates a view action whose response only depends on collections, as in
+    bos.versions.conditional_on_collections, on the query parameters and on the language.
+    Versions of the collections are part of the cache key, so entries written before
+    a write are never read again and expire on their own. permission is checked
+    before the cache is read, for views that check it themselves.
+    """
+    def decorator(view):
+        endpoint = view.__qualname__
+
+        @wraps(view)
+        def cached_view(self, request, *args, **kwargs):
+            if RESPONSE_CACHE_BACKEND is None:
+                return view(self, request, *args, **kwargs)
+            if permission is not None and not has_permission(request, permission):
+                return Response(status=403)
+
+            ngo_id = request.user.ngo_id if ngo_from == NGO_FROM_USER else None
+            ngo_key = kwargs.get('pk', None) if ngo_from == NGO_FROM_KEY else None
+            if ngo_from == NGO_FROM_KEY and (request.user.ngo is None or request.user.ngo.key != ngo_key):
+                # Only the view answers for ngos the user does not belong to, with its 404 or 403
+                return view(self, request, *args, **kwargs)
+            etag, _ = collection_versions(collections, ngo_id=ngo_id, ngo_key=ngo_key)
+            cache = caches[RESPONSE_CACHE_BACKEND]
+            cache_key = _response_cache_key(request, etag)
+            data = cache.get(cache_key)
+            if data is not None:
+                _count_response_cache_lookup(response_cache_hits, endpoint)
+                response = Response(data=data)
+                response['X-Cache'] = 'HIT'
+                return response
+
+            _count_response_cache_lookup(response_cache_misses, endpoint)
+            response = view(self, request, *args, **kwargs)
+            if response.status_code == 200 and isinstance(response, Response):
+                cache.set(cache_key, response.data, RESPONSE_CACHE_TIMEOUT)
+                response['X-Cache'] = 'MISS'
+            return response
+        return cached_view
+    return decorator
@@ -0,0 +1,77 @@
+#  Copyright (c) 2019 Maverick Labs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as,
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.conf import settings
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db.models import CharField, Lookup, Q, Case, When, Value, BooleanField
+from django.db.models.functions import Greatest
+
+AUTOCOMPLETE_LIMIT = getattr(settings, "AUTOCOMPLETE_LIMIT", 10)
+
+
+class ILikeLookup(Lookup):
+    """
+    Case insensitive pattern match written as ILIKE, which a pg_trgm GIN index can
+    answer, unlike the UPPER(...) LIKE UPPER(...) generated by icontains.
+    """
+    param_pattern = '%s'
+    prepare_rhs = False
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return '%s ILIKE %s' % (lhs, rhs), lhs_params + rhs_params
+
+    def get_db_prep_lookup(self, value, connection):
+        return '%s', [self.param_pattern % connection.ops.prep_for_like_query(value)]
+
+
+@CharField.register_lookup
+class ILikeContains(ILikeLookup):
+    lookup_name = 'ilike_contains'
+    param_pattern = '%%%s%%'
+
+
+@CharField.register_lookup
+class ILikeStartsWith(ILikeLookup):
+    lookup_name = 'ilike_startswith'
+    param_pattern = '%s%%'
+
+
+def contains_filter(fields, value):
+    field_filter = Q()
+    for field in fields:
+        field_filter |= Q(**{field + '__ilike_contains': value})
+    return field_filter
+
+
+def autocomplete(queryset, fields, query, limit=AUTOCOMPLETE_LIMIT):
+    """
+    Rows where one of fields starts with query come first, followed by rows that
+    are only similar to it, each ranked by their best trigram similarity.
+    """
+    prefix_filter = Q()
+    similar_filter = Q()
+    for field in fields:
+        prefix_filter |= Q(**{field + '__ilike_startswith': query})
+        similar_filter |= Q(**{field + '__trigram_similar': query})
+
+    similarities = [TrigramSimilarity(field, query) for field in fields]
+    similarity = Greatest(*similarities) if len(similarities) > 1 else similarities[0]
+    return queryset.filter(prefix_filter | similar_filter).annotate(
+        is_prefix=Case(When(prefix_filter, then=Value(True)), default=Value(False), output_field=BooleanField()),
+        similarity=similarity,
+    ).order_by('-is_prefix', '-similarity')[:limit]
@@ -0,0 +1,170 @@
+#  Copyright (c) 2019 Maverick Labs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as,
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.translation import gettext as _
+
+from bos.constants import MESSAGE_KEY
+from bos.exceptions import ValidationException
+from bos.utils import find_user_ids_under_users
+from measurements.models import Measurement
+from measurements.serializers import MeasurementSerializer
+from resources.models import Resource, EvaluationResource
+from resources.serializers import ResourceDetailSerializer, EvaluationResourceDetailSerializer
+from users.models import User, UserGroup, UserHierarchy, Tombstone
+from users.serializers import UserRestrictedDetailSerializer, UserGroupSyncSerializer
+
+# Rows committed shortly after the previous sync started may carry an older last_modification_time
+SYNC_WATERMARK_OVERLAP = timedelta(seconds=getattr(settings, "SYNC_WATERMARK_OVERLAP", 60))
+# Tombstones are purged after this many days, older watermarks cannot tell the deletions anymore
+TOMBSTONE_RETENTION_DAYS = getattr(settings, "TOMBSTONE_RETENTION_DAYS", 90)
+
+
+def _since_from_request(query_params, collections):
+    since = {}
+    for collection in collections:
+        name = collection + '_since' if collection + '_since' in query_params else 'since'
+        value = query_params.get(name, None)
+        if not value:
+            since[collection] = None
+            continue
+        try:
+            value = parse_datetime(value)
+        except ValueError:
+            value = None
+        if value is None:
+            raise ValidationException({MESSAGE_KEY: _('Invalid %s') % name})
+        if timezone.is_naive(value):
+            value = timezone.make_aware(value, timezone.utc)
+        if value < timezone.now() - timedelta(days=TOMBSTONE_RETENTION_DAYS):
+            raise ValidationException({MESSAGE_KEY: _('Expired %s, sync again without it') % name})
+        since[collection] = value - SYNC_WATERMARK_OVERLAP
+    return since
+
+
+def _tombstone_keys(ngo, collection, since):
+    return set(Tombstone.objects.filter(ngo=ngo, collection=collection, deletion_time__gt=since)
+               .values_list('object_key', flat=True))
+
+
+def _sync_collection(ngo, collection, since, queryset, serializer_class, visible_filter=Q(is_active=True),
+                     change_fields=('last_modification_time',)):
+    """
+    queryset holds every row of the collection the user can reach whatever its state,
+    visible_filter the rows the app keeps. Changed rows that are no longer visible and
+    tombstoned keys that are not visible anymore are returned as deleted.
+    """
+    visible = queryset.filter(visible_filter)
+    if since is None:
+        return {'changed': serializer_class(visible, many=True).data, 'deleted': []}
+
+    change_filter = Q()
+    for field in change_fields:
+        change_filter |= Q(**{field + '__gt': since})
+    changed = queryset.filter(change_filter)
+    deleted = set(changed.exclude(visible_filter).values_list('key', flat=True))
+
+    tombstone_keys = _tombstone_keys(ngo, collection, since)
+    if tombstone_keys:
+        deleted |= tombstone_keys - set(visible.filter(key__in=tombstone_keys).values_list('key', flat=True))
+    return {'changed': serializer_class(changed.filter(visible_filter), many=True).data, 'deleted': sorted(deleted)}
+
+
+def _sync_hierarchy(user, since):
+    # Edges are grouped by child, a child that lost one of its edges is sent again with its remaining parents
+    user_hierarchies = UserHierarchy.objects.filter(child_user_id__in=find_user_ids_under_users([user.id]))
+    tombstone_keys = set()
+    if since is not None:
+        tombstone_keys = _tombstone_keys(user.ngo, Tombstone.HIERARCHY, since)
+        changed_child_user_ids = user_hierarchies.filter(
+            Q(last_modification_time__gt=since) | Q(child_user__key__in=tombstone_keys)).values('child_user_id')
+        user_hierarchies = user_hierarchies.filter(child_user_id__in=changed_child_user_ids)
+
+    parent_user_keys = defaultdict(list)
+    for parent_user_key, child_user_key in user_hierarchies.values_list('parent_user__key', 'child_user__key'):
+        parent_user_keys[child_user_key].append(parent_user_key)
+    changed = [{'child_user': child_user_key, 'parent_users': parent_keys}
+               for child_user_key, parent_keys in parent_user_keys.items()]
+    return {'changed': changed, 'deleted': sorted(tombstone_keys - set(parent_user_keys))}
+
+
+def _sync_athletes(user, since):
+    queryset = User.objects.filter(id__in=find_user_ids_under_users([user.id]), role=User.ATHLETE) \
+        .select_related('ngo')
+    return _sync_collection(user.ngo, Tombstone.ATHLETES, since, queryset, UserRestrictedDetailSerializer)
+
+
+def _sync_resources(user, since):
+    queryset = Resource.objects.filter(Q(userresource__user=user) | Q(ngoregistrationresource__ngo=user.ngo) |
+                                       Q(usergroup__users=user)).select_related('ngo').distinct()
+    # Links bump their own last_modification_time, group memberships bump the group's
+    change_fields = ('last_modification_time', 'userresource__last_modification_time',
+                     'ngoregistrationresource__last_modification_time', 'usergroup__last_modification_time')
+    return _sync_collection(user.ngo, Tombstone.RESOURCES, since, queryset, ResourceDetailSerializer,
+                            change_fields=change_fields)
+
+
+def _sync_groups(user, since):
+    queryset = UserGroup.objects.filter(users=user, ngo=user.ngo).select_related('ngo') \
+        .prefetch_related('users', 'resources')
+    return _sync_collection(user.ngo, Tombstone.GROUPS, since, queryset, UserGroupSyncSerializer)
+
+
+def _sync_measurements(user, since):
+    queryset = Measurement.objects.filter(ngo=user.ngo).select_related('ngo').prefetch_related('types')
+    return _sync_collection(user.ngo, Tombstone.MEASUREMENTS, since, queryset, MeasurementSerializer)
+
+
+def _sync_evaluation_resources(user, since):
+    queryset = EvaluationResource.objects.filter(user=user, ngo=user.ngo) \
+        .select_related('ngo', 'evaluated_user', 'evaluated_group')
+    return _sync_collection(user.ngo, Tombstone.EVALUATION_RESOURCES, since, queryset,
+                            EvaluationResourceDetailSerializer, visible_filter=Q(is_evaluated=False))
+
+
+SYNC_COLLECTIONS = {
+    Tombstone.ATHLETES: _sync_athletes,
+    Tombstone.HIERARCHY: _sync_hierarchy,
+    Tombstone.RESOURCES: _sync_resources,
+    Tombstone.GROUPS: _sync_groups,
+    Tombstone.MEASUREMENTS: _sync_measurements,
+    Tombstone.EVALUATION_RESOURCES: _sync_evaluation_resources,
+}
+
+
+def sync_collections(user, query_params):
+    """
+    Rows of the mobile collections changed since the watermark of each collection,
+    given as since or <collection>_since, and the keys to remove. Without a watermark
+    the whole collection is returned. The returned watermark is used for the next call.
+    """
+    collections = list(SYNC_COLLECTIONS)
+    if query_params.get('collections', None):
+        collections = [collection for collection in query_params['collections'].split(',')
+                       if collection in SYNC_COLLECTIONS]
+    since = _since_from_request(query_params, collections)
+
+    watermark = timezone.now()
+    return {
+        'watermark': watermark.isoformat(),
+        'collections': {collection: SYNC_COLLECTIONS[collection](user, since[collection])
+                        for collection in collections},
+    }
@@ -19,6 +19,8 @@ from django.contrib import admin
 from django.urls import path, include
 from rest_framework import routers
 
+from bos.instrumentation import metrics_view
+
 from measurements import views as measurement_views
 from ngos import views as ngo_views
 from users import views as user_views
@@ -39,10 +41,12 @@ router.register(r'resources', resource_views.ResourceViewSet, 'Resource')
 router.register(r'evaluation_resources', resource_views.EvaluationResourceViewSet, 'EvaluationResource')
 router.register(r'readings', user_views.UserReadingViewSet, 'UserReading')
 router.register(r'requests', user_views.UserRequestViewSet, 'UserRequest')
+router.register(r'sync', user_views.SyncViewSet, 'Sync')
 
 urlpatterns = [
     url(r'^', include(router.urls)),
     path('admin/', admin.site.urls),
+    url(r'^metrics$', metrics_view, name='metrics'),
     url(r'^login', user_views.login_view, name='login'),
     url(r'^logout', user_views.logout_view, name='logout'),
     url(r'^is_authenticated', user_views.is_authenticated, name='is_user_authenticated'),
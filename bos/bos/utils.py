@@ -13,15 +13,24 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
-import requests
+import json
+from collections import defaultdict
+
 from django.db.models import Q
 from django.utils.translation import gettext as _
-
-from bos.constants import MESSAGE_KEY, VALID_FILE_EXTENSIONS
+from rest_framework.utils.encoders import JSONEncoder
+
+from bos.constants import MESSAGE_KEY, VALID_FILE_EXTENSIONS, BULK_CREATE_BATCH_SIZE
+from bos.exceptions import ValidationException
+from bos.search import contains_filter
+from measurements.models import Measurement
+from ngos.models import NGO
+from resources.models import Resource
 from users.management.commands.superset_api import login_superset, create_superset_user, get_roles, \
-    find_ngo_role_from_superset_roles, find_gamma_role_from_superset_roles
-from users.models import UserHierarchy, User
-from users.serializers import UserHierarchySerializer, UserRestrictedDetailSerializer
+    find_ngo_role_from_superset_roles, find_gamma_role_from_superset_roles, get_users, find_user, \
+    update_superset_user_if_needed, update_superset_user_password, RetryingSession
+from users.models import UserHierarchy, User, UserHierarchyClosure, UserReading
+from users.serializers import UserRestrictedDetailSerializer
 
 
 def get_ngo_group_name(ngo, name):
@@ -58,7 +67,7 @@ def user_filters_from_request(request_data):
         if available_user_search_filter in request_data:
             value = request_data.get(available_user_search_filter)
             if available_user_search_filter == 'name':
-                search_filter = Q(first_name__icontains=value) | Q(last_name__icontains=value)
+                search_filter = contains_filter(['first_name', 'last_name'], value)
 
     return user_filter, search_filter
 
@@ -84,7 +93,7 @@ def measurement_filters_from_request(request_data):
         if available_measurement_search_filter in request_data:
             value = request_data.get(available_measurement_search_filter)
             if available_measurement_search_filter == 'label':
-                search_filter = Q(label__icontains=value)
+                search_filter = contains_filter(['label'], value)
 
     return measurement_filter, search_filter
 
@@ -130,7 +139,7 @@ def ngo_filters_from_request(request_data):
         if available_ngo_search_filter in request_data:
             value = request_data.get(available_ngo_search_filter)
             if available_ngo_search_filter == 'name':
-                search_filter = Q(name__icontains=value)
+                search_filter = contains_filter(['name'], value)
 
     return ngo_filter, search_filter
 
@@ -156,11 +165,53 @@ def resource_filters_from_request(request_data):
         if available_resource_search_filter in request_data:
             value = request_data.get(available_resource_search_filter)
             if available_resource_search_filter == 'label':
-                search_filter = Q(label__icontains=value)
+                search_filter = contains_filter(['label'], value)
 
     return resource_filter, search_filter
 
 
+RESOURCE_FIELDS = tuple(field.name for field in Resource._meta.concrete_fields if field.name != 'id')
+RESOURCE_FIELDS_SUMMARY = 'summary'
+RESOURCE_SUMMARY_FIELDS = ('key', 'label', 'description', 'type', 'is_active', 'is_shared', 'ngo', 'version',
+                           'last_modification_time')
+
+
+def resource_fields_from_request(request_data):
+    """
+    Fields of the resources to return, from ?fields=, a list of fields or summary, and
+    ?omit=, a list of fields. None when all of them are returned.
+    """
+    fields = request_data.get('fields', None)
+    omit = request_data.get('omit', None)
+    if not fields and not omit:
+        return None
+
+    if fields == RESOURCE_FIELDS_SUMMARY:
+        fields = list(RESOURCE_SUMMARY_FIELDS)
+    elif fields:
+        fields = [field.strip() for field in fields.split(',') if field.strip()]
+    else:
+        fields = list(RESOURCE_FIELDS)
+    omitted_fields = [field.strip() for field in (omit or '').split(',') if field.strip()]
+    unknown_fields = set(fields + omitted_fields) - set(RESOURCE_FIELDS)
+    if unknown_fields:
+        raise ValidationException({MESSAGE_KEY: _('Unknown resource fields %s') % ', '.join(sorted(unknown_fields))})
+
+    fields = [field for field in fields if field not in omitted_fields]
+    if not fields:
+        raise ValidationException({MESSAGE_KEY: _('No resource fields to return')})
+    return fields
+
+
+def project_resources(queryset, fields):
+    # Only the columns of the returned fields are loaded, the ngo key is joined in
+    if fields is None:
+        return queryset.select_related('ngo')
+    if 'ngo' not in fields:
+        return queryset.only(*fields)
+    return queryset.select_related('ngo').only(*fields, 'ngo__key')
+
+
 def user_group_filters_from_request(request_data):
     user_group_filter = {}
     available_user_group_filters = ['is_active']
@@ -202,14 +253,83 @@ def user_reading_filters_from_request(request_data):
         if available_user_reading_search_filter in request_data:
             value = request_data.get(available_user_reading_search_filter)
             if available_user_reading_search_filter == 'athlete':
-                search_filter = search_filter & (
-                        Q(user__first_name__icontains=value) | Q(user__last_name__icontains=value))
+                search_filter = search_filter & contains_filter(['user__first_name', 'user__last_name'], value)
             if available_user_reading_search_filter == 'measurement':
                 search_filter = search_filter & Q(measurement__key=value)
 
+    # Range filters over numeric readings use the typed column instead of casting value
+    for available_user_reading_range_filter, lookup in [('value_min', 'numeric_value__gte'),
+                                                        ('value_max', 'numeric_value__lte')]:
+        if available_user_reading_range_filter in request_data:
+            try:
+                user_reading_filter[lookup] = float(request_data.get(available_user_reading_range_filter))
+            except ValueError:
+                pass
+
     return user_reading_filter, search_filter
 
 
+def build_user_readings(by_user, user_readings, results):
+    user_keys = set()
+    ngo_keys = set()
+    measurement_keys = set()
+    for index, user_reading_data in user_readings:
+        user_keys.add(user_reading_data['user'])
+        ngo_keys.add(user_reading_data['ngo'])
+        measurement_keys.add(user_reading_data['measurement'])
+
+    # One query per related model instead of one per field per reading
+    users = {key: (user_id, ngo_id) for key, user_id, ngo_id in
+             User.objects.filter(key__in=user_keys).values_list('key', 'id', 'ngo_id')}
+    ngos = dict(NGO.objects.filter(key__in=ngo_keys).values_list('key', 'id'))
+    measurements = {key: (measurement_id, ngo_id, input_type) for key, measurement_id, ngo_id, input_type in
+                    Measurement.objects.filter(key__in=measurement_keys)
+                        .values_list('key', 'id', 'ngo_id', 'input_type')}
+
+    user_readings_to_create = []
+    for index, user_reading_data in user_readings:
+        errors = {}
+        status = 400
+        ngo_id = ngos.get(user_reading_data['ngo'])
+        user = users.get(user_reading_data['user'])
+        measurement = measurements.get(user_reading_data['measurement'])
+        if ngo_id is None:
+            errors['ngo'] = [_('Object with key=%s does not exist.') % user_reading_data['ngo']]
+        elif ngo_id != by_user.ngo_id:
+            errors['ngo'] = [_('Readings can only be added to your ngo')]
+            status = 403
+        if user is None:
+            errors['user'] = [_('Object with key=%s does not exist.') % user_reading_data['user']]
+        elif ngo_id is not None and user[1] != ngo_id:
+            errors['user'] = [_('User does not belong to the ngo')]
+        if measurement is None:
+            errors['measurement'] = [_('Object with key=%s does not exist.') % user_reading_data['measurement']]
+        elif ngo_id is not None and measurement[1] != ngo_id:
+            errors['measurement'] = [_('Measurement does not belong to the ngo')]
+
+        if errors:
+            results[index]['status'] = status
+            results[index]['errors'] = errors
+            continue
+
+        user_reading = UserReading(
+            user_id=user[0],
+            ngo_id=ngo_id,
+            measurement_id=measurement[0],
+            by_user=by_user,
+            entered_by=by_user,
+            training_session_uuid=user_reading_data.get('training_session_uuid', None),
+            evaluation_resource_uuid=user_reading_data.get('evaluation_resource_uuid', None),
+            value=user_reading_data['value'],
+            recorded_at=user_reading_data['recorded_at'],
+            is_active=user_reading_data['is_active'],
+        )
+        # bulk_create skips save(), so the typed values are set here
+        user_reading.set_typed_values(measurement[2])
+        user_readings_to_create.append((index, user_reading))
+    return user_readings_to_create
+
+
 def user_request_filters_from_request(request_data):
     user_request_filter = {}
     available_user_reading_filters = ['is_active']
@@ -330,22 +450,110 @@ def request_user_belongs_to_user_request_ngo(request, user_request):
 
 
 def find_athletes_under_user(user):
-    user_ids = find_user_ids_under_users([user.id], [])
+    user_ids = find_user_ids_under_users([user.id])
     queryset = User.objects.filter(id__in=user_ids, role=User.ATHLETE)
     serializer = UserRestrictedDetailSerializer(queryset, many=True)
     return serializer.data
 
 
-def find_user_ids_under_users(user_ids, previous_children):
-    children = []
-    queryset = UserHierarchy.objects.filter(parent_user__in=user_ids)
-    serializer = UserHierarchySerializer(queryset, many=True)
-    for child in serializer.data:
-        children.append(child['child_user'])
-    if len(children) == 0:
-        return previous_children
-    else:
-        return find_user_ids_under_users(children, previous_children + children)
+def find_user_ids_under_users(user_ids):
+    return UserHierarchyClosure.objects.filter(ancestor__in=user_ids).values('descendant_id')
+
+
+def add_user_hierarchy_closure(parent_user, child_user):
+    ancestors = [(parent_user.id, 0)] + list(
+        UserHierarchyClosure.objects.filter(descendant=parent_user).values_list('ancestor_id', 'depth'))
+    descendants = [(child_user.id, 0)] + list(
+        UserHierarchyClosure.objects.filter(ancestor=child_user).values_list('descendant_id', 'depth'))
+
+    closures = []
+    for ancestor_id, ancestor_depth in ancestors:
+        for descendant_id, descendant_depth in descendants:
+            if ancestor_id == descendant_id:
+                continue
+            closures.append(UserHierarchyClosure(ancestor_id=ancestor_id, descendant_id=descendant_id,
+                                                 depth=ancestor_depth + descendant_depth + 1))
+    UserHierarchyClosure.objects.bulk_create(closures, batch_size=BULK_CREATE_BATCH_SIZE, ignore_conflicts=True)
+
+
+def update_user_hierarchy_closure(moved_user_ids):
+    """
+    Recomputes the closure rows of the users whose parent edges changed and of
+    everyone under them, from the stored edges. Rows of other users are kept.
+    """
+    subtree_user_ids = set(moved_user_ids) | set(UserHierarchyClosure.objects.filter(
+        ancestor_id__in=moved_user_ids).values_list('descendant_id', flat=True))
+    UserHierarchyClosure.objects.filter(descendant_id__in=subtree_user_ids).delete()
+
+    parents = defaultdict(list)
+    for parent_user_id, child_user_id in UserHierarchy.objects.filter(child_user_id__in=subtree_user_ids) \
+            .exclude(parent_user=None).values_list('parent_user_id', 'child_user_id'):
+        parents[child_user_id].append(parent_user_id)
+    outside_parent_ids = {parent_user_id for parent_user_ids in parents.values() for parent_user_id in parent_user_ids
+                          if parent_user_id not in subtree_user_ids}
+    ancestors = defaultdict(dict)
+    for ancestor_id, descendant_id, depth in UserHierarchyClosure.objects.filter(
+            descendant_id__in=outside_parent_ids).values_list('ancestor_id', 'descendant_id', 'depth'):
+        ancestors[descendant_id][ancestor_id] = depth
+
+    # Parents inside the subtree are resolved before their children, a parent still
+    # on the stack is part of a cycle and is skipped
+    for user_id in subtree_user_ids:
+        stack = [user_id]
+        on_stack = {user_id}
+        while stack:
+            current_id = stack[-1]
+            pending_ids = [parent_user_id for parent_user_id in parents[current_id] if parent_user_id in
+                           subtree_user_ids and parent_user_id not in ancestors and parent_user_id not in on_stack]
+            if pending_ids:
+                stack.extend(pending_ids)
+                on_stack.update(pending_ids)
+                continue
+            stack.pop()
+            on_stack.discard(current_id)
+            if current_id in ancestors:
+                continue
+            current_ancestors = {}
+            for parent_user_id in parents[current_id]:
+                if parent_user_id in subtree_user_ids and parent_user_id not in ancestors:
+                    continue
+                for ancestor_id, depth in [(parent_user_id, 0)] + list(ancestors[parent_user_id].items()):
+                    if ancestor_id != current_id and depth + 1 < current_ancestors.get(ancestor_id, depth + 2):
+                        current_ancestors[ancestor_id] = depth + 1
+            ancestors[current_id] = current_ancestors
+
+    closures = [UserHierarchyClosure(ancestor_id=ancestor_id, descendant_id=user_id, depth=depth)
+                for user_id in subtree_user_ids for ancestor_id, depth in ancestors[user_id].items()]
+    UserHierarchyClosure.objects.bulk_create(closures, batch_size=BULK_CREATE_BATCH_SIZE)
+
+
+def rebuild_user_hierarchy_closure(ngo):
+    UserHierarchyClosure.objects.filter(Q(ancestor__ngo=ngo) | Q(descendant__ngo=ngo)).delete()
+
+    user_hierarchies = UserHierarchy.objects.filter(Q(parent_user__ngo=ngo) | Q(child_user__ngo=ngo)) \
+        .exclude(parent_user=None).values_list('parent_user_id', 'child_user_id')
+    children = defaultdict(list)
+    for parent_user_id, child_user_id in user_hierarchies:
+        children[parent_user_id].append(child_user_id)
+
+    closures = []
+    for ancestor_id in children:
+        visited = {ancestor_id}
+        depth = 1
+        level = children[ancestor_id]
+        while level:
+            next_level = []
+            for descendant_id in level:
+                # Guards against cycles in the stored hierarchy
+                if descendant_id in visited:
+                    continue
+                visited.add(descendant_id)
+                closures.append(UserHierarchyClosure(ancestor_id=ancestor_id, descendant_id=descendant_id,
+                                                     depth=depth))
+                next_level.extend(children.get(descendant_id, []))
+            level = next_level
+            depth += 1
+    UserHierarchyClosure.objects.bulk_create(closures, batch_size=BULK_CREATE_BATCH_SIZE)
 
 
 def is_extension_valid(extension):
@@ -354,23 +562,64 @@ def is_extension_valid(extension):
     return False
 
 
+def stream_json_list(items):
+    yield '['
+    for index, item in enumerate(items):
+        if index != 0:
+            yield ','
+        yield json.dumps(item, cls=JSONEncoder)
+    yield ']'
+
+
 def debug_print(message):
     print(message)
     return
 
 
 def open_superset_session_and_create_user(admin):
-    with requests.Session() as session:
+    with RetryingSession() as session:
         session.auth = ('user', 'pass')
         # Login in as admin
         if not login_superset(session):
             return False
 
         is_successful, superset_roles = get_roles(session)
+        if not is_successful:
+            return False
+        is_successful, superset_users = get_users(session)
         if not is_successful:
             return False
 
         superset_role = find_ngo_role_from_superset_roles(admin.ngo, superset_roles)
         gamma_superset_role = find_gamma_role_from_superset_roles(superset_roles)
         assert gamma_superset_role
+        # A retried event may find the user created by an earlier attempt
+        superset_user = find_user(admin, superset_users)
+        if superset_user:
+            return update_superset_user_if_needed(admin, superset_user, [superset_role, gamma_superset_role], session)
         return create_superset_user(admin, [superset_role, gamma_superset_role], session)
+
+
+def open_superset_session_and_update_password(admin, password):
+    with RetryingSession() as session:
+        session.auth = ('user', 'pass')
+        # Login in as admin
+        if not login_superset(session):
+            return False
+
+        is_successful, superset_users = get_users(session)
+        if not is_successful:
+            return False
+
+        superset_user = find_user(admin, superset_users)
+        if superset_user:
+            return update_superset_user_password(superset_user, password, session)
+
+        # The outbox has not created the user yet, create it with the password
+        is_successful, superset_roles = get_roles(session)
+        if not is_successful:
+            return False
+        superset_role = find_ngo_role_from_superset_roles(admin.ngo, superset_roles)
+        gamma_superset_role = find_gamma_role_from_superset_roles(superset_roles)
+        assert gamma_superset_role
+        return create_superset_user(admin, [superset_role, gamma_superset_role], session, password)
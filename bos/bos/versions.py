@@ -0,0 +1,123 @@
+#  Copyright (c) 2019 Maverick Labs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as,
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import hashlib
+from functools import wraps
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag, http_date, urlencode
+from django.utils.translation import get_language
+
+from ngos.models import CollectionVersion
+
+COLLECTION_MEASUREMENTS = 'measurements'
+COLLECTION_MEASUREMENT_TYPES = 'measurement_types'
+COLLECTION_RESOURCES = 'resources'
+COLLECTION_NGOS = 'ngos'
+COLLECTION_PERMISSIONS = 'permissions'
+# Collections shared by every ngo, versioned without an ngo
+GLOBAL_COLLECTIONS = (COLLECTION_NGOS, COLLECTION_PERMISSIONS)
+
+# Where conditional views find the ngo whose collections they serve
+NGO_FROM_KEY = 'key'
+NGO_FROM_USER = 'user'
+
+
+def bump_collection_version(collection, ngo_id=None):
+    if collection in GLOBAL_COLLECTIONS:
+        ngo_id = None
+    updated = CollectionVersion.objects.filter(ngo_id=ngo_id, collection=collection) \
+        .update(version=F('version') + 1, last_modification_time=timezone.now())
+    if updated:
+        return
+    try:
+        with transaction.atomic():
+            CollectionVersion.objects.create(ngo_id=ngo_id, collection=collection)
+    except IntegrityError:
+        # Created by a concurrent write, which bumped it already
+        pass
+
+
+def collection_versions(collections, ngo_id=None, ngo_key=None):
+    """
+    Returns the ETag and Last-Modified timestamp of collections, in one query. A
+    collection never written to has version 0 and no modification time.
+    """
+    collection_filter = Q(ngo__isnull=True, collection__in=[collection for collection in collections
+                                                             if collection in GLOBAL_COLLECTIONS])
+    ngo_collections = [collection for collection in collections if collection not in GLOBAL_COLLECTIONS]
+    if ngo_collections and ngo_id is not None:
+        collection_filter |= Q(ngo_id=ngo_id, collection__in=ngo_collections)
+    elif ngo_collections and ngo_key is not None:
+        collection_filter |= Q(ngo__key=ngo_key, collection__in=ngo_collections)
+
+    versions = {collection: 0 for collection in collections}
+    last_modification_time = None
+    for collection, version, modification_time in CollectionVersion.objects.filter(collection_filter) \
+            .values_list('collection', 'version', 'last_modification_time'):
+        versions[collection] = version
+        if last_modification_time is None or modification_time > last_modification_time:
+            last_modification_time = modification_time
+
+    scope = ngo_key if ngo_key is not None else str(ngo_id)
+    etag = hashlib.sha1((scope + ':' + ','.join('%s=%d' % (collection, versions[collection])
+                                                 for collection in sorted(versions))).encode()).hexdigest()
+    return etag, int(last_modification_time.timestamp()) if last_modification_time else None
+
+
+def request_variant(request):
+    # Query parameters like fields or search and the language change the body built from the same versions
+    # The same language is reported as en-in or en-IN depending on how it was activated
+    return '|'.join([urlencode(sorted(request.GET.lists()), doseq=True), (get_language() or '').lower()])
+
+
+def conditional_response(request, build_response, collections, ngo_id=None, ngo_key=None):
+    """
+    Answers with 304 Not Modified when the client holds the current versions of the
+    collections the response is built from, without calling build_response. Views
+    call it once their lookups and permission checks passed.
+    """
+    etag, last_modified = collection_versions(collections, ngo_id=ngo_id, ngo_key=ngo_key)
+    etag = hashlib.sha1((etag + '|' + request_variant(request)).encode()).hexdigest()
+    response = get_conditional_response(request, etag=quote_etag(etag), last_modified=last_modified)
+    if response is None:
+        response = build_response()
+        if response.status_code != 200:
+            return response
+    response['ETag'] = quote_etag(etag)
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    # Clients revalidate every time rather than reuse a response heuristically
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def conditional_on_collections(collections, ngo_from=None):
+    """
+    Decorates a view action whose response only depends on global collections or on
+    collections of the ngo of the request user (NGO_FROM_USER), with no lookup that could
+    fail. Views looking objects up call conditional_response after their checks instead.
+    """
+    def decorator(view):
+        @wraps(view)
+        def conditional_view(self, request, *args, **kwargs):
+            ngo_id = request.user.ngo_id if ngo_from == NGO_FROM_USER else None
+            return conditional_response(request, lambda: view(self, request, *args, **kwargs), collections,
+                                        ngo_id=ngo_id)
+        return conditional_view
+    return decorator
@@ -14,6 +14,7 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from django.contrib.postgres.indexes import GinIndex
 from django.db import models
 
 from django.utils.crypto import get_random_string
@@ -46,6 +47,10 @@ class Measurement(models.Model):
 
     class Meta:
         db_table = 'measurements'
+        indexes = [
+            models.Index(fields=['ngo', 'is_active'], name='measurements_ngo_active_idx'),
+            GinIndex(fields=['label'], name='measurements_label_trgm_idx', opclasses=['gin_trgm_ops']),
+        ]
 
     def __str__(self):
         return self.label
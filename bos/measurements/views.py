@@ -17,23 +17,29 @@ from django.db import transaction
 from django.db.models.deletion import ProtectedError
 from django.shortcuts import get_object_or_404
 from psycopg2._psycopg import DatabaseError
+from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.viewsets import ViewSet
 from django.utils.translation import gettext as _
 
+from bos.constants import METHOD_GET
 from bos.exceptions import ValidationException
 from bos.pagination import BOSPageNumberPagination
 from bos.permissions import has_permission, PERMISSION_CAN_VIEW_MEASUREMENT, PERMISSION_CAN_ADD_MEASUREMENT, \
     PERMISSION_CAN_CHANGE_MEASUREMENT, PERMISSION_CAN_DESTROY_MEASUREMENT, PERMISSION_CAN_VIEW_MEASUREMENT_TYPE, \
     PERMISSION_CAN_ADD_MEASUREMENT_TYPE, PERMISSION_CAN_CHANGE_MEASUREMENT_TYPE, PERMISSION_CAN_DESTROY_MEASUREMENT_TYPE
+from bos.response_cache import cached_response
+from bos.search import autocomplete
 from bos.utils import measurement_filters_from_request, measurement_type_filters_from_request, \
     error_protected_measurement, error_protected_measurement_type
+from bos.versions import COLLECTION_MEASUREMENTS, COLLECTION_MEASUREMENT_TYPES
 from measurements.models import Measurement, MeasurementType
 from measurements.serializers import MeasurementSerializer, MeasurementTypeSerializer
 
 
 class MeasurementViewSet(ViewSet):
 
+    @cached_response([COLLECTION_MEASUREMENTS], permission=PERMISSION_CAN_VIEW_MEASUREMENT)
     def list(self, request):
         if not has_permission(request, PERMISSION_CAN_VIEW_MEASUREMENT):
             return Response(status=403)
@@ -53,6 +59,18 @@ class MeasurementViewSet(ViewSet):
         serializer = MeasurementSerializer(result, many=True)
         return paginator.get_paginated_response(serializer.data)
 
+    @action(detail=False, methods=[METHOD_GET])
+    def autocomplete(self, request):
+        if not has_permission(request, PERMISSION_CAN_VIEW_MEASUREMENT):
+            return Response(status=403)
+
+        query = request.GET.get('q', '').strip()
+        if not query:
+            return Response(data=[])
+        queryset = Measurement.objects.filter(ngo=request.user.ngo, is_active=True)
+        measurements = autocomplete(queryset, ['label'], query).values('key', 'label', 'input_type', 'uom')
+        return Response(data=list(measurements))
+
     def create(self, request):
         if not has_permission(request, PERMISSION_CAN_ADD_MEASUREMENT):
             return Response(status=403)
@@ -112,6 +130,7 @@ class MeasurementViewSet(ViewSet):
 
 class MeasurementTypeViewSet(ViewSet):
 
+    @cached_response([COLLECTION_MEASUREMENT_TYPES], permission=PERMISSION_CAN_VIEW_MEASUREMENT_TYPE)
     def list(self, request):
         if not has_permission(request, PERMISSION_CAN_VIEW_MEASUREMENT_TYPE):
             return Response(status=403)
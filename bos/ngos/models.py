@@ -14,7 +14,9 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from django.contrib.postgres.indexes import GinIndex
 from django.db import models
+from django.db.models import Q
 from django.utils.crypto import get_random_string
 
 from bos.constants import PUBLIC_KEY_LENGTH_NGO
@@ -35,6 +37,9 @@ class NGO(models.Model):
 
     class Meta:
         db_table = 'ngos'
+        indexes = [
+            GinIndex(fields=['name'], name='ngos_name_trgm_idx', opclasses=['gin_trgm_ops']),
+        ]
 
     def __str__(self):
         return self.name
@@ -62,3 +67,20 @@ class NGORegistrationResource(models.Model):
 
     def __str__(self):
         return self.label
+
+
+class CollectionVersion(models.Model):
+    # Bumped on every write to a collection of the ngo, or to a global collection when ngo is null
+    ngo = models.ForeignKey('ngos.NGO', null=True, blank=False, on_delete=models.CASCADE)
+    collection = models.CharField(max_length=50, null=False, blank=False)
+    version = models.PositiveIntegerField(default=1)
+    last_modification_time = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'collection_versions'
+        constraints = [
+            models.UniqueConstraint(fields=['ngo', 'collection'], condition=Q(ngo__isnull=False),
+                                    name='collection_versions_ngo_uniq'),
+            models.UniqueConstraint(fields=['collection'], condition=Q(ngo__isnull=True),
+                                    name='collection_versions_global_uniq'),
+        ]
@@ -1,3 +1,108 @@
+from unittest import mock
+
+from django.core.cache import caches
 from django.test import TestCase
+from rest_framework.test import APIClient
+
+from bos.exceptions import ValidationException
+from bos.utils import rebuild_user_hierarchy_closure
+from ngos.models import NGO
+from ngos.views import save_user_hierarchy_edges
+from users.models import User, UserHierarchyClosure
+
+
+class SaveUserHierarchyEdgesTestCase(TestCase):
+
+    def setUp(self):
+        self.ngo = NGO.objects.create(name='Test ngo')
+        self.users = {}
+        for username in 'abcdef':
+            self.users[username] = User.objects.create(username=username, first_name=username, last_name=username,
+                                                       ngo=self.ngo, role=User.COACH, gender=User.MALE)
+
+    def save_edges(self, edges):
+        save_user_hierarchy_edges(self.ngo, [(self.users[parent].key if parent else None, self.users[child].key)
+                                             for parent, child in edges])
+
+    def closure(self):
+        return set(UserHierarchyClosure.objects.values_list('ancestor__username', 'descendant__username', 'depth'))
+
+    def assertClosureRebuilt(self):
+        closure = self.closure()
+        rebuild_user_hierarchy_closure(self.ngo)
+        self.assertEqual(closure, self.closure())
+
+    def test_moved_subtree_closure(self):
+        self.save_edges([(None, 'a'), ('a', 'b'), ('b', 'c'), ('c', 'd'), ('a', 'e'), ('e', 'f')])
+        self.assertClosureRebuilt()
+
+        self.save_edges([(None, 'a'), ('a', 'b'), ('e', 'c'), ('c', 'd'), ('a', 'e'), ('e', 'f')])
+        self.assertClosureRebuilt()
+        self.assertIn(('e', 'd', 2), self.closure())
+        self.assertNotIn(('b', 'd', 2), self.closure())
+
+        self.save_edges([(None, 'a'), ('a', 'b'), ('e', 'c'), ('c', 'd'), (None, 'e'), ('e', 'f')])
+        self.assertClosureRebuilt()
+        self.assertFalse([descendant for ancestor, descendant, depth in self.closure() if ancestor == 'a'
+                          and descendant != 'b'])
+
+    def test_unmoved_closure_rows_are_kept(self):
+        self.save_edges([(None, 'a'), ('a', 'b'), ('b', 'c'), ('a', 'd')])
+        kept_ids = set(UserHierarchyClosure.objects.filter(descendant__username__in=['b', 'c'])
+                       .values_list('id', flat=True))
+
+        self.save_edges([(None, 'a'), ('a', 'b'), ('b', 'c'), ('c', 'd')])
+        self.assertEqual(kept_ids, set(UserHierarchyClosure.objects.filter(descendant__username__in=['b', 'c'])
+                                       .values_list('id', flat=True)))
+        self.assertClosureRebuilt()
+
+    def test_users_of_other_ngos_are_rejected(self):
+        other_ngo = NGO.objects.create(name='Other ngo')
+        self.users['g'] = User.objects.create(username='g', first_name='g', last_name='g', ngo=other_ngo,
+                                              role=User.COACH, gender=User.MALE)
+
+        with self.assertRaises(ValidationException):
+            self.save_edges([(None, 'a'), ('a', 'g')])
+        self.assertFalse(UserHierarchyClosure.objects.exists())
+
+
+class ConditionalResponseTestCase(TestCase):
+
+    def setUp(self):
+        self.ngo = NGO.objects.create(name='Test ngo')
+        user = User.objects.create(username='coach', first_name='coach', last_name='coach', ngo=self.ngo,
+                                   role=User.COACH, gender=User.MALE)
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+
+    def test_missing_ngo_is_not_modified(self):
+        self.assertEqual(self.client.get('/ngos/missing/measurements/', HTTP_IF_NONE_MATCH='*').status_code, 404)
+
+    def test_etag_of_variants(self):
+        url = '/ngos/%s/measurements/' % self.ngo.key
+        etag = self.client.get(url, HTTP_ACCEPT_LANGUAGE='en')['ETag']
+
+        self.assertEqual(self.client.get(url, HTTP_ACCEPT_LANGUAGE='en', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertNotEqual(self.client.get(url + '?search=push', HTTP_ACCEPT_LANGUAGE='en')['ETag'], etag)
+        self.assertNotEqual(self.client.get(url, HTTP_ACCEPT_LANGUAGE='hi')['ETag'], etag)
+
+
+class CachedResponseTestCase(TestCase):
+
+    def client_of(self, ngo):
+        user = User.objects.create(username='admin ' + ngo.name, first_name='admin', last_name='admin', ngo=ngo,
+                                   role=User.ADMIN, gender=User.MALE, is_superuser=True)
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    @mock.patch('bos.response_cache.RESPONSE_CACHE_BACKEND', 'default')
+    def test_cached_response_of_other_ngo(self):
+        caches['default'].clear()
+        ngo = NGO.objects.create(name='Test ngo')
+        url = '/ngos/%s/files/' % ngo.key
+        client = self.client_of(ngo)
+        self.assertEqual(client.get(url).status_code, 200)
+        self.assertEqual(client.get(url)['X-Cache'], 'HIT')
 
-# Create your tests here.
+        self.assertEqual(self.client_of(NGO.objects.create(name='Other ngo')).get(url).status_code, 403)
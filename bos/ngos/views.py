@@ -14,12 +14,16 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from collections import defaultdict
+
 from django.contrib.auth.models import Group, Permission
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError
 from django.db import transaction
 from django.db.models import Q
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils.translation import gettext as _
 from psycopg2._psycopg import DatabaseError
 from rest_framework.decorators import action
 from rest_framework.permissions import AllowAny
@@ -27,7 +31,7 @@ from rest_framework.response import Response
 from rest_framework.viewsets import ViewSet
 
 from bos import utils
-from bos.constants import GroupType, METHOD_POST, METHOD_GET, MESSAGE_KEY
+from bos.constants import GroupType, METHOD_POST, METHOD_GET, MESSAGE_KEY, BULK_CREATE_BATCH_SIZE
 from bos.defaults import DEFAULT_MEASUREMENT_TYPES
 from bos.exceptions import ValidationException
 from bos.pagination import BOSPageNumberPagination
@@ -36,15 +40,19 @@ from bos.permissions import CanChangeCustomUserGroup, DEFAULT_PERMISSIONS_NGO_AD
     CanViewTrainingSession, CanAddTrainingSession, CanViewUserHierarchy, CanChangeUserHierarchy, CanViewMeasurement, \
     DEFAULT_PERMISSIONS_COACH, CanChangeCoach, CanChangeAdmin, PERMISSION_CAN_VIEW_NGO, \
     PERMISSION_CAN_ADD_NGO, PERMISSION_CAN_CHANGE_NGO, PERMISSION_CAN_DESTROY_NGO, CanChangeAthlete
-from bos.utils import ngo_filters_from_request
+from bos.response_cache import cached_response
+from bos.search import autocomplete
+from bos.utils import ngo_filters_from_request, resource_fields_from_request, project_resources
+from bos.versions import conditional_on_collections, conditional_response, COLLECTION_MEASUREMENTS, \
+    COLLECTION_RESOURCES, COLLECTION_NGOS, NGO_FROM_KEY, NGO_FROM_USER
 from measurements.models import generate_measurement_key, Measurement
 from measurements.serializers import MeasurementTypeSerializer, MeasurementSerializer, MeasurementDetailSerializer
 from ngos.models import NGO, NGORegistrationResource
 from ngos.serializers import NGOSerializer, NGORegistrationResourceSerializer, NGORegistrationResourceDetailSerializer
 from resources.models import Resource
-from resources.serializers import ResourceSerializer, ResourceDetailSerializer
-from users.models import User, UserHierarchy
-from users.serializers import UserSerializer, PermissionGroupSerializer, UserHierarchyWriteSerializer
+from resources.serializers import ResourceDetailSerializer, ResourceProjectionSerializer
+from users.models import User, UserHierarchy, UserHierarchyClosure, Tombstone, record_tombstones
+from users.serializers import UserSerializer, PermissionGroupSerializer
 
 
 class NGOViewSet(ViewSet):
@@ -65,6 +73,18 @@ class NGOViewSet(ViewSet):
         serializer = NGOSerializer(result, many=True)
         return paginator.get_paginated_response(serializer.data)
 
+    @action(detail=False, methods=[METHOD_GET])
+    def autocomplete(self, request):
+        if not has_permission(request, PERMISSION_CAN_VIEW_NGO):
+            return Response(status=403)
+
+        query = request.GET.get('q', '').strip()
+        if not query:
+            return Response(data=[])
+        queryset = NGO.objects.filter(is_active=True)
+        ngos = autocomplete(queryset, ['name'], query).values('key', 'name')
+        return Response(data=list(ngos))
+
     def create(self, request):
         if not has_permission(request, PERMISSION_CAN_ADD_NGO):
             return Response(status=403)
@@ -222,45 +242,71 @@ class NGOViewSet(ViewSet):
 
         queryset = Measurement.objects.filter(ngo=ngo, is_active=True)
         serializer = MeasurementSerializer(queryset, many=True)
-        return Response(serializer.data)
+        return conditional_response(request, lambda: Response(serializer.data), [COLLECTION_MEASUREMENTS],
+                                    ngo_id=ngo.id)
 
     @action(detail=True, methods=[METHOD_GET], permission_classes=[CanViewFile])
+    @cached_response([COLLECTION_RESOURCES], ngo_from=NGO_FROM_KEY)
     def files(self, request, pk=None):
         try:
             ngo = NGO.objects.get(key=pk)
         except NGO.DoesNotExist:
             return Response(status=404)
+        if ngo != request.user.ngo:
+            return Response(status=403)
+
+        try:
+            fields = resource_fields_from_request(request.GET)
+        except ValidationException as e:
+            return Response(status=400, data=e.errors)
 
-        queryset = Resource.objects.filter(
-            ngo=ngo, type=Resource.FILE, is_active=True)
-        serializer = ResourceSerializer(queryset, many=True)
+        queryset = project_resources(Resource.objects.filter(
+            ngo=ngo, type=Resource.FILE, is_active=True), fields)
+        serializer = ResourceProjectionSerializer(queryset, many=True, fields=fields)
         return Response(serializer.data)
 
     @action(detail=True, methods=[METHOD_GET], permission_classes=[CanViewCurriculum])
+    @cached_response([COLLECTION_RESOURCES], ngo_from=NGO_FROM_KEY)
     def curricula(self, request, pk=None):
         try:
             ngo = NGO.objects.get(key=pk)
         except NGO.DoesNotExist:
             return Response(status=404)
+        if ngo != request.user.ngo:
+            return Response(status=403)
+
+        try:
+            fields = resource_fields_from_request(request.GET)
+        except ValidationException as e:
+            return Response(status=400, data=e.errors)
 
-        queryset = Resource.objects.filter(
-            ngo=ngo, type=Resource.CURRICULUM, is_active=True)
-        serializer = ResourceSerializer(queryset, many=True)
+        queryset = project_resources(Resource.objects.filter(
+            ngo=ngo, type=Resource.CURRICULUM, is_active=True), fields)
+        serializer = ResourceProjectionSerializer(queryset, many=True, fields=fields)
         return Response(serializer.data)
 
     @action(detail=True, methods=[METHOD_GET], permission_classes=[CanViewTrainingSession])
+    @cached_response([COLLECTION_RESOURCES], ngo_from=NGO_FROM_KEY)
     def training_sessions(self, request, pk=None):
         try:
             ngo = NGO.objects.get(key=pk)
         except NGO.DoesNotExist:
             return Response(status=404)
+        if ngo != request.user.ngo:
+            return Response(status=403)
 
-        queryset = Resource.objects.filter(
-            ngo=ngo, type=Resource.TRAINING_SESSION, is_active=True)
-        serializer = ResourceSerializer(queryset, many=True)
+        try:
+            fields = resource_fields_from_request(request.GET)
+        except ValidationException as e:
+            return Response(status=400, data=e.errors)
+
+        queryset = project_resources(Resource.objects.filter(
+            ngo=ngo, type=Resource.TRAINING_SESSION, is_active=True), fields)
+        serializer = ResourceProjectionSerializer(queryset, many=True, fields=fields)
         return Response(serializer.data)
 
     @action(detail=False, methods=[METHOD_GET], permission_classes=[AllowAny])
+    @conditional_on_collections([COLLECTION_NGOS])
     def active_ngos(self, request, pk=None):
         ngos = NGO.objects.filter(is_active=True)
         serializer = NGOSerializer(ngos, many=True)
@@ -292,7 +338,8 @@ class NGOViewSet(ViewSet):
             ]
 
         }
-        return Response(data=serializer.data.get('resource'))
+        return conditional_response(request, lambda: Response(data=serializer.data.get('resource')),
+                                    [COLLECTION_RESOURCES], ngo_id=ngo.id)
 
     @action(detail=True, methods=[METHOD_POST], permission_classes=[CanAddTrainingSession])
     def mark_as_coach_registration_resource(self, request, pk=None):
@@ -426,39 +473,10 @@ class NGOViewSet(ViewSet):
         except NGO.DoesNotExist:
             return Response(status=404)
 
-        response_data = []
-        active_users = User.objects.filter(ngo=ngo, is_active=True)
-        ghost_node = {}
-        ghost_node['key'] = "ghost_node"
-        ghost_node['parent_node'] = None
-        ghost_node['label'] = "Organisation"
-        ghost_node_children = []
-        for active_user in active_users:
-            user = {}
-            user['key'] = active_user.key
-            user['role'] = active_user.role
-            user['label'] = active_user.full_name
-            parent_user_user_hierarchy = UserHierarchy.objects.filter(parent_user__is_active=True,
-                                                                      child_user=active_user).first()
-            if parent_user_user_hierarchy:
-                user['parent_node'] = parent_user_user_hierarchy.parent_user.key
-            else:
-                user['parent_node'] = None
-            child_user_user_hierarchies = UserHierarchy.objects.filter(child_user__is_active=True,
-                                                                       parent_user=active_user)
-            child_user_keys = []
-            for child_user_user_hierarchy in child_user_user_hierarchies:
-                child_user_keys.append(child_user_user_hierarchy.child_user.key)
-            user['children'] = child_user_keys
-            response_data.append(user)
-
-            if user['parent_node'] is None and len(user['children']) != 0:
-                ghost_node_children.append(active_user.key)
-
-        ghost_node['children'] = ghost_node_children
-        response_data.append(ghost_node)
-
-        return Response(response_data)
+        nodes = user_hierarchy_nodes(ngo)
+        if request.GET.get('stream', 'false').lower() == 'true':
+            return StreamingHttpResponse(utils.stream_json_list(nodes), content_type='application/json')
+        return Response(list(nodes))
 
     @action(detail=True, methods=[METHOD_POST], permission_classes=[CanChangeUserHierarchy])
     def save_user_hierarchy(self, request, pk=None):
@@ -468,15 +486,10 @@ class NGOViewSet(ViewSet):
             return Response(status=404)
 
         try:
+            hierarchy_data = request.data.copy()
+            user_hierarchy_edges = parent_to_child(hierarchy_data)
             with transaction.atomic():
-                # clean all UserHierarchy objects for ngo
-                ngo_filter = Q(parent_user__ngo=ngo) | Q(child_user__ngo=ngo)
-                UserHierarchy.objects.filter(ngo_filter).delete()
-
-                # TODO Check for cycle in binary tree.
-                hierarchy_data = request.data.copy()
-                for node in hierarchy_data:
-                    parent_to_child(node)
+                save_user_hierarchy_edges(ngo, user_hierarchy_edges)
 
         except ValidationException as e:
             return Response(e.errors, status=400)
@@ -494,6 +507,7 @@ class NGOViewSet(ViewSet):
         return Response(data=serializer.data)
 
     @action(detail=True, methods=[METHOD_GET], permission_classes=[CanViewMeasurement])
+    @conditional_on_collections([COLLECTION_MEASUREMENTS], ngo_from=NGO_FROM_USER)
     def all_measurements(self, request, pk=None):
         queryset = Measurement.objects.filter(ngo=request.user.ngo)
         serializer = MeasurementDetailSerializer(queryset, read_only=True, many=True)
@@ -502,37 +516,129 @@ class NGOViewSet(ViewSet):
     @action(detail=True, methods=[METHOD_GET], permission_classes=[CanChangeAthlete,
                                                                    CanChangeAdmin,
                                                                    CanChangeCoach])
+    @conditional_on_collections([COLLECTION_RESOURCES], ngo_from=NGO_FROM_USER)
     def all_resources(self, request, pk=None):
         queryset = Resource.objects.filter(ngo=request.user.ngo)
         serializer = ResourceDetailSerializer(queryset, read_only=True, many=True)
         return Response(data=serializer.data)
 
 
+def user_hierarchy_nodes(ngo):
+    # Load every active edge of the ngo at once and assemble the tree in memory
+    user_hierarchies = UserHierarchy.objects.filter(Q(parent_user__ngo=ngo) | Q(child_user__ngo=ngo),
+                                                    parent_user__is_active=True,
+                                                    child_user__is_active=True) \
+        .order_by('id').values_list('parent_user__key', 'child_user__key')
+    parent_keys = {}
+    children_keys = defaultdict(list)
+    for parent_key, child_key in user_hierarchies:
+        parent_keys.setdefault(child_key, parent_key)
+        children_keys[parent_key].append(child_key)
+
+    active_users = User.objects.filter(ngo=ngo, is_active=True) \
+        .only('key', 'role', 'first_name', 'middle_name', 'last_name')
+    ghost_node_children = []
+    for active_user in active_users.iterator():
+        user = {}
+        user['key'] = active_user.key
+        user['role'] = active_user.role
+        user['label'] = active_user.full_name
+        user['parent_node'] = parent_keys.get(active_user.key, None)
+        user['children'] = children_keys.get(active_user.key, [])
+        yield user
+
+        if user['parent_node'] is None and len(user['children']) != 0:
+            ghost_node_children.append(active_user.key)
+
+    ghost_node = {}
+    ghost_node['key'] = "ghost_node"
+    ghost_node['parent_node'] = None
+    ghost_node['label'] = "Organisation"
+    ghost_node['children'] = ghost_node_children
+    yield ghost_node
+
+
 def parent_to_child(hierarchy_data):
-    parent_key = hierarchy_data.get('key', None)
-    children = hierarchy_data.get('children', [])
-    children_keys = []
-    for child in children:
-        child_key = child.get('key', None)
-        if not child_key:
-            # print("Child key is None")
-            raise ValidationException()
-
-        children_keys.append(child_key)
-
-    if parent_key == 'ghost_node':
-        parent_key = None
-
-        # Write to user hierarchy
-    for child_key in children_keys:
-        create_data = {'parent_user': parent_key, 'child_user': child_key}
-        serializer = UserHierarchyWriteSerializer(data=create_data)
-        if not serializer.is_valid():
-            raise ValidationException(serializer.errors)
-        serializer.save()
-
-    for child in children:
-        parent_to_child(child)
+    # Flatten the posted tree into (parent_key, child_key) edges without touching the database
+    parent_keys = {}
+    nodes = list(hierarchy_data)
+    while nodes:
+        node = nodes.pop()
+        parent_key = node.get('key', None)
+        if not parent_key:
+            raise ValidationException({MESSAGE_KEY: _('User key is missing')})
+        if parent_key == 'ghost_node':
+            parent_key = None
+
+        for child in node.get('children', []):
+            child_key = child.get('key', None)
+            if not child_key or child_key == 'ghost_node':
+                raise ValidationException({MESSAGE_KEY: _('User key is missing')})
+            if child_key in parent_keys:
+                raise ValidationException({MESSAGE_KEY: _('User %s has more than one parent') % child_key})
+            parent_keys[child_key] = parent_key
+            nodes.append(child)
+
+    acyclic_keys = set()
+    for user_key in parent_keys:
+        path = set()
+        while user_key is not None and user_key not in acyclic_keys:
+            if user_key in path:
+                raise ValidationException({MESSAGE_KEY: _('Cycle in user hierarchy at user %s') % user_key})
+            path.add(user_key)
+            user_key = parent_keys.get(user_key, None)
+        acyclic_keys.update(path)
+
+    return [(parent_key, child_key) for child_key, parent_key in parent_keys.items()]
+
+
+def save_user_hierarchy_edges(ngo, user_hierarchy_edges):
+    user_keys = set()
+    for parent_key, child_key in user_hierarchy_edges:
+        if parent_key is not None:
+            user_keys.add(parent_key)
+        user_keys.add(child_key)
+    # Users of other ngos are reported like missing ones
+    user_ids = dict(User.objects.filter(key__in=user_keys, ngo=ngo).values_list('key', 'id'))
+    for user_key in user_keys:
+        if user_key not in user_ids:
+            raise ValidationException({MESSAGE_KEY: _('User %s does not exist') % user_key})
+
+    new_edges = set()
+    for parent_key, child_key in user_hierarchy_edges:
+        new_edges.add((user_ids[parent_key] if parent_key is not None else None, user_ids[child_key]))
+
+    # Apply only the difference against the edges already stored for the ngo
+    ngo_filter = Q(parent_user__ngo=ngo) | Q(child_user__ngo=ngo)
+    existing_edges = set()
+    stale_user_hierarchy_ids = []
+    stale_child_user_ids = set()
+    for user_hierarchy_id, parent_user_id, child_user_id in UserHierarchy.objects.filter(ngo_filter) \
+            .values_list('id', 'parent_user_id', 'child_user_id'):
+        edge = (parent_user_id, child_user_id)
+        if edge in new_edges and edge not in existing_edges:
+            existing_edges.add(edge)
+        else:
+            stale_user_hierarchy_ids.append(user_hierarchy_id)
+            stale_child_user_ids.add(child_user_id)
+
+    user_hierarchies = [UserHierarchy(parent_user_id=parent_user_id, child_user_id=child_user_id)
+                        for parent_user_id, child_user_id in new_edges - existing_edges]
+    if not stale_user_hierarchy_ids and not user_hierarchies:
+        return
+
+    # Children of removed edges and everyone under them may drop out of a synced hierarchy
+    stale_descendant_ids = UserHierarchyClosure.objects.filter(ancestor_id__in=stale_child_user_ids) \
+        .values_list('descendant_id', flat=True)
+    stale_user_keys = User.objects.filter(Q(id__in=stale_child_user_ids) | Q(id__in=stale_descendant_ids)) \
+        .values_list('key', flat=True)
+    record_tombstones(Tombstone.HIERARCHY, ngo.id, stale_user_keys)
+    record_tombstones(Tombstone.ATHLETES, ngo.id, stale_user_keys)
+    UserHierarchy.objects.filter(id__in=stale_user_hierarchy_ids).delete()
+    UserHierarchy.objects.bulk_create(user_hierarchies, batch_size=BULK_CREATE_BATCH_SIZE)
+    # Only the subtrees of children whose parent edges changed get new closure rows
+    moved_user_ids = stale_child_user_ids | {user_hierarchy.child_user_id for user_hierarchy in user_hierarchies}
+    utils.update_user_hierarchy_closure(moved_user_ids)
 
 
 class PingViewSet(ViewSet):
@@ -15,6 +15,7 @@
 #
 
 from django.contrib.postgres.fields import JSONField
+from django.contrib.postgres.indexes import GinIndex
 from django.db import models
 from django.utils.crypto import get_random_string
 from bos.constants import PUBLIC_KEY_LENGTH_RESOURCE, LENGTH_LABEL, LENGTH_DESCRIPTION, \
@@ -57,11 +58,16 @@ class Resource(models.Model):
     is_active = models.BooleanField(default=True, blank=True)
     is_shared = models.BooleanField(default=True, blank=True)
     ngo = models.ForeignKey('ngos.NGO', null=False, blank=False, on_delete=models.PROTECT)
+    version = models.PositiveIntegerField(default=1)
     creation_time = models.DateTimeField(auto_now=False, auto_now_add=True)
     last_modification_time = models.DateTimeField(auto_now=True)
 
     class Meta:
         db_table = 'resources'
+        indexes = [
+            models.Index(fields=['ngo', 'type', 'is_active'], name='resources_ngo_type_active_idx'),
+            GinIndex(fields=['label'], name='resources_label_trgm_idx', opclasses=['gin_trgm_ops']),
+        ]
         permissions = (
             PERMISSION_CAN_ADD_TRAINING_SESSION[0:2],
             PERMISSION_CAN_CHANGE_TRAINING_SESSION[0:2],
@@ -108,6 +114,7 @@ class EvaluationResource(models.Model):
                                         related_name="evaluated_user_group")
     ngo = models.ForeignKey('ngos.NGO', null=False, blank=False, on_delete=models.PROTECT)
     is_evaluated = models.BooleanField(default=False, blank=False)
+    version = models.PositiveIntegerField(default=1)
     creation_time = models.DateTimeField(auto_now=False, auto_now_add=True)
     last_modification_time = models.DateTimeField(auto_now=True)
 
@@ -29,6 +29,7 @@ class ResourceSerializer(ModelSerializer):
     class Meta:
         model = Resource
         exclude = ('id',)
+        read_only_fields = ('version',)
 
 
 class ResourceDetailSerializer(ModelSerializer):
@@ -39,6 +40,20 @@ class ResourceDetailSerializer(ModelSerializer):
     class Meta:
         model = Resource
         exclude = ('id',)
+        read_only_fields = ('version',)
+
+
+class ResourceProjectionSerializer(ResourceDetailSerializer):
+    """
+    Read only resource limited to the given fields, as returned by
+    resource_fields_from_request.
+    """
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for field_name in set(self.fields) - set(fields):
+                self.fields.pop(field_name)
 
 
 class EvaluationResourceDetailSerializer(ModelSerializer):
@@ -51,6 +66,7 @@ class EvaluationResourceDetailSerializer(ModelSerializer):
     class Meta:
         model = EvaluationResource
         exclude = ('id',)
+        read_only_fields = ('version',)
 
 
 class EvaluationResourceUserWriteOnlySerializer(ModelSerializer):
@@ -63,6 +79,7 @@ class EvaluationResourceUserWriteOnlySerializer(ModelSerializer):
     class Meta:
         model = EvaluationResource
         exclude = ('id',)
+        read_only_fields = ('version',)
 
 
 class EvaluationResourceGroupWriteOnlySerializer(ModelSerializer):
@@ -75,3 +92,4 @@ class EvaluationResourceGroupWriteOnlySerializer(ModelSerializer):
     class Meta:
         model = EvaluationResource
         exclude = ('id',)
+        read_only_fields = ('version',)
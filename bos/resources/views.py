@@ -13,36 +13,58 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import hashlib
 import json
 import os
 import pathlib
+import uuid
 
 from django.db import transaction
 from django.db.models.deletion import ProtectedError
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.http import quote_etag
+from django.utils.translation import gettext as _
 # Create your views here.
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from rest_framework.viewsets import ViewSet
 
-from bos.constants import METHOD_POST
+from bos.constants import METHOD_POST, METHOD_GET, MESSAGE_KEY, LENGTH_IDEMPOTENCY_KEY, BULK_READINGS_MAX_COUNT, \
+    BULK_CREATE_BATCH_SIZE
 from bos.exceptions import ValidationException, SingleMessageValidationException
+from bos.json_patch import JSONPatchParser, MergePatchParser, JSONPatchConflict, JSONPatchFailed, if_match_version, \
+    patch_steps_from_request, apply_json_patch
 from bos.pagination import BOSPageNumberPagination
 from bos.permissions import has_permission, PERMISSION_CAN_VIEW_RESOURCE, PERMISSION_CAN_ADD_FILE, \
     PERMISSION_CAN_ADD_CURRICULUM, PERMISSION_CAN_ADD_TRAINING_SESSION, PERMISSION_CAN_CHANGE_FILE, \
     PERMISSION_CAN_CHANGE_CURRICULUM, PERMISSION_CAN_CHANGE_TRAINING_SESSION, PERMISSION_CAN_DESTROY_RESOURCE, \
     PERMISSION_CAN_ADD_REGISTRATION_FORM, PERMISSION_CAN_CHANGE_REGISTRATION_FORM, PERMISSION_CAN_ADD_READING
+from bos.search import autocomplete
 from bos.storage_backends import S3Storage
 from bos.utils import resource_filters_from_request, error_403_json, error_400_json, request_user_belongs_to_resource, \
-    is_extension_valid, error_file_extension_json, error_500_json, error_protected_resource
+    is_extension_valid, error_file_extension_json, error_500_json, error_protected_resource, \
+    resource_fields_from_request, project_resources, build_user_readings
+from bos.versions import bump_collection_version, COLLECTION_RESOURCES
 from resources.models import Resource, EvaluationResource
 from resources.serializers import ResourceSerializer, EvaluationResourceDetailSerializer, \
-    EvaluationResourceUserWriteOnlySerializer, \
+    EvaluationResourceUserWriteOnlySerializer, ResourceProjectionSerializer, \
     EvaluationResourceGroupWriteOnlySerializer
-from users.models import User, UserGroup
+from users.models import User, UserGroup, UserReading, IdempotencyKey
+from users.serializers import UserReadingBulkWriteOnlySerializer
+
+RESOURCE_CHANGE_PERMISSIONS = {
+    Resource.FILE: PERMISSION_CAN_CHANGE_FILE,
+    Resource.CURRICULUM: PERMISSION_CAN_CHANGE_CURRICULUM,
+    Resource.TRAINING_SESSION: PERMISSION_CAN_CHANGE_TRAINING_SESSION,
+    Resource.REGISTRATION_FORM: PERMISSION_CAN_CHANGE_REGISTRATION_FORM,
+}
+PATCH_PARSER_CLASSES = list(api_settings.DEFAULT_PARSER_CLASSES) + [JSONPatchParser, MergePatchParser]
 
 
 class ResourceViewSet(ViewSet):
+    parser_classes = PATCH_PARSER_CLASSES
 
     def list(self, request):
         if not has_permission(request, PERMISSION_CAN_VIEW_RESOURCE):
@@ -54,15 +76,31 @@ class ResourceViewSet(ViewSet):
             'ngo': request.user.ngo,
         }
         filters = {**common_filters, **resource_filters}
+        try:
+            fields = resource_fields_from_request(request.GET)
+        except ValidationException as e:
+            return Response(status=400, data=e.errors)
 
-        queryset = Resource.objects.filter(search_filters, **filters)
+        queryset = project_resources(Resource.objects.filter(search_filters, **filters), fields)
         if ordering:
             queryset = queryset.order_by(ordering)
         paginator = BOSPageNumberPagination()
         result = paginator.paginate_queryset(queryset, request)
-        serializer = ResourceSerializer(result, many=True)
+        serializer = ResourceProjectionSerializer(result, many=True, fields=fields)
         return paginator.get_paginated_response(serializer.data)
 
+    @action(detail=False, methods=[METHOD_GET])
+    def autocomplete(self, request):
+        if not has_permission(request, PERMISSION_CAN_VIEW_RESOURCE):
+            return Response(status=403, data=error_403_json())
+
+        query = request.GET.get('q', '').strip()
+        if not query:
+            return Response(data=[])
+        queryset = Resource.objects.filter(ngo=request.user.ngo, is_active=True)
+        resources = autocomplete(queryset, ['label'], query).values('key', 'label', 'type')
+        return Response(data=list(resources))
+
     def create(self, request):
 
         resource_type = request.data.get('type', None)
@@ -136,7 +174,9 @@ class ResourceViewSet(ViewSet):
         queryset = Resource.objects.all()
         item = get_object_or_404(queryset, key=pk)
         serializer = ResourceSerializer(item)
-        return Response(serializer.data)
+        response = Response(serializer.data)
+        response['ETag'] = quote_etag(str(item.version))
+        return response
 
     def update(self, request, pk=None):
         resource_type = request.data.get('type', None)
@@ -153,27 +193,51 @@ class ResourceViewSet(ViewSet):
                                                                               PERMISSION_CAN_CHANGE_REGISTRATION_FORM):
             return Response(status=403, data=error_403_json())
 
-        try:
-            resource = Resource.objects.get(key=pk)
-        except Resource.DoesNotExist:
-            return Response(status=404)
-
-        if not request_user_belongs_to_resource(request, resource):
-            return Response(status=403, data=error_403_json())
-
         update_data = request.data.copy()
         update_data['ngo'] = request.user.ngo.key
         resource_data = request.data.get('data', None)
         if type(resource_data) == list:
             return Response(status=400, data=error_400_json())
 
-        if resource.type == Resource.FILE:
-            update_data['data'] = json.dumps(resource.data)
-        serializer = ResourceSerializer(resource, data=update_data)
-        if serializer.is_valid():
-            serializer.save()
-            return Response(serializer.data)
-        return Response(serializer.errors, status=400)
+        with transaction.atomic():
+            try:
+                resource = Resource.objects.select_for_update().get(key=pk)
+            except Resource.DoesNotExist:
+                return Response(status=404)
+
+            if not request_user_belongs_to_resource(request, resource):
+                return Response(status=403, data=error_403_json())
+            version = if_match_version(request)
+            if version is not None and version != resource.version:
+                return Response(status=412, data={MESSAGE_KEY: _('Resource was changed since it was read')})
+
+            if resource.type == Resource.FILE:
+                update_data['data'] = json.dumps(resource.data)
+            serializer = ResourceSerializer(resource, data=update_data)
+            if serializer.is_valid():
+                serializer.save(version=resource.version + 1)
+                response = Response(serializer.data)
+                response['ETag'] = quote_etag(str(resource.version))
+                return response
+            return Response(serializer.errors, status=400)
+
+    def partial_update(self, request, pk=None):
+        """
+        Applies a JSON patch or a merge patch to the data of the resource, made against
+        the version given in the If-Match header.
+        """
+        try:
+            resource = Resource.objects.only('id', 'key', 'type', 'ngo_id').get(key=pk)
+        except Resource.DoesNotExist:
+            return Response(status=404)
+
+        permission = RESOURCE_CHANGE_PERMISSIONS.get(resource.type, None)
+        if not permission or not has_permission(request, permission) or resource.ngo_id != request.user.ngo_id:
+            return Response(status=403, data=error_403_json())
+        response = patch_resource_data(request, Resource, resource)
+        if response.status_code == 200:
+            bump_collection_version(COLLECTION_RESOURCES, resource.ngo_id)
+        return response
 
     def destroy(self, request, pk=None):
         if not has_permission(request, PERMISSION_CAN_DESTROY_RESOURCE):
@@ -247,6 +311,7 @@ class ResourceViewSet(ViewSet):
 
 
 class EvaluationResourceViewSet(ViewSet):
+    parser_classes = PATCH_PARSER_CLASSES
 
     def create(self, request):
         if not has_permission(request, PERMISSION_CAN_ADD_READING):
@@ -308,9 +373,195 @@ class EvaluationResourceViewSet(ViewSet):
             return Response(status=400, data=error_400_json())
 
         resource_data = json.loads(resource_data)
-        evaluation_resource.data = resource_data
-        evaluation_resource.is_evaluated = is_evaluated
-        evaluation_resource.save()
+        with transaction.atomic():
+            evaluation_resource = EvaluationResource.objects.select_for_update().get(id=evaluation_resource.id)
+            version = if_match_version(request)
+            if version is not None and version != evaluation_resource.version:
+                return Response(status=412, data={MESSAGE_KEY: _('Evaluation resource was changed since it was read')})
+            evaluation_resource.data = resource_data
+            evaluation_resource.is_evaluated = is_evaluated
+            evaluation_resource.version += 1
+            evaluation_resource.save()
 
         serializer = EvaluationResourceDetailSerializer(evaluation_resource)
-        return Response(serializer.data)
+        response = Response(serializer.data)
+        response['ETag'] = quote_etag(str(evaluation_resource.version))
+        return response
+
+    def partial_update(self, request, pk=None):
+        if not has_permission(request, PERMISSION_CAN_ADD_READING):
+            return Response(status=403, data=error_403_json())
+
+        try:
+            evaluation_resource = EvaluationResource.objects.only('id', 'key', 'ngo_id').get(key=pk)
+        except EvaluationResource.DoesNotExist:
+            return Response(status=404)
+
+        if evaluation_resource.ngo_id != request.user.ngo_id:
+            return Response(status=403, data=error_403_json())
+        return patch_resource_data(request, EvaluationResource, evaluation_resource)
+
+    @action(detail=False, methods=[METHOD_POST])
+    def upload(self, request):
+        """
+        Upserts a session recorded offline, its evaluation resource and readings, in one
+        transaction. Retries with the same Idempotency-Key get the stored response back.
+        """
+        if not has_permission(request, PERMISSION_CAN_ADD_READING):
+            return Response(status=403, data=error_403_json())
+
+        if type(request.data) == list:
+            return Response(status=400, data=error_400_json())
+        idempotency_key = request.META.get('HTTP_IDEMPOTENCY_KEY', None) or request.data.get('idempotency_key', None)
+        if not idempotency_key or len(idempotency_key) > LENGTH_IDEMPOTENCY_KEY:
+            return Response(status=400, data=error_400_json())
+        request_hash = hashlib.sha256(json.dumps(request.data, sort_keys=True, default=str).encode()).hexdigest()
+
+        try:
+            with transaction.atomic():
+                # A concurrent retry waits on the insert of the first one, then reads its response
+                idempotency, created = IdempotencyKey.objects.get_or_create(
+                    user=request.user, key=idempotency_key, defaults={'request_hash': request_hash})
+                if not created:
+                    if idempotency.request_hash != request_hash:
+                        raise ValidationException({MESSAGE_KEY: _('Idempotency key was used for another upload')})
+                    return Response(status=idempotency.response_status, data=idempotency.response_data)
+
+                status, response_data = upload_evaluation_session(request.user, request.data)
+                idempotency.response_status = status
+                idempotency.response_data = response_data
+                idempotency.save()
+            return Response(status=status, data=response_data)
+
+        except ValidationException as e:
+            return Response(status=400, data=e.errors)
+
+
+def patch_resource_data(request, model, instance):
+    version = if_match_version(request)
+    if version is None:
+        return Response(status=428, data={MESSAGE_KEY: _('If-Match header with the version is required')})
+
+    try:
+        steps = patch_steps_from_request(request)
+        with transaction.atomic():
+            version = apply_json_patch(model, instance.id, version, steps)
+    except ValidationException as e:
+        return Response(status=400, data=e.errors)
+    except JSONPatchConflict:
+        return Response(status=412, data={MESSAGE_KEY: _('Resource was changed since it was read')})
+    except JSONPatchFailed:
+        return Response(status=409, data={MESSAGE_KEY: _('Patch could not be applied to the resource')})
+
+    response = Response({'key': instance.key, 'version': version})
+    response['ETag'] = quote_etag(str(version))
+    return response
+
+
+UPLOADED_READING_FIELDS = ('training_session_uuid', 'value', 'numeric_value', 'boolean_value', 'text_value',
+                           'is_active')
+
+
+def evaluation_resource_upload_serializer(user, evaluation_resource_data, evaluation_resource):
+    evaluation_resource_data = dict(evaluation_resource_data)
+    evaluation_resource_data['ngo'] = user.ngo.key
+    evaluation_resource_data['user'] = user.key
+    if isinstance(evaluation_resource_data.get('data', None), str):
+        try:
+            evaluation_resource_data['data'] = json.loads(evaluation_resource_data['data'])
+        except ValueError:
+            raise ValidationException({'data': [_('Invalid JSON')]})
+
+    evaluation_resource_type = evaluation_resource_data.get('type', None)
+    if evaluation_resource_type == EvaluationResource.USER:
+        if not User.objects.filter(key=evaluation_resource_data.get('evaluated_user', None), ngo=user.ngo).exists():
+            raise ValidationException({'evaluated_user': [_('User does not belong to the ngo')]})
+        return EvaluationResourceUserWriteOnlySerializer(evaluation_resource, data=evaluation_resource_data)
+    if evaluation_resource_type == EvaluationResource.GROUP:
+        if not UserGroup.objects.filter(key=evaluation_resource_data.get('evaluated_group', None),
+                                        ngo=user.ngo).exists():
+            raise ValidationException({'evaluated_group': [_('Group does not belong to the ngo')]})
+        return EvaluationResourceGroupWriteOnlySerializer(evaluation_resource, data=evaluation_resource_data)
+    raise ValidationException({'type': [_('Invalid type')]})
+
+
+def upload_evaluation_session(user, upload_data):
+    """
+    Creates or updates the evaluation resource of the user with the uploaded uuid and
+    its readings, matched on athlete, measurement and recorded_at. Returns the status
+    and data of the response, any invalid part raises a ValidationException.
+    """
+    evaluation_resource_data = upload_data.get('evaluation_resource', None)
+    readings_data = upload_data.get('readings', [])
+    if type(evaluation_resource_data) != dict or type(readings_data) != list or \
+            len(readings_data) > BULK_READINGS_MAX_COUNT:
+        raise ValidationException(error_400_json())
+    try:
+        evaluation_resource_uuid = uuid.UUID(str(evaluation_resource_data.get('uuid', None)))
+    except ValueError:
+        raise ValidationException({'uuid': [_('Invalid uuid')]})
+
+    # Uploads of a user are applied one after the other, so a session is never created twice
+    list(User.objects.select_for_update().filter(id=user.id).values_list('id'))
+    evaluation_resource = EvaluationResource.objects.filter(uuid=evaluation_resource_uuid, user=user,
+                                                            ngo=user.ngo).first()
+    serializer = evaluation_resource_upload_serializer(user, evaluation_resource_data, evaluation_resource)
+    if not serializer.is_valid():
+        raise ValidationException(serializer.errors)
+    if evaluation_resource is None:
+        status = 201
+        evaluation_resource = serializer.save()
+    else:
+        status = 200
+        evaluation_resource = serializer.save(version=evaluation_resource.version + 1)
+
+    results = []
+    user_readings = []
+    for index, user_reading_data in enumerate(readings_data):
+        if type(user_reading_data) != dict:
+            raise ValidationException(error_400_json())
+        user_reading_data = {**user_reading_data, 'ngo': user.ngo.key,
+                             'evaluation_resource_uuid': evaluation_resource_uuid}
+        reading_serializer = UserReadingBulkWriteOnlySerializer(data=user_reading_data)
+        results.append({'index': index, 'status': 201})
+        if reading_serializer.is_valid():
+            user_readings.append((index, reading_serializer.validated_data))
+        else:
+            results[index].update({'status': 400, 'errors': reading_serializer.errors})
+    user_readings = build_user_readings(user, user_readings, results)
+    if len(user_readings) != len(results):
+        raise ValidationException({'readings': [result for result in results if result['status'] == 400]})
+
+    stored_user_readings = {(user_reading.user_id, user_reading.measurement_id, user_reading.recorded_at): user_reading
+                            for user_reading in UserReading.objects.filter(
+                                ngo=user.ngo, evaluation_resource_uuid=evaluation_resource_uuid)}
+    user_readings_to_create = []
+    user_readings_to_update = {}
+    for index, user_reading in user_readings:
+        identity = (user_reading.user_id, user_reading.measurement_id, user_reading.recorded_at)
+        stored_user_reading = stored_user_readings.get(identity, None)
+        if stored_user_reading is None:
+            stored_user_readings[identity] = user_reading
+            user_readings_to_create.append(user_reading)
+        else:
+            for field in UPLOADED_READING_FIELDS:
+                setattr(stored_user_reading, field, getattr(user_reading, field))
+            if stored_user_reading.id is not None:
+                results[index]['status'] = 200
+                user_readings_to_update[stored_user_reading.id] = stored_user_reading
+            user_reading = stored_user_reading
+        results[index]['user_reading'] = user_reading
+
+    UserReading.objects.bulk_create(user_readings_to_create, batch_size=BULK_CREATE_BATCH_SIZE)
+    # bulk_update skips auto_now
+    now = timezone.now()
+    for user_reading in user_readings_to_update.values():
+        user_reading.last_modification_time = now
+    UserReading.objects.bulk_update(user_readings_to_update.values(),
+                                    UPLOADED_READING_FIELDS + ('last_modification_time',),
+                                    batch_size=BULK_CREATE_BATCH_SIZE)
+
+    for result in results:
+        result['key'] = result.pop('user_reading').key
+    return status, {'evaluation_resource': EvaluationResourceDetailSerializer(evaluation_resource).data,
+                    'readings': results}
@@ -0,0 +1,239 @@
+#  Copyright (c) 2019 Maverick Labs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as,
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import json
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+from django.contrib.auth.models import Permission
+from django.core.management import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from bos.permissions import DEFAULT_PERMISSIONS_NGO_ADMIN, DEFAULT_PERMISSIONS_COACH
+from measurements.models import Measurement
+from ngos.models import NGO
+from resources.models import EvaluationResource, Resource
+from users.models import User, MobileAuthToken, UserHierarchyClosure, UserReading, Tombstone
+
+PERCENTILES = (50, 95, 99)
+
+
+def _percentile(durations, percentile):
+    # Nearest rank on sorted durations
+    index = max(0, int(round(percentile / 100.0 * len(durations))) - 1)
+    return durations[min(index, len(durations) - 1)]
+
+
+def _create_benchmark_user(ngo, role, password, permissions):
+    user = User.objects.create(username='benchmark_%s_%s' % (role, uuid.uuid4().hex[:8]), first_name='Benchmark',
+                               last_name=role.capitalize(), ngo=ngo, role=role, gender=User.MALE)
+    user.set_password(password)
+    user.save()
+    # Permissions are given to the user directly, the groups of the ngo stay untouched
+    user.user_permissions.add(*Permission.objects.filter(codename__in=[code_name for code_name, _, _ in permissions]))
+    return user
+
+
+def _prepare_users(ngo, password):
+    """
+    Creates a benchmark admin and coach with the password and default permissions,
+    and picks a coach with athletes and one of them, as created by generate_load_data,
+    whose data the requests read and write. The existing users are left unchanged.
+    """
+    closure = UserHierarchyClosure.objects.filter(ancestor__ngo=ngo, ancestor__role=User.COACH, depth=1,
+                                                  descendant__role=User.ATHLETE).order_by('id').first()
+    if closure is None:
+        raise CommandError("Ngo %s needs a coach with athletes" % ngo.key)
+
+    admin = _create_benchmark_user(ngo, User.ADMIN, password, DEFAULT_PERMISSIONS_NGO_ADMIN)
+    coach = _create_benchmark_user(ngo, User.COACH, password, DEFAULT_PERMISSIONS_COACH)
+    return admin, coach, closure.ancestor, closure.descendant
+
+
+def _delete_with_tombstones(queryset, collection):
+    keys = list(queryset.values_list('key', flat=True))
+    queryset.delete()
+    Tombstone.objects.filter(collection=collection, object_key__in=keys).delete()
+
+
+def _scenarios(ngo, admin, coach, data_coach, athlete, password):
+    """
+    Returns (name, client, method, path, payload factory, cleanup) of every benchmarked
+    endpoint. Admin endpoints use a session, coach endpoints the mobile token. cleanup
+    deletes the rows created by a write scenario.
+    """
+    admin_client = Client()
+    if not admin_client.login(username=admin.username, password=password):
+        raise CommandError("Could not log in as " + admin.username)
+    token = MobileAuthToken.objects.create(user=coach, expiry_date=datetime.now(tz=timezone.utc) + timedelta(days=1))
+    coach_client = Client(HTTP_AUTHORIZATION='Token ' + token.token)
+    anonymous_client = Client()
+    measurement = Measurement.objects.filter(ngo=ngo, is_active=True, input_type=Measurement.NUMERIC) \
+        .order_by('id').first()
+    if measurement is None:
+        raise CommandError("Ngo %s needs a numeric measurement" % ngo.key)
+
+    def login_data():
+        return {'username': admin.username, 'password': password}
+
+    # Uuids of the rows created by write scenarios
+    training_session_uuids = []
+    evaluation_resource_uuids = []
+
+    def reading_data():
+        training_session_uuids.append(str(uuid.uuid4()))
+        return {'user': athlete.key, 'ngo': ngo.key, 'measurement': measurement.key, 'value': '42.5',
+                'recorded_at': datetime.now(tz=timezone.utc).isoformat(),
+                'training_session_uuid': training_session_uuids[-1]}
+
+    def delete_readings():
+        _delete_with_tombstones(UserReading.objects.filter(training_session_uuid__in=training_session_uuids),
+                                Tombstone.READINGS)
+
+    def evaluation_resource_data():
+        evaluation_resource_uuids.append(str(uuid.uuid4()))
+        return {'uuid': evaluation_resource_uuids[-1], 'label': 'Benchmark session', 'type': EvaluationResource.USER,
+                'resource_type': Resource.TRAINING_SESSION, 'evaluated_user': athlete.key,
+                'data': json.dumps({'label': 'Benchmark session', 'children': []})}
+
+    def delete_evaluation_resources():
+        _delete_with_tombstones(EvaluationResource.objects.filter(uuid__in=evaluation_resource_uuids),
+                                Tombstone.EVALUATION_RESOURCES)
+
+    return [
+        ('login', anonymous_client, 'post', '/login', login_data, None),
+        ('mobile_token_auth', coach_client, 'get', '/ping/', None, None),
+        ('athlete_list', admin_client, 'get', '/athletes/?page=1&page_size=25', None, None),
+        ('reading_create', coach_client, 'post', '/readings/', reading_data, delete_readings),
+        ('reading_list', admin_client, 'get', '/readings/?page=1&page_size=25', None, None),
+        ('user_hierarchy', admin_client, 'get', '/ngos/%s/user_hierarchy/' % ngo.key, None, None),
+        ('user_resources', coach_client, 'get', '/users/%s/resources/' % data_coach.key, None, None),
+        ('evaluation_resource_create', coach_client, 'post', '/evaluation_resources/', evaluation_resource_data,
+         delete_evaluation_resources),
+    ]
+
+
+def _request(client, method, path, payload):
+    if payload is None:
+        return getattr(client, method)(path)
+    return getattr(client, method)(path, data=json.dumps(payload()), content_type='application/json')
+
+
+def _run_scenario(client, method, path, payload, iterations, warmup):
+    for _ in range(warmup):
+        _request(client, method, path, payload)
+
+    durations = []
+    query_counts = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        with CaptureQueriesContext(connection) as queries:
+            request_start = time.perf_counter()
+            response = _request(client, method, path, payload)
+            durations.append(time.perf_counter() - request_start)
+        if response.status_code >= 400:
+            raise CommandError("%s %s answered %d" % (method.upper(), path, response.status_code))
+        query_counts.append(len(queries))
+    total_time = time.perf_counter() - start
+
+    durations.sort()
+    query_counts.sort()
+    result = {'p%d_ms' % percentile: round(_percentile(durations, percentile) * 1000, 3)
+              for percentile in PERCENTILES}
+    result['throughput_rps'] = round(iterations / total_time, 1)
+    result['queries'] = query_counts[len(query_counts) // 2]
+    return result
+
+
+def _regressions(results, baseline, latency_threshold, query_threshold):
+    regressions = []
+    for name, result in results.items():
+        expected = baseline.get(name, None)
+        if expected is None:
+            continue
+        if result['p95_ms'] > expected['p95_ms'] * (1 + latency_threshold):
+            regressions.append('%s p95 %.1fms, baseline %.1fms' % (name, result['p95_ms'], expected['p95_ms']))
+        if result['queries'] > expected['queries'] + query_threshold:
+            regressions.append('%s %d queries, baseline %d' % (name, result['queries'], expected['queries']))
+    return regressions
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the hot API endpoints in process against the configured database, e.g. filled by ' \
+           'generate_load_data, and fail when they regress past the thresholds compared to a JSON baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('ngo', help='Key of the ngo to benchmark with, benchmark users with --password are '
+                                        'created in it and deleted afterwards')
+        parser.add_argument('--iterations', type=int, default=100)
+        parser.add_argument('--warmup', type=int, default=10)
+        parser.add_argument('--password', default='benchmark')
+        parser.add_argument('--scenarios', default=None, help='Comma separated names of the scenarios to run')
+        parser.add_argument('--baseline', default='benchmark_baseline.json')
+        parser.add_argument('--save-baseline', action='store_true', help='Write the results as the new baseline')
+        parser.add_argument('--latency-threshold', type=float, default=0.2,
+                            help='Allowed p95 latency increase over the baseline, as a fraction')
+        parser.add_argument('--query-threshold', type=int, default=0,
+                            help='Allowed number of queries over the baseline')
+
+    def handle(self, *args, **options):
+        try:
+            ngo = NGO.objects.get(key=options['ngo'])
+        except NGO.DoesNotExist:
+            raise CommandError("Ngo %s does not exist" % options['ngo'])
+        selected_scenarios = options['scenarios'].split(',') if options['scenarios'] else None
+
+        results = {}
+        admin, coach, data_coach, athlete = _prepare_users(ngo, options['password'])
+        try:
+            scenarios = _scenarios(ngo, admin, coach, data_coach, athlete, options['password'])
+            with override_settings(ALLOWED_HOSTS=['testserver'] + list(settings.ALLOWED_HOSTS)):
+                for name, client, method, path, payload, cleanup in scenarios:
+                    if selected_scenarios and name not in selected_scenarios:
+                        continue
+                    # Writes commit like in production, so their on_commit hooks run and are measured too.
+                    # The rows they created are deleted afterwards, so runs do not grow the database
+                    try:
+                        results[name] = _run_scenario(client, method, path, payload, options['iterations'],
+                                                      options['warmup'])
+                    finally:
+                        if cleanup:
+                            cleanup()
+                    print("%-28s p50 %8.2fms  p95 %8.2fms  p99 %8.2fms  %7.1f req/s  %3d queries" % (
+                        name, results[name]['p50_ms'], results[name]['p95_ms'], results[name]['p99_ms'],
+                        results[name]['throughput_rps'], results[name]['queries']))
+        finally:
+            benchmark_users = [admin, coach]
+            MobileAuthToken.objects.filter(user__in=benchmark_users).delete()
+            User.objects.filter(id__in=[user.id for user in benchmark_users]).delete()
+
+        if options['save_baseline']:
+            with open(options['baseline'], 'w') as baseline_file:
+                json.dump(results, baseline_file, indent=2, sort_keys=True)
+            print("Saved baseline to " + options['baseline'])
+        else:
+            try:
+                with open(options['baseline']) as baseline_file:
+                    baseline = json.load(baseline_file)
+            except FileNotFoundError:
+                raise CommandError("No baseline at %s, run with --save-baseline first" % options['baseline'])
+            regressions = _regressions(results, baseline, options['latency_threshold'], options['query_threshold'])
+            if regressions:
+                raise CommandError("Regressions over the baseline:\n" + '\n'.join(regressions))
+        print("Finished")
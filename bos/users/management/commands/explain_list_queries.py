@@ -0,0 +1,54 @@
+#  Copyright (c) 2019 Maverick Labs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as,
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.core.management import BaseCommand
+
+from measurements.models import Measurement
+from ngos.models import NGO
+from resources.models import Resource
+from users.models import User, UserReading
+
+
+def _list_queries(ngo):
+    # The first page of each list view with its common filters, as built in the views
+    reading = UserReading.objects.filter(ngo=ngo).order_by('id').first()
+    queries = [
+        ('athletes', User.objects.filter(ngo=ngo, role=User.ATHLETE, is_active=True)),
+        ('coaches', User.objects.filter(ngo=ngo, role=User.COACH, is_active=True)),
+        ('resources', Resource.objects.filter(ngo=ngo, type=Resource.TRAINING_SESSION, is_active=True)),
+        ('measurements', Measurement.objects.filter(ngo=ngo, is_active=True)),
+        ('readings', UserReading.objects.filter(ngo=ngo, is_active=True).order_by('-recorded_at')),
+    ]
+    if reading:
+        queries.append(('athlete readings', UserReading.objects.filter(
+            ngo=ngo, user_id=reading.user_id, measurement_id=reading.measurement_id).order_by('recorded_at')))
+    return queries
+
+
+class Command(BaseCommand):
+    help = 'Print the query plans of the list views of an ngo, to compare them before and after index changes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('ngo', help='Key of the ngo to explain the list queries of')
+        parser.add_argument('--page-size', type=int, default=100)
+        parser.add_argument('--analyze', action='store_true', help='Run the queries and report actual timings')
+
+    def handle(self, *args, **options):
+        ngo = NGO.objects.get(key=options['ngo'])
+        for name, queryset in _list_queries(ngo):
+            print("== " + name)
+            print(queryset[:options['page_size']].explain(analyze=options['analyze']))
+        print("Finished")
@@ -0,0 +1,243 @@
+#  Copyright (c) 2019 Maverick Labs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as,
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import csv
+import io
+import random
+import string
+import uuid
+from datetime import datetime, timedelta, timezone
+from multiprocessing import Pool
+
+from django.core.management import BaseCommand
+from django.db import connection, connections, transaction
+
+from bos import utils
+from bos.constants import PUBLIC_KEY_LENGTH_NGO, PUBLIC_KEY_LENGTH_USER, PUBLIC_KEY_LENGTH_USER_GROUP, \
+    PUBLIC_KEY_LENGTH_RESOURCE, PUBLIC_KEY_LENGTH_MEASUREMENT, PUBLIC_KEY_LENGTH_MEASUREMENT_TYPE, \
+    PUBLIC_KEY_LENGTH_USER_READING, BULK_CREATE_BATCH_SIZE
+from measurements.models import Measurement, MeasurementType
+from ngos.models import NGO
+from resources.models import Resource
+from users.models import User, UserHierarchy, UserGroup, UserReading, typed_reading_values
+
+KEY_CHARACTERS = string.ascii_letters + string.digits
+FIRST_NAMES = ['Aarav', 'Ananya', 'Arjun', 'Diya', 'Ishaan', 'Kavya', 'Meera', 'Rohan', 'Saanvi', 'Vihaan']
+LAST_NAMES = ['Gowda', 'Iyer', 'Joshi', 'Kulkarni', 'Nair', 'Patil', 'Rao', 'Reddy', 'Shetty', 'Singh']
+TEXT_VALUES = ['good', 'average', 'needs practice', 'excellent', 'absent']
+# Readings are recorded in sessions of this many readings sharing a training session uuid
+READINGS_PER_SESSION = 10
+READINGS_START = datetime(2019, 1, 1, tzinfo=timezone.utc)
+READINGS_PERIOD = timedelta(days=730)
+COPY_BATCH_SIZE = 50000
+
+
+def _key(rng, length):
+    return ''.join(rng.choice(KEY_CHARACTERS) for _ in range(length))
+
+
+def _uuid(rng):
+    return uuid.UUID(int=rng.getrandbits(128), version=4)
+
+
+def _users(rng, ngo, role, count):
+    users = [User(key=_key(rng, PUBLIC_KEY_LENGTH_USER), username=_key(rng, PUBLIC_KEY_LENGTH_USER),
+                  first_name=rng.choice(FIRST_NAMES), last_name=rng.choice(LAST_NAMES), ngo=ngo, role=role,
+                  gender=rng.choice([User.MALE, User.FEMALE]), password='!', reset_password=False)
+             for _ in range(count)]
+    return User.objects.bulk_create(users, batch_size=BULK_CREATE_BATCH_SIZE)
+
+
+def _curriculum_data(rng, label, measurements, sessions):
+    # Same shape as the resources built in the web app, a tree of sessions holding measurements
+    return {
+        'label': label,
+        'type': Resource.CURRICULUM,
+        'children': [{
+            'label': 'Session %d' % (index + 1),
+            'type': Resource.TRAINING_SESSION,
+            'description': ' '.join(rng.choice(TEXT_VALUES) for _ in range(20)),
+            'children': [{'label': measurement.label, 'type': 'MEASUREMENT', 'key': measurement.key}
+                         for measurement in rng.sample(measurements, min(len(measurements), 8))],
+        } for index in range(sessions)],
+    }
+
+
+def _create_ngo(seed, ngo_index, options):
+    """
+    Creates an ngo with its admin, coach hierarchy, athletes, measurements, resources
+    and groups, and returns the (athlete id, coach id) pairs and measurements to
+    generate readings for.
+    """
+    rng = random.Random('%d-%d' % (seed, ngo_index))
+    ngo = NGO.objects.create(key=_key(rng, PUBLIC_KEY_LENGTH_NGO), name='Load %d-%d' % (seed, ngo_index),
+                             description='Generated load testing ngo')
+
+    admin = _users(rng, ngo, User.ADMIN, 1)[0]
+    edges = [(None, admin)]
+    parents = [admin]
+    for _ in range(options['depth']):
+        coaches = _users(rng, ngo, User.COACH, len(parents) * options['fan_out'])
+        edges += [(parents[index // options['fan_out']], coach) for index, coach in enumerate(coaches)]
+        parents = coaches
+
+    athletes_per_coach = options['athletes_per_coach']
+    athletes = _users(rng, ngo, User.ATHLETE, len(parents) * athletes_per_coach)
+    edges += [(parents[index // athletes_per_coach], athlete) for index, athlete in enumerate(athletes)]
+    UserHierarchy.objects.bulk_create([UserHierarchy(parent_user=parent, child_user=child) for parent, child in edges],
+                                      batch_size=BULK_CREATE_BATCH_SIZE)
+    utils.rebuild_user_hierarchy_closure(ngo)
+
+    measurement_type = MeasurementType.objects.create(key=_key(rng, PUBLIC_KEY_LENGTH_MEASUREMENT_TYPE),
+                                                      label='Load', ngo=ngo)
+    input_types = [Measurement.NUMERIC, Measurement.NUMERIC, Measurement.BOOLEAN, Measurement.TEXT]
+    measurements = Measurement.objects.bulk_create([
+        Measurement(key=_key(rng, PUBLIC_KEY_LENGTH_MEASUREMENT), label='Measurement %d' % (index + 1), ngo=ngo,
+                    input_type=input_types[index % len(input_types)], uom='')
+        for index in range(options['measurements'])])
+    Measurement.types.through.objects.bulk_create([
+        Measurement.types.through(measurement_id=measurement.id, measurementtype_id=measurement_type.id)
+        for measurement in measurements])
+
+    resource_types = [Resource.CURRICULUM, Resource.TRAINING_SESSION, Resource.TRAINING_SESSION, Resource.FILE]
+    resources = []
+    for index in range(options['resources']):
+        resource_type = resource_types[index % len(resource_types)]
+        label = '%s %d' % (resource_type.capitalize(), index + 1)
+        resources.append(Resource(key=_key(rng, PUBLIC_KEY_LENGTH_RESOURCE), label=label, type=resource_type,
+                                  ngo=ngo, data=_curriculum_data(rng, label, measurements,
+                                                                 options['sessions_per_curriculum'])))
+    resources = Resource.objects.bulk_create(resources, batch_size=BULK_CREATE_BATCH_SIZE)
+
+    user_group_users = []
+    user_group_resources = []
+    for coach_index, coach in enumerate(parents):
+        coach_athletes = athletes[coach_index * athletes_per_coach:(coach_index + 1) * athletes_per_coach]
+        for group_index in range(options['groups_per_coach']):
+            user_group = UserGroup.objects.create(key=_key(rng, PUBLIC_KEY_LENGTH_USER_GROUP), ngo=ngo,
+                                                  label='Group %d-%d' % (coach_index + 1, group_index + 1))
+            for user in [coach] + rng.sample(coach_athletes, len(coach_athletes) // 2):
+                user_group_users.append(UserGroup.users.through(usergroup_id=user_group.id, user_id=user.id))
+            for resource in rng.sample(resources, min(len(resources), 5)):
+                user_group_resources.append(UserGroup.resources.through(usergroup_id=user_group.id,
+                                                                        resource_id=resource.id))
+    UserGroup.users.through.objects.bulk_create(user_group_users, batch_size=BULK_CREATE_BATCH_SIZE)
+    UserGroup.resources.through.objects.bulk_create(user_group_resources, batch_size=BULK_CREATE_BATCH_SIZE)
+
+    athlete_coaches = [(athlete.id, parents[index // athletes_per_coach].id) for index, athlete in enumerate(athletes)]
+    return ngo.id, athlete_coaches, [(measurement.id, measurement.input_type) for measurement in measurements]
+
+
+def _reading_value(rng, input_type):
+    if input_type == Measurement.NUMERIC:
+        return '%.2f' % rng.uniform(1, 100)
+    if input_type == Measurement.BOOLEAN:
+        return rng.choice(['yes', 'no'])
+    return rng.choice(TEXT_VALUES)
+
+
+def _copy_readings(task):
+    """
+    Generates the readings of a chunk of athletes and loads them with COPY. Runs in a
+    worker process, the random generator only depends on the seed and the chunk.
+    """
+    seed, ngo_index, chunk_index, ngo_id, athlete_coaches, measurements, readings_per_athlete = task
+    rng = random.Random('%d-%d-%d' % (seed, ngo_index, chunk_index))
+    columns = [field.column for field in UserReading._meta.concrete_fields if field.name != 'id']
+    copy_sql = 'COPY %s (%s) FROM STDIN WITH (FORMAT csv)' % (UserReading._meta.db_table, ', '.join(columns))
+    now = datetime.now(timezone.utc).isoformat()
+
+    count = 0
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    with connection.cursor() as cursor:
+        for athlete_id, coach_id in athlete_coaches:
+            for index in range(readings_per_athlete):
+                if index % READINGS_PER_SESSION == 0:
+                    training_session_uuid = _uuid(rng)
+                    evaluation_resource_uuid = _uuid(rng)
+                    recorded_at = READINGS_START + timedelta(
+                        seconds=rng.randrange(int(READINGS_PERIOD.total_seconds())))
+                measurement_id, input_type = rng.choice(measurements)
+                value = _reading_value(rng, input_type)
+                numeric_value, boolean_value, text_value = typed_reading_values(input_type, value)
+                row = {
+                    'key': _key(rng, PUBLIC_KEY_LENGTH_USER_READING), 'user_id': athlete_id, 'ngo_id': ngo_id,
+                    'by_user_id': coach_id, 'entered_by_id': coach_id, 'measurement_id': measurement_id,
+                    'training_session_uuid': training_session_uuid,
+                    'evaluation_resource_uuid': evaluation_resource_uuid, 'value': value,
+                    'numeric_value': numeric_value, 'boolean_value': boolean_value, 'text_value': text_value,
+                    'is_active': True, 'recorded_at': (recorded_at + timedelta(seconds=index)).isoformat(),
+                    'creation_time': now, 'last_modification_time': now,
+                }
+                writer.writerow([row[column] for column in columns])
+                count += 1
+                if count % COPY_BATCH_SIZE == 0:
+                    buffer.seek(0)
+                    cursor.copy_expert(copy_sql, buffer)
+                    buffer.seek(0)
+                    buffer.truncate()
+        buffer.seek(0)
+        cursor.copy_expert(copy_sql, buffer)
+    connection.close()
+    return count
+
+
+class Command(BaseCommand):
+    help = 'Generate ngos with a coach and athlete hierarchy, groups, resources and readings for load testing. ' \
+           'The same seed and options always generate the same data.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--ngos', type=int, default=1)
+        parser.add_argument('--depth', type=int, default=2, help='Levels of coaches under the admin of an ngo')
+        parser.add_argument('--fan-out', type=int, default=5, help='Coaches under each admin or coach')
+        parser.add_argument('--athletes-per-coach', type=int, default=20,
+                            help='Athletes under each coach of the last level')
+        parser.add_argument('--groups-per-coach', type=int, default=2)
+        parser.add_argument('--measurements', type=int, default=20, help='Measurements per ngo')
+        parser.add_argument('--resources', type=int, default=40, help='Resources per ngo')
+        parser.add_argument('--sessions-per-curriculum', type=int, default=10)
+        parser.add_argument('--readings-per-athlete', type=int, default=100)
+        parser.add_argument('--athletes-per-worker-task', type=int, default=200)
+        parser.add_argument('--workers', type=int, default=4, help='Processes loading readings in parallel')
+
+    def handle(self, *args, **options):
+        seed = options['seed']
+        tasks = []
+        for ngo_index in range(options['ngos']):
+            if NGO.objects.filter(name='Load %d-%d' % (seed, ngo_index)).exists():
+                print("Ngo %d of seed %d exists, skipped" % (ngo_index, seed))
+                continue
+            with transaction.atomic():
+                ngo_id, athlete_coaches, measurements = _create_ngo(seed, ngo_index, options)
+            print("Created ngo %d with %d athletes" % (ngo_index, len(athlete_coaches)))
+
+            chunk_size = options['athletes_per_worker_task']
+            for chunk_index, start in enumerate(range(0, len(athlete_coaches), chunk_size)):
+                tasks.append((seed, ngo_index, chunk_index, ngo_id, athlete_coaches[start:start + chunk_size],
+                              measurements, options['readings_per_athlete']))
+
+        # Forked workers must not share the connection of this process
+        connections.close_all()
+        count = 0
+        with Pool(options['workers']) as pool:
+            for task_count in pool.imap_unordered(_copy_readings, tasks):
+                count += task_count
+                print("Loaded %d readings" % count)
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE %s' % UserReading._meta.db_table)
+        print("Finished")
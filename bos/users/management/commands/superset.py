@@ -13,82 +13,134 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
-import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.conf import settings
 from django.core.management import BaseCommand
 
 from ngos.models import NGO
 from users.management.commands.superset_api import login_superset, get_users, get_roles, update_superset_user_if_needed, \
     create_superset_user, create_ngo_role_if_needed, create_ngo_table_if_needed, create_bos_database_if_needed, \
-    get_databases, find_bos_database_from_superset_databases, find_user, find_ngo_role_from_superset_roles, \
-    find_gamma_role_from_superset_roles
+    get_databases, find_bos_database_from_superset_databases, RetryingSession, index_superset_users, \
+    index_superset_roles, GAMMA_ROLE, is_superset_user_dirty
 from users.models import User
 
+SUPERSET_SYNC_WORKERS = getattr(settings, "SUPERSET_SYNC_WORKERS", 4)
+SUPERSET_CREATE_USER = 'create'
+SUPERSET_UPDATE_USER = 'update'
 
-def _process_ngo(self, ngo, superset_users, superset_role, session):
-    # fetch admin users for the ngo
-    admin_users = User.objects.filter(role=User.ADMIN, ngo=ngo)
-    for admin_user in admin_users:
-        # update_superset_user_password(self,admin_user,session)
-        superset_user = find_user(admin_user, superset_users)
-        if superset_user:
-            self.stdout.write(self.style.SUCCESS('Superset user exists'))
-            # Check if superset user is active
-            update_superset_user_if_needed(admin_user, superset_user, superset_role, session)
-        else:
-            create_superset_user(admin_user, superset_role, session)
+_worker = threading.local()
+
+
+def _plan_superset_user_changes(ngos, superset_users, superset_roles):
+    """
+    Diffs the admins of the ngos against the superset users and returns the
+    (change, admin_user, superset_user, superset_roles) tuples to apply.
+    """
+    superset_users_by_username = index_superset_users(superset_users)
+    superset_roles_by_name = index_superset_roles(superset_roles)
+    gamma_superset_role = superset_roles_by_name.get(GAMMA_ROLE)
+    assert gamma_superset_role
+
+    changes = []
+    for admin_user in User.objects.filter(role=User.ADMIN, ngo__in=ngos).select_related('ngo'):
+        ngo_superset_role = superset_roles_by_name.get(admin_user.ngo.key)
+        roles = [superset_role for superset_role in [ngo_superset_role, gamma_superset_role] if superset_role]
+        superset_user = superset_users_by_username.get(admin_user.username)
+        if not superset_user:
+            changes.append((SUPERSET_CREATE_USER, admin_user, None, roles))
+        elif is_superset_user_dirty(admin_user, superset_user):
+            changes.append((SUPERSET_UPDATE_USER, admin_user, superset_user, roles))
+    return changes
 
 
-def _superset_init(self):
-    ngos = NGO.objects.filter(is_active=True)
-    with requests.Session() as session:
+def _worker_session(cookies):
+    # Requests sessions are not thread safe, each worker reuses its own one logged in with the shared cookies
+    if not hasattr(_worker, 'session'):
+        _worker.session = RetryingSession()
+        _worker.session.auth = ('user', 'pass')
+        _worker.session.cookies.update(cookies)
+    return _worker.session
+
+
+def _apply_superset_user_change(change, cookies):
+    change_type, admin_user, superset_user, superset_roles = change
+    if change_type == SUPERSET_CREATE_USER:
+        return create_superset_user(admin_user, superset_roles, _worker_session(cookies))
+    return update_superset_user_if_needed(admin_user, superset_user, superset_roles, _worker_session(cookies))
+
+
+def _superset_init(self, dry_run=False, workers=SUPERSET_SYNC_WORKERS):
+    ngos = list(NGO.objects.filter(is_active=True))
+    with RetryingSession() as session:
         session.auth = ('user', 'pass')
         # Login in as admin
         if not login_superset(session):
             return
 
+        is_successful = create_bos_database_if_needed(session, dry_run)
+        if not is_successful:
+            return
+
         # Check if bos database created in superset database
         is_successful, superset_databases = get_databases(session)
         if not is_successful:
             return False
 
-        is_successful = create_bos_database_if_needed(session)
-        if not is_successful:
-            return
-
         superset_bos_database = find_bos_database_from_superset_databases(superset_databases)
-        if not superset_bos_database:
+        if not superset_bos_database and not dry_run:
             return False
 
         # Check if tables are created for all the ngos
-        is_successful = create_ngo_table_if_needed(ngos, superset_bos_database, session)
+        is_successful = create_ngo_table_if_needed(ngos, superset_bos_database, session, dry_run)
         if not is_successful:
             return
 
         # Check if permissions are created for all the ngos
-        is_successful = create_ngo_role_if_needed(ngos, session)
+        is_successful = create_ngo_role_if_needed(ngos, session, dry_run)
         if not is_successful:
             return
-        # Fetch all users in superset
+        # Fetch all users and roles in superset once
         is_successful, superset_users = get_users(session)
         if not is_successful:
             return
         is_successful, superset_roles = get_roles(session)
         if not is_successful:
             return
-        for ngo in ngos:
-            superset_role = find_ngo_role_from_superset_roles(ngo, superset_roles)
-            gamma_superset_role = find_gamma_role_from_superset_roles(superset_roles)
-            assert gamma_superset_role
-            _process_ngo(self, ngo, superset_users, [superset_role, gamma_superset_role], session)
+
+        changes = _plan_superset_user_changes(ngos, superset_users, superset_roles)
+        for change_type, admin_user, _, _ in changes:
+            self.stdout.write('%s %s' % (change_type, admin_user.username))
+        if dry_run or not changes:
+            return
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(partial(_apply_superset_user_change, cookies=session.cookies), changes))
+        failed_changes = results.count(False)
+        if failed_changes:
+            self.stdout.write(self.style.ERROR('%d of %d superset user changes failed' % (failed_changes, len(changes))))
+        else:
+            self.stdout.write(self.style.SUCCESS('%d superset user changes applied' % len(changes)))
+
+        # Superset cannot use the bos password hashes, created users need a bos password reset to log in
+        created_usernames = [change[1].username for change, is_successful in zip(changes, results)
+                             if change[0] == SUPERSET_CREATE_USER and is_successful]
+        if created_usernames:
+            self.stdout.write(self.style.WARNING('Reset the bos password of these users to set their superset '
+                                                 'password: %s' % ', '.join(created_usernames)))
 
 
 class Command(BaseCommand):
     help = 'Create superset users for superset'
 
     def add_arguments(self, parser):
-        pass
+        parser.add_argument('--dry-run', action='store_true', help='Print the changes without applying them')
+        parser.add_argument('--workers', type=int, default=SUPERSET_SYNC_WORKERS,
+                            help='Number of concurrent superset requests')
 
     def handle(self, *args, **options):
-        _superset_init(self)
+        _superset_init(self, options['dry_run'], options['workers'])
         print("Finished")
         return
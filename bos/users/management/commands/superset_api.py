@@ -13,27 +13,42 @@
 #    You should have received a copy of the GNU Affero General Public License
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
-import base64
+import logging
+import re
+import secrets
+from urllib.parse import urljoin
 
-import psycopg2
+import backoff
+import requests
 from django.conf import settings
+from urllib3.exceptions import NewConnectionError
 
 SUPERSET_API_URL = getattr(settings, "SUPERSET_API_URL", None)
-SUPERSET_LOGIN_URL = SUPERSET_API_URL + "login/"
-SUPERSET_GET_ROLES_URL = SUPERSET_API_URL + "roles/api/read"
-SUPERSET_GET_TABLES_URL = SUPERSET_API_URL + "tablemodelview/api/read"
-SUPERSET_GET_DATABASES_URL = SUPERSET_API_URL + "databaseview/api/read"
-SUPERSET_GET_USERS_URL = SUPERSET_API_URL + "users/api/read"
-SUPERSET_CREATE_USERS_URL = SUPERSET_API_URL + "users/api/create"
-SUPERSET_EDIT_USERS_URL = SUPERSET_API_URL + "users/edit/%s"
-SUPERSET_CREATE_ROLES_URL = SUPERSET_API_URL + "roles/api/create"
-SUPERSET_CREATE_TABLES_URL = SUPERSET_API_URL + "tablemodelview/api/create"
-SUPERSET_CREATE_DATABASES_URL = SUPERSET_API_URL + "databaseview/api/create"
+# Relative to the base url of the RetryingSession
+SUPERSET_LOGIN_URL = "login/"
+SUPERSET_GET_ROLES_URL = "roles/api/read"
+SUPERSET_GET_TABLES_URL = "tablemodelview/api/read"
+SUPERSET_GET_DATABASES_URL = "databaseview/api/read"
+SUPERSET_GET_USERS_URL = "users/api/read"
+SUPERSET_GET_PERMISSION_VIEWS_URL = "permissionviews/api/read"
+SUPERSET_CREATE_USERS_URL = "users/api/create"
+SUPERSET_EDIT_USERS_URL = "users/edit/%s"
+SUPERSET_RESET_PASSWORD_URL = "resetpassword/form?pk=%s"
+SUPERSET_CREATE_ROLES_URL = "roles/api/create"
+SUPERSET_CREATE_TABLES_URL = "tablemodelview/api/create"
+SUPERSET_CREATE_DATABASES_URL = "databaseview/api/create"
 SUPERSET_DATABASE = "superset"
+SUPERSET_DATASOURCE_ACCESS_PERMISSION = "datasource_access"
 GAMMA_ROLE = "Gamma"
 SUPERSET_BASE_TABLE_NAME = "user_readings_%s"
 BASE_DATABASE_CONNECTION_URL = "postgresql+psycopg2://%s:%s@%s/%s"
 HTTP_OK = 200
+HTTP_SERVER_ERROR = 500
+SUPERSET_MAX_TRIES = getattr(settings, "SUPERSET_MAX_TRIES", 5)
+# Only these are retried after superset may have received them, a retried POST could create a user twice
+SUPERSET_IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+# Table links and permission view names embed the table name, the ngo key follows its prefix
+SUPERSET_NGO_TABLE_REGEX = re.compile(re.escape(SUPERSET_BASE_TABLE_NAME % '') + r'(\w+)')
 
 CONFIG_DATABASES = getattr(settings, "DATABASES", None)
 BOS_DATABASE_NAME = CONFIG_DATABASES["default"]["NAME"]
@@ -47,11 +62,70 @@ SUPERSET_DATABASE_CONNECTION_URL = BASE_DATABASE_CONNECTION_URL % (BOS_DATABASE_
                                                                    BOS_DATABASE_HOST, SUPERSET_DATABASE)
 
 
+logger = logging.getLogger(__name__)
+
+
 def debug_print(message):
     print(message)
     return
 
 
+def _is_server_error(response):
+    return response.status_code >= HTTP_SERVER_ERROR
+
+
+def _may_have_been_sent(exception):
+    # Connect timeouts and refused connections fail before superset receives anything
+    if isinstance(exception, requests.ConnectTimeout):
+        return False
+    reason = getattr(exception.args[0], 'reason', None) if exception.args else None
+    return not isinstance(reason, NewConnectionError)
+
+
+class RetryingSession(requests.Session):
+    """
+    Session against the superset api retrying with exponential backoff. Idempotent requests are retried on
+    connection errors and 5xx responses, the others only when the connection failed before sending them.
+    """
+
+    def __init__(self, base_url=None):
+        super().__init__()
+        self.base_url = base_url or SUPERSET_API_URL
+
+    def request(self, method, url, *args, **kwargs):
+        url = urljoin(self.base_url, url)
+        if method.upper() in SUPERSET_IDEMPOTENT_METHODS:
+            return self._idempotent_request(method, url, *args, **kwargs)
+        return self._unsent_retrying_request(method, url, *args, **kwargs)
+
+    @backoff.on_exception(backoff.expo, (requests.ConnectionError, requests.Timeout), max_tries=SUPERSET_MAX_TRIES)
+    @backoff.on_predicate(backoff.expo, _is_server_error, max_tries=SUPERSET_MAX_TRIES)
+    def _idempotent_request(self, method, url, *args, **kwargs):
+        return super().request(method, url, *args, **kwargs)
+
+    @backoff.on_exception(backoff.expo, requests.ConnectionError, max_tries=SUPERSET_MAX_TRIES,
+                          giveup=_may_have_been_sent)
+    def _unsent_retrying_request(self, method, url, *args, **kwargs):
+        return super().request(method, url, *args, **kwargs)
+
+
+def index_superset_users(superset_users):
+    return {superset_user.username: superset_user for superset_user in superset_users}
+
+
+def index_superset_roles(superset_roles):
+    return {superset_role.name: superset_role for superset_role in superset_roles}
+
+
+def index_by_ngo_key(superset_items, attribute):
+    indexed_items = {}
+    for superset_item in superset_items:
+        match = SUPERSET_NGO_TABLE_REGEX.search(getattr(superset_item, attribute) or '')
+        if match:
+            indexed_items.setdefault(match.group(1), superset_item)
+    return indexed_items
+
+
 def find_user(admin_user, superset_users):
     for superset_user in superset_users:
         if admin_user.username == superset_user.username:
@@ -147,6 +221,23 @@ def get_tables(session):
     return True, superset_tables
 
 
+def get_permission_views(session):
+    response = session.get(SUPERSET_GET_PERMISSION_VIEWS_URL)
+    if response.status_code != HTTP_OK:
+        debug_print('Get permission views failed')
+        return False, []
+
+    json_data = response.json()
+    permission_views_json = json_data.get("result", [])
+    permission_views_pks = json_data.get("pks", [])
+    permission_views = []
+    for index, permission_view_json in enumerate(permission_views_json):
+        permission_view_json['pk'] = permission_views_pks[index]
+        permission_views.append(SupersetPermissionView.from_json(permission_view_json))
+    debug_print('Get permission views successful')
+    return True, permission_views
+
+
 def get_databases(session):
     response = session.get(SUPERSET_GET_DATABASES_URL)
     if response.status_code != HTTP_OK:
@@ -221,71 +312,81 @@ def create_bos_database(session):
     return True
 
 
-def create_ngo_role_if_needed(ngos, session):
+def create_ngo_role_if_needed(ngos, session, dry_run=False):
     is_successful, superset_roles = get_roles(session)
     if not is_successful:
         return False
+    superset_roles_by_name = index_superset_roles(superset_roles)
+    missing_ngos = [ngo for ngo in ngos if ngo.key not in superset_roles_by_name]
+    if not missing_ngos:
+        return True
+    if dry_run:
+        for ngo in missing_ngos:
+            debug_print('Would create role %s' % ngo.key)
+        return True
 
-    query_string = "SELECT abpv.id,abvm.name from ab_permission_view abpv,ab_view_menu abvm,ab_permission abp WHERE " \
-                   "abpv.view_menu_id=abvm.id AND abpv.permission_id=abp.id AND abp.name='datasource_access'; "
-    is_successful, permission_view_rows = execute_raw_query(query_string, True)
+    is_successful, permission_views = get_permission_views(session)
     if not is_successful:
         return False
 
-    permission_views = []
-    for permission_view in permission_view_rows:
-        permission_views.append(SupersetPermissionView.from_tuple(permission_view))
+    datasource_permission_views = [permission_view for permission_view in permission_views
+                                   if permission_view.permission == SUPERSET_DATASOURCE_ACCESS_PERMISSION]
+    permission_views_by_ngo_key = index_by_ngo_key(datasource_permission_views, 'name')
 
-    for ngo in ngos:
-        superset_role = find_ngo_role_from_superset_roles(ngo, superset_roles)
-        if not superset_role:
-            permission_view = find_ngo_permission_view_from_permission_views(ngo, permission_views)
+    for ngo in missing_ngos:
+        permission_view = permission_views_by_ngo_key.get(ngo.key)
+        if not permission_view:
+            debug_print('Permission view missing for %s' % ngo.key)
+            return False
 
-            is_successful = create_role(ngo, permission_view, session)
-            if not is_successful:
-                return False
+        is_successful = create_role(ngo, permission_view, session)
+        if not is_successful:
+            return False
     return True
 
 
-def create_ngo_table_if_needed(ngos, superset_bos_database, session):
+def create_ngo_table_if_needed(ngos, superset_bos_database, session, dry_run=False):
     is_successful, superset_tables = get_tables(session)
     if not is_successful:
         return False
 
+    superset_tables_by_ngo_key = index_by_ngo_key(superset_tables, 'link')
     for ngo in ngos:
-        superset_table = find_ngo_table_from_superset_tables(ngo, superset_tables)
-        if not superset_table:
+        if ngo.key not in superset_tables_by_ngo_key:
+            if dry_run:
+                debug_print('Would create table %s' % (SUPERSET_BASE_TABLE_NAME % ngo.key))
+                continue
             is_successful = create_table(ngo, superset_bos_database, session)
             if not is_successful:
                 return False
     return True
 
 
-def create_bos_database_if_needed(session):
+def create_bos_database_if_needed(session, dry_run=False):
     is_successful, superset_databases = get_databases(session)
     if not is_successful:
         return False
 
     superset_bos_database = find_bos_database_from_superset_databases(superset_databases)
     if not superset_bos_database:
+        if dry_run:
+            debug_print('Would create bos database')
+            return True
         is_successful = create_bos_database(session)
         if not is_successful:
             return False
     return True
 
 
-def update_superset_user_password(user):
-    algorithm, iterations, salt, password_hash = user.password.split('$', 3)
-    algorithm = algorithm.replace("_", ":")
-    password_hash = base64.b64decode(password_hash).hex()
-    superset_password = "%s:%s$%s$%s" % (algorithm, iterations, salt, password_hash)
-
-    query_string = "UPDATE ab_user SET password='%s' WHERE username='%s';" % (superset_password, user.username)
-    is_successful, _ = execute_raw_query(query_string, False)
-    if not is_successful:
-        debug_print('updated not password %s' % user.username)
+def update_superset_user_password(superset_user, password, session):
+    # Superset only keeps its own hashes, the password is set through its reset password form
+    update_data = {"password": password,
+                   "conf_password": password}
+    response = session.post(SUPERSET_RESET_PASSWORD_URL % superset_user.pk, data=update_data)
+    if response.status_code != HTTP_OK:
+        debug_print('Update password failed %s' % superset_user.username)
         return False
-    debug_print('Updated password %s' % user.username)
+    debug_print('Updated password %s' % superset_user.username)
     return True
 
 
@@ -304,18 +405,16 @@ def update_superset_user_if_needed(user, superset_user, superset_roles, session)
             debug_print('Update user failed')
             return False
         debug_print('Update user successful')
+        return True
 
     debug_print('User is upto date')
-
-    # update Password for user
-    if not update_superset_user_password(user):
-        debug_print('Update password failed')
-        return False
-
     return True
 
 
-def create_superset_user(user, superset_roles, session):
+def create_superset_user(user, superset_roles, session, password=None):
+    # Without the plain text password the user gets a random one, it is replaced once the bos password is reset
+    is_password_unknown = password is None
+    password = password or secrets.token_urlsafe()
     create_data = {}
     create_data["first_name"] = user.first_name
     create_data["last_name"] = user.last_name
@@ -323,18 +422,16 @@ def create_superset_user(user, superset_roles, session):
     create_data["email"] = user.email
     create_data["active"] = True
     create_data["roles"] = [superset_role.pk for superset_role in superset_roles]
-    create_data["password"] = "admin@123"
-    create_data["conf_password"] = "admin@123"
+    create_data["password"] = password
+    create_data["conf_password"] = password
     response = session.post(SUPERSET_CREATE_USERS_URL, data=create_data)
     if response.status_code != HTTP_OK:
         debug_print('Create user failed')
         return False
+    if is_password_unknown:
+        logger.warning('Superset user %s created without a password, it is set by a bos password reset',
+                       user.username)
     debug_print('Create user successful')
-
-    # update Password for user
-    if not update_superset_user_password(user):
-        debug_print('Update password failed')
-        return False
     return True
 
 
@@ -347,35 +444,6 @@ def login_superset(session):
     return True
 
 
-def execute_raw_query(query, is_result_expected):
-    is_successful = True
-    record = None
-    connection = None
-    try:
-        connection = psycopg2.connect(user=BOS_DATABASE_USER,
-                                      password=BOS_DATABASE_PASSWORD,
-                                      host=BOS_DATABASE_HOST,
-                                      port="5432",
-                                      database=SUPERSET_DATABASE)
-
-        cursor = connection.cursor()
-        cursor.execute(query)
-        if is_result_expected:
-            record = cursor.fetchall()
-            print("You are connected to - ", record, "\n")
-        else:
-            connection.commit()
-        cursor.close()
-    except (Exception, psycopg2.Error) as error:
-        is_successful = False
-        debug_print("Error while connecting to PostgreSQL", error)
-    finally:
-        # closing database connection.
-        if connection is not None:
-            connection.close()
-        return is_successful, record
-
-
 class SupersetUser:
 
     def __init__(self, pk, active, email, first_name, last_name, username, roles):
@@ -447,13 +515,14 @@ class SupersetDatabase:
 
 
 class SupersetPermissionView:
-    def __init__(self, pk, name):
+    def __init__(self, pk, permission, view_menu):
         self.pk = pk
-        self.name = name
+        self.permission = permission
+        self.name = view_menu
 
     @classmethod
-    def from_tuple(cls, tuple_data):
-        return cls(pk=tuple_data[0], name=tuple_data[1])
+    def from_json(cls, json):
+        return cls(**json)
 
     def __repr__(self):
         return str(self.name)
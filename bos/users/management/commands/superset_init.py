@@ -15,70 +15,133 @@
 #
 
 from django.core.management import BaseCommand
-from django.db import connection
-
-from ngos.models import NGO
-from bos.create_view_as import create_view_as
-from django.db.models import F, CharField
+from django.db import connection, transaction
+from django.db.models import F, CharField, Q
 from django.db.models import Value
 from django.db.models.functions import Concat
 
+from bos.sync import TOMBSTONE_RETENTION_DAYS
+from ngos.models import NGO
 from users.management.commands.superset_api import SUPERSET_BASE_TABLE_NAME
-from users.models import UserReading
+from users.models import UserReading, Tombstone
+
+SUPERSET_WATERMARKS_TABLE = 'superset_refresh_watermarks'
+# Rows committed by transactions that were still open at the previous refresh are picked up by re-reading this window
+SUPERSET_REFRESH_OVERLAP = '5 minutes'
+SUPERSET_READING_COLUMNS = [
+    'key',
+    'measurement_label',
+    'value',
+    'user_full_name',
+    'user_gender',
+    'user_is_active',
+    'creation_time',
+    'last_modification_time',
+]
+
+
+def _changed_user_readings(ngo, watermark):
+    """
+    Readings of the ngo joined with their user and measurement, limited to the ones
+    where any of the three rows changed after the watermark. Inactive readings are
+    kept so that their rows can be removed from the summary table.
+    """
+    user_readings = UserReading.objects.filter(ngo=ngo)
+    if watermark:
+        user_readings = user_readings.filter(Q(last_modification_time__gt=watermark) |
+                                             Q(user__last_modification_time__gt=watermark) |
+                                             Q(measurement__last_modification_time__gt=watermark))
+    return user_readings.annotate(
+        user_full_name=Concat('user__first_name',
+                              Value(' '),
+                              'user__middle_name',
+                              Value(' '),
+                              'user__last_name', output_field=CharField()),
+        measurement_label=F('measurement__label'),
+        user_gender=F('user__gender'),
+        user_is_active=F('user__is_active'),
+    ).values_list(*SUPERSET_READING_COLUMNS + ['is_active'])
+
 
+def _create_summary_table_if_needed(cursor, table_name):
+    # Earlier versions published a plain view under the same name
+    cursor.execute("SELECT relkind FROM pg_class WHERE relname = %s AND relkind IN ('v', 'r')", [table_name])
+    relation = cursor.fetchone()
+    if relation and relation[0] == 'r':
+        return False
+    if relation:
+        cursor.execute("DROP VIEW %s" % connection.ops.quote_name(table_name))
+    cursor.execute("CREATE TABLE %s ("
+                   "key varchar(50) PRIMARY KEY, "
+                   "measurement_label varchar(50), "
+                   "value varchar(50), "
+                   "user_full_name text, "
+                   "user_gender varchar(10), "
+                   "user_is_active boolean, "
+                   "creation_time timestamp with time zone, "
+                   "last_modification_time timestamp with time zone)" % connection.ops.quote_name(table_name))
+    return True
 
-def _superset_init():
+
+def _refresh_ngo_summary_table(cursor, ngo, full):
+    summary_table_name = SUPERSET_BASE_TABLE_NAME % ngo.key
+    table_name = connection.ops.quote_name(summary_table_name)
+    # Watermarks older than the tombstone retention may miss purged reading tombstones
+    cursor.execute("SELECT now(), watermark - interval '%s', watermark < now() - interval '%d days' "
+                   "FROM %s WHERE table_name = %%s"
+                   % (SUPERSET_REFRESH_OVERLAP, TOMBSTONE_RETENTION_DAYS, SUPERSET_WATERMARKS_TABLE),
+                   [summary_table_name])
+    row = cursor.fetchone()
+    created = _create_summary_table_if_needed(cursor, summary_table_name)
+    if full or created or not row or row[2]:
+        cursor.execute("SELECT now()")
+        refreshed_at, watermark = cursor.fetchone()[0], None
+        # DELETE rather than TRUNCATE keeps the table readable by dashboards during the rebuild
+        cursor.execute("DELETE FROM %s" % table_name)
+    else:
+        refreshed_at, watermark = row[:2]
+
+    sql, params = _changed_user_readings(ngo, watermark).query.get_compiler(connection=connection).as_sql()
+    columns = ', '.join(SUPERSET_READING_COLUMNS)
+    updates = ', '.join('%s = EXCLUDED.%s' % (column, column) for column in SUPERSET_READING_COLUMNS[1:])
+    cursor.execute("INSERT INTO %s (%s) SELECT %s FROM (%s) changed WHERE changed.is_active "
+                   "ON CONFLICT (key) DO UPDATE SET %s" % (table_name, columns, columns, sql, updates), params)
+    upserted = cursor.rowcount
+    cursor.execute("DELETE FROM %s USING (%s) changed WHERE %s.key = changed.key AND NOT changed.is_active"
+                   % (table_name, sql, table_name), params)
+    deleted = cursor.rowcount
+    if watermark:
+        # Readings deleted from user_readings only left a tombstone
+        sql, params = Tombstone.objects.filter(ngo=ngo, collection=Tombstone.READINGS, deletion_time__gt=watermark) \
+            .values_list('object_key').query.get_compiler(connection=connection).as_sql()
+        cursor.execute("DELETE FROM %s WHERE key IN (%s)" % (table_name, sql), params)
+        deleted += cursor.rowcount
+
+    cursor.execute("INSERT INTO %s (table_name, watermark) VALUES (%%s, %%s) "
+                   "ON CONFLICT (table_name) DO UPDATE SET watermark = EXCLUDED.watermark"
+                   % SUPERSET_WATERMARKS_TABLE, [summary_table_name, refreshed_at])
+    return upserted, deleted
+
+
+def _superset_init(full=False):
     with connection.cursor() as cursor:
-        ngos = NGO.objects.all().values_list("key", flat=True)
-
-        # /Drop temporary tables in case the process got cut off before
-        for ngo in ngos:
-            print(ngo)
-            view_name = SUPERSET_BASE_TABLE_NAME % (ngo)
-
-            drop_view_string = "DROP VIEW IF EXISTS %s" % view_name
-            cursor.execute(
-                drop_view_string
-            )
-            # Create the new table from the summary query
-            ngo_filter = {
-                'ngo__key': ngo,
-                'is_active': True
-            }
-
-            user_readings = UserReading.objects.filter(**ngo_filter).annotate(
-                user_full_name=Concat('user__first_name',
-                                      Value(' '),
-                                      'user__middle_name',
-                                      Value(' '),
-                                      'user__last_name', output_field=CharField()),
-                measurement_label=F('measurement__label'),
-                user_gender=F('user__gender'),
-                user_is_active=F('user__is_active'),
-            ).values_list(
-                'key',
-                'measurement_label',
-                'value',
-                'user_full_name',
-                'user_gender',
-                'user_is_active',
-                'creation_time',
-                'last_modification_time',
-            )
-            create_view_string = view_name
-            create_view_as(
-                create_view_string,
-                user_readings,
-            )
+        cursor.execute("CREATE TABLE IF NOT EXISTS %s (table_name varchar(100) PRIMARY KEY, "
+                       "watermark timestamp with time zone NOT NULL)" % SUPERSET_WATERMARKS_TABLE)
+
+    for ngo in NGO.objects.all():
+        # One transaction per ngo, dashboards keep reading the previous rows until it commits
+        with transaction.atomic(), connection.cursor() as cursor:
+            upserted, deleted = _refresh_ngo_summary_table(cursor, ngo, full)
+        print("%s: %d rows upserted, %d rows deleted" % (ngo.key, upserted, deleted))
 
 
 class Command(BaseCommand):
-    help = 'Create views for superset'
+    help = 'Create and refresh the per ngo reading tables read by superset'
 
     def add_arguments(self, parser):
-        pass
+        parser.add_argument('--full', action='store_true', help='Rebuild the tables instead of refreshing changes')
 
     def handle(self, *args, **options):
-        _superset_init()
+        _superset_init(options['full'])
         print("Finished")
         return
@@ -0,0 +1,36 @@
+#  Copyright (c) 2019 Maverick Labs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as,
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.core.management import BaseCommand
+from django.db import transaction
+
+from bos.utils import rebuild_user_hierarchy_closure
+from ngos.models import NGO
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the user hierarchy closure table from user hierarchy'
+
+    def add_arguments(self, parser):
+        pass
+
+    def handle(self, *args, **options):
+        for ngo in NGO.objects.all():
+            with transaction.atomic():
+                rebuild_user_hierarchy_closure(ngo)
+            self.stdout.write(self.style.SUCCESS('Rebuilt user hierarchy closure for "%s"' % ngo.key))
+        print("Finished")
+        return
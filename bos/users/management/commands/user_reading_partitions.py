@@ -0,0 +1,185 @@
+#  Copyright (c) 2019 Maverick Labs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as,
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import re
+from datetime import date
+
+from django.core.management import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from users.models import UserReading
+
+USER_READINGS_TABLE = UserReading._meta.db_table
+LEGACY_USER_READINGS_TABLE = USER_READINGS_TABLE + '_legacy'
+DEFAULT_PARTITION_TABLE = USER_READINGS_TABLE + '_default'
+PARTITION_TABLE = USER_READINGS_TABLE + '_p%04d_%02d'
+PARTITION_TABLE_REGEX = re.compile('^' + USER_READINGS_TABLE + r'_p(\d{4})_(\d{2})$')
+# Unique constraints of a partitioned table must include recorded_at, this table keeps key unique on its own
+USER_READING_KEYS_TABLE = 'user_reading_keys'
+USER_READING_KEYS_FUNCTION = USER_READING_KEYS_TABLE + '_sync'
+
+
+def _add_months(month, months):
+    month_index = month.year * 12 + month.month - 1 + months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def _is_partitioned(cursor):
+    cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass", [USER_READINGS_TABLE])
+    return cursor.fetchone() is not None
+
+
+def _partitions(cursor):
+    cursor.execute("SELECT child.relname FROM pg_inherits "
+                   "JOIN pg_class parent ON pg_inherits.inhparent = parent.oid "
+                   "JOIN pg_class child ON pg_inherits.inhrelid = child.oid "
+                   "WHERE parent.relname = %s", [USER_READINGS_TABLE])
+    return [row[0] for row in cursor.fetchall()]
+
+
+def _create_partition(cursor, month):
+    partition = PARTITION_TABLE % (month.year, month.month)
+    cursor.execute("SELECT to_regclass(%s), to_regclass(%s)", [partition, DEFAULT_PARTITION_TABLE])
+    partition_exists, default_partition_exists = cursor.fetchone()
+    if partition_exists:
+        return
+
+    # Bounds are UTC month starts, recorded_at is stored as timestamp with time zone
+    bounds = "FROM ('%s 00:00:00+00') TO ('%s 00:00:00+00')" % (month.isoformat(), _add_months(month, 1).isoformat())
+    if not default_partition_exists:
+        cursor.execute("CREATE TABLE %s PARTITION OF %s FOR VALUES %s" % (partition, USER_READINGS_TABLE, bounds))
+        return
+
+    # Rows of the month already in the default partition, e.g. from a device clock set in the future, would
+    # make PARTITION OF fail, they are moved to the new table before it is attached
+    cursor.execute("CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+                   % (partition, USER_READINGS_TABLE))
+    cursor.execute("WITH moved AS (DELETE FROM %s WHERE recorded_at >= '%s 00:00:00+00' AND "
+                   "recorded_at < '%s 00:00:00+00' RETURNING *) INSERT INTO %s SELECT * FROM moved"
+                   % (DEFAULT_PARTITION_TABLE, month.isoformat(), _add_months(month, 1).isoformat(), partition))
+    if cursor.rowcount:
+        print("Moved %d rows from %s to %s" % (cursor.rowcount, DEFAULT_PARTITION_TABLE, partition))
+        # The delete released their keys, the insert into the detached table did not claim them again
+        cursor.execute("INSERT INTO %s (key) SELECT key FROM %s" % (USER_READING_KEYS_TABLE, partition))
+    cursor.execute("ALTER TABLE %s ATTACH PARTITION %s FOR VALUES %s" % (USER_READINGS_TABLE, partition, bounds))
+
+
+def _create_key_uniqueness(cursor):
+    # Readings claim their key in user_reading_keys, a duplicate fails with the unique violation of its
+    # primary key. Keys of detached partitions stay claimed, archived readings keep theirs.
+    cursor.execute("CREATE TABLE %s (key varchar(%d) PRIMARY KEY)"
+                   % (USER_READING_KEYS_TABLE, UserReading._meta.get_field('key').max_length))
+    cursor.execute("INSERT INTO %s (key) SELECT key FROM %s" % (USER_READING_KEYS_TABLE, USER_READINGS_TABLE))
+    cursor.execute("CREATE FUNCTION %s() RETURNS trigger LANGUAGE plpgsql AS $$ BEGIN "
+                   "IF TG_OP IN ('DELETE', 'UPDATE') THEN DELETE FROM %s WHERE key = OLD.key; END IF; "
+                   "IF TG_OP IN ('INSERT', 'UPDATE') THEN INSERT INTO %s (key) VALUES (NEW.key); END IF; "
+                   "RETURN NULL; END $$" % (USER_READING_KEYS_FUNCTION, USER_READING_KEYS_TABLE,
+                                            USER_READING_KEYS_TABLE))
+    cursor.execute("CREATE TRIGGER %s AFTER INSERT OR DELETE OR UPDATE OF key ON %s FOR EACH ROW "
+                   "EXECUTE PROCEDURE %s()" % (USER_READING_KEYS_FUNCTION, USER_READINGS_TABLE,
+                                               USER_READING_KEYS_FUNCTION))
+
+
+def _convert(cursor):
+    """
+    Replaces user_readings by a table partitioned by month of recorded_at, with
+    the same columns, sequence, indexes and foreign keys. The primary key includes
+    recorded_at, as PostgreSQL requires for partitioned tables, and key stays
+    globally unique through user_reading_keys.
+    """
+    cursor.execute("SELECT indexdef FROM pg_indexes WHERE tablename = %s AND indexdef NOT LIKE 'CREATE UNIQUE%%'",
+                   [USER_READINGS_TABLE])
+    index_definitions = [row[0] for row in cursor.fetchall()]
+    cursor.execute("SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+                   "WHERE conrelid = %s::regclass AND contype = 'f'", [USER_READINGS_TABLE])
+    foreign_keys = cursor.fetchall()
+
+    cursor.execute("ALTER TABLE %s RENAME TO %s" % (USER_READINGS_TABLE, LEGACY_USER_READINGS_TABLE))
+    cursor.execute("CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+                   "PARTITION BY RANGE (recorded_at)" % (USER_READINGS_TABLE, LEGACY_USER_READINGS_TABLE))
+    cursor.execute("ALTER SEQUENCE %s_id_seq OWNED BY %s.id" % (USER_READINGS_TABLE, USER_READINGS_TABLE))
+
+    cursor.execute("SELECT date_trunc('month', min(recorded_at) AT TIME ZONE 'UTC')::date, "
+                   "date_trunc('month', max(recorded_at) AT TIME ZONE 'UTC')::date FROM %s"
+                   % LEGACY_USER_READINGS_TABLE)
+    first_month, last_month = cursor.fetchone()
+    current_month = timezone.now().date().replace(day=1)
+    month = min(first_month or current_month, current_month)
+    last_month = max(last_month or current_month, current_month)
+    while month <= last_month:
+        _create_partition(cursor, month)
+        month = _add_months(month, 1)
+    cursor.execute("CREATE TABLE %s PARTITION OF %s DEFAULT" % (DEFAULT_PARTITION_TABLE, USER_READINGS_TABLE))
+
+    cursor.execute("INSERT INTO %s SELECT * FROM %s" % (USER_READINGS_TABLE, LEGACY_USER_READINGS_TABLE))
+    cursor.execute("DROP TABLE %s" % LEGACY_USER_READINGS_TABLE)
+
+    # Indexes are built after the copy, on a partitioned table they cascade to every partition
+    cursor.execute("ALTER TABLE %s ADD PRIMARY KEY (id, recorded_at)" % USER_READINGS_TABLE)
+    cursor.execute("ALTER TABLE %s ADD CONSTRAINT %s_key_recorded_at_uniq UNIQUE (key, recorded_at)"
+                   % (USER_READINGS_TABLE, USER_READINGS_TABLE))
+    _create_key_uniqueness(cursor)
+    for index_definition in index_definitions:
+        cursor.execute(index_definition)
+    for name, definition in foreign_keys:
+        cursor.execute("ALTER TABLE %s ADD CONSTRAINT %s %s" % (USER_READINGS_TABLE, name, definition))
+
+
+def _detach_old_partitions(cursor, retain_months, archive_schema):
+    oldest_month = _add_months(timezone.now().date().replace(day=1), -retain_months)
+    if archive_schema:
+        cursor.execute("CREATE SCHEMA IF NOT EXISTS %s" % connection.ops.quote_name(archive_schema))
+
+    for partition in _partitions(cursor):
+        match = PARTITION_TABLE_REGEX.match(partition)
+        if not match or date(int(match.group(1)), int(match.group(2)), 1) >= oldest_month:
+            continue
+        cursor.execute("ALTER TABLE %s DETACH PARTITION %s" % (USER_READINGS_TABLE, partition))
+        if archive_schema:
+            cursor.execute("ALTER TABLE %s SET SCHEMA %s" % (partition, connection.ops.quote_name(archive_schema)))
+        print("Detached " + partition)
+
+
+class Command(BaseCommand):
+    help = 'Partition user readings by month of recorded_at, create future partitions and detach old ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--convert', action='store_true',
+                            help='Convert the existing user readings table to a partitioned table')
+        parser.add_argument('--months-ahead', type=int, default=3,
+                            help='Number of future monthly partitions to create')
+        parser.add_argument('--retain-months', type=int, default=None,
+                            help='Detach monthly partitions older than this many months')
+        parser.add_argument('--archive-schema', default=None,
+                            help='Schema to move detached partitions to')
+
+    def handle(self, *args, **options):
+        with transaction.atomic(), connection.cursor() as cursor:
+            if not _is_partitioned(cursor):
+                if not options['convert']:
+                    print("Table " + USER_READINGS_TABLE + " is not partitioned, run with --convert first")
+                    return
+                _convert(cursor)
+
+            current_month = timezone.now().date().replace(day=1)
+            for months in range(options['months_ahead'] + 1):
+                _create_partition(cursor, _add_months(current_month, months))
+
+            if options['retain_months'] is not None:
+                _detach_old_partitions(cursor, options['retain_months'], options['archive_schema'])
+
+        print("Finished")
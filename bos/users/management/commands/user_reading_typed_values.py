@@ -0,0 +1,50 @@
+#  Copyright (c) 2019 Maverick Labs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as,
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.core.management import BaseCommand
+from django.db import transaction
+
+from bos.constants import BULK_CREATE_BATCH_SIZE
+from users.models import UserReading
+
+TYPED_VALUE_FIELDS = ['numeric_value', 'boolean_value', 'text_value']
+
+
+class Command(BaseCommand):
+    help = 'Backfill the typed value columns of user readings from their measurement input type'
+
+    def add_arguments(self, parser):
+        pass
+
+    def handle(self, *args, **options):
+        last_id = 0
+        while True:
+            # Walk the table by id so each batch is an index range scan and its own transaction
+            user_readings = list(UserReading.objects.filter(id__gt=last_id).order_by('id')
+                                 .only('id', 'value', 'measurement__input_type')
+                                 .select_related('measurement')[:BULK_CREATE_BATCH_SIZE])
+            if not user_readings:
+                break
+
+            for user_reading in user_readings:
+                user_reading.set_typed_values(user_reading.measurement.input_type)
+            with transaction.atomic():
+                UserReading.objects.bulk_update(user_readings, TYPED_VALUE_FIELDS)
+
+            last_id = user_readings[-1].id
+            print("Updated readings up to id " + str(last_id))
+
+        print("Finished")
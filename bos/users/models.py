@@ -14,22 +14,36 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from django.contrib.auth.models import AbstractUser
+import math
+from collections import defaultdict
+
+from django.contrib.auth.models import AbstractUser, Group, Permission
 from django.contrib.postgres.fields import JSONField
-from django.db import models
+from django.contrib.postgres.indexes import GinIndex
+from django.db import models, connections, transaction
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed, post_migrate
+from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.crypto import get_random_string
 from django.utils.translation import gettext as _
 
+from bos.cache import invalidate_mobile_tokens, MOBILE_TOKEN_USER_IGNORED_FIELDS
 from bos.constants import PUBLIC_KEY_LENGTH_USER, LENGTH_TOKEN, LENGTH_RESET_PASSWORD_TOKEN, FIELD_LENGTH_NAME, \
     LENGTH_USERNAME, PUBLIC_KEY_LENGTH_USER_READING, PUBLIC_KEY_LENGTH_USER_GROUP, LENGTH_LABEL, \
-    PUBLIC_KEY_LENGTH_USER_REQUEST
+    PUBLIC_KEY_LENGTH_USER_REQUEST, READING_BOOLEAN_VALUES, LENGTH_IDEMPOTENCY_KEY
 from bos.permissions import PERMISSION_BOS_ADMIN, PERMISSION_CAN_ADD_COACH, PERMISSION_CAN_CHANGE_COACH, \
     PERMISSION_CAN_DESTROY_COACH, PERMISSION_CAN_VIEW_COACH, PERMISSION_CAN_ADD_ATHLETE, PERMISSION_CAN_CHANGE_ATHLETE, \
     PERMISSION_CAN_DESTROY_ATHLETE, PERMISSION_CAN_VIEW_ATHLETE, PERMISSION_CAN_ADD_ADMIN, PERMISSION_CAN_CHANGE_ADMIN, \
     PERMISSION_CAN_DESTROY_ADMIN, PERMISSION_CAN_VIEW_ADMIN, PERMISSION_CAN_ADD_CUSTOM_USER_GROUP, \
     PERMISSION_CAN_CHANGE_CUSTOM_USER_GROUP, PERMISSION_CAN_DESTROY_CUSTOM_USER_GROUP, \
     PERMISSION_CAN_VIEW_CUSTOM_USER_GROUP, PERMISSION_CAN_ADD_PERMISSION_GROUP, PERMISSION_CAN_CHANGE_PERMISSION_GROUP, \
-    PERMISSION_CAN_DESTROY_PERMISSION_GROUP, PERMISSION_CAN_VIEW_PERMISSION_GROUP
+    PERMISSION_CAN_DESTROY_PERMISSION_GROUP, PERMISSION_CAN_VIEW_PERMISSION_GROUP, invalidate_permission_cache
+from bos.versions import bump_collection_version, COLLECTION_MEASUREMENTS, COLLECTION_MEASUREMENT_TYPES, \
+    COLLECTION_RESOURCES, COLLECTION_NGOS, COLLECTION_PERMISSIONS
+from measurements.models import Measurement, MeasurementType
+from ngos.models import NGO, NGORegistrationResource, CollectionVersion
+from resources.models import Resource, EvaluationResource
 
 
 def generate_user_key():
@@ -153,6 +167,35 @@ class User(AbstractUser):
             PERMISSION_CAN_DESTROY_PERMISSION_GROUP[0:2],
             PERMISSION_CAN_VIEW_PERMISSION_GROUP[0:2],
         )
+        indexes = [
+            # Admin, coach and athlete lists of an ngo
+            models.Index(fields=['ngo', 'role', 'is_active'], name='users_ngo_role_active_idx'),
+            # Name search and autocomplete, pg_trgm GIN indexes serve both ILIKE and similarity
+            GinIndex(fields=['first_name'], name='users_first_name_trgm_idx', opclasses=['gin_trgm_ops']),
+            GinIndex(fields=['last_name'], name='users_last_name_trgm_idx', opclasses=['gin_trgm_ops']),
+        ]
+
+
+@receiver(post_save, sender=User)
+def invalidate_cached_mobile_auth_tokens(sender, instance, created, update_fields=None, **kwargs):
+    # Cached token users must reflect deactivation and any other change to the user
+    if created or (update_fields and set(update_fields) <= MOBILE_TOKEN_USER_IGNORED_FIELDS):
+        return
+    invalidate_mobile_tokens(MobileAuthToken.objects.filter(user=instance).values_list('token', flat=True))
+
+
+@receiver(m2m_changed, sender=Group.permissions.through)
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=User.user_permissions.through)
+def invalidate_cached_permissions(sender, action, **kwargs):
+    # Bumped after the commit, a concurrent request would otherwise cache the old permissions under the new version
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        transaction.on_commit(invalidate_permission_cache)
+
+
+@receiver(post_delete, sender=Group)
+def invalidate_cached_permissions_of_group(sender, instance, **kwargs):
+    transaction.on_commit(invalidate_permission_cache)
 
 
 class MobileAuthToken(models.Model):
@@ -169,6 +212,7 @@ class MobileAuthToken(models.Model):
 
 
 class UserReading(models.Model):
+    # Once the table is partitioned the user_reading_keys table keeps key unique, see user_reading_partitions
     key = models.CharField(max_length=PUBLIC_KEY_LENGTH_USER_READING,
                            default=generate_user_reading_key, unique=True)
     user = models.ForeignKey('users.User', null=False, blank=False,
@@ -184,6 +228,10 @@ class UserReading(models.Model):
     training_session_uuid = models.UUIDField(null=True, blank=True)
     evaluation_resource_uuid = models.UUIDField(null=True, blank=True)
     value = models.CharField(max_length=50, null=False, blank=False)
+    # Typed copies of value, filled according to the input type of the measurement
+    numeric_value = models.FloatField(null=True, blank=True)
+    boolean_value = models.BooleanField(null=True, blank=True)
+    text_value = models.CharField(max_length=50, null=True, blank=True)
     is_active = models.BooleanField(default=True, null=False, blank=True)
     recorded_at = models.DateTimeField(auto_now=False, auto_now_add=False, blank=False, null=False)
     creation_time = models.DateTimeField(auto_now=False, auto_now_add=True)
@@ -191,6 +239,43 @@ class UserReading(models.Model):
 
     class Meta:
         db_table = 'user_readings'
+        indexes = [
+            models.Index(fields=['measurement', 'numeric_value'], name='user_readings_numeric_idx'),
+            models.Index(fields=['measurement', 'boolean_value'], name='user_readings_boolean_idx'),
+            # Readings of an athlete for a measurement over time
+            models.Index(fields=['ngo', 'user', 'measurement', 'recorded_at'], name='user_readings_ngo_user_idx'),
+            # Active readings of an ngo, as listed by default and read by the superset views
+            models.Index(fields=['ngo', 'recorded_at'], name='user_readings_ngo_active_idx',
+                         condition=Q(is_active=True)),
+            # Readings of a session, matched on upload
+            models.Index(fields=['ngo', 'evaluation_resource_uuid'], name='user_readings_session_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.set_typed_values(self.measurement.input_type)
+        super().save(*args, **kwargs)
+
+    def set_typed_values(self, input_type):
+        self.numeric_value, self.boolean_value, self.text_value = typed_reading_values(input_type, self.value)
+
+
+def typed_reading_values(input_type, value):
+    """
+    Returns the (numeric, boolean, text) columns of a reading value, only the one
+    matching the input type is set and values that do not parse are left empty.
+    """
+    value = str(value).strip()
+    if input_type == Measurement.NUMERIC:
+        try:
+            numeric_value = float(value)
+        except ValueError:
+            return None, None, None
+        return (numeric_value if math.isfinite(numeric_value) else None), None, None
+    if input_type == Measurement.BOOLEAN:
+        return None, READING_BOOLEAN_VALUES.get(value.lower()), None
+    if input_type == Measurement.TEXT:
+        return None, None, value
+    return None, None, None
 
 
 class UserHierarchy(models.Model):
@@ -206,6 +291,20 @@ class UserHierarchy(models.Model):
         unique_together = ('parent_user', 'child_user')
 
 
+class UserHierarchyClosure(models.Model):
+    # Every ancestor/descendant pair of user_hierarchy, derived from it and kept in sync on every write
+    ancestor = models.ForeignKey('users.User', null=False, blank=False, on_delete=models.CASCADE,
+                                 related_name="descendant_closures")
+    descendant = models.ForeignKey('users.User', null=False, blank=False, on_delete=models.CASCADE,
+                                   related_name="ancestor_closures")
+    depth = models.PositiveIntegerField(null=False, blank=False)
+    creation_time = models.DateTimeField(auto_now=False, auto_now_add=True)
+
+    class Meta:
+        db_table = 'user_hierarchy_closure'
+        unique_together = ('ancestor', 'descendant')
+
+
 class UserResetPassword(models.Model):
     user = models.ForeignKey('users.User', null=False,
                              blank=False, on_delete=models.PROTECT)
@@ -295,3 +394,200 @@ class UserRequest(models.Model):
 
     class Meta:
         db_table = 'user_requests'
+
+
+class OutboxEvent(models.Model):
+    SUPERSET_CREATE_USER = 'superset_create_user'
+    EVENT_TYPES = (
+        (SUPERSET_CREATE_USER, 'Superset create user'),
+    )
+
+    event_type = models.CharField(max_length=50, choices=EVENT_TYPES, null=False, blank=False)
+    user = models.ForeignKey('users.User', null=False, blank=False, on_delete=models.CASCADE)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(null=True, blank=True)
+    available_at = models.DateTimeField(default=timezone.now)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    creation_time = models.DateTimeField(auto_now=False, auto_now_add=True)
+    last_modification_time = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'outbox_events'
+        indexes = [
+            # Pending events, in the order the worker drains them
+            models.Index(fields=['available_at'], name='outbox_events_pending_idx',
+                         condition=Q(processed_at__isnull=True)),
+        ]
+
+
+class IdempotencyKey(models.Model):
+    # Response of a request sent with an idempotency key, returned again on retries
+    key = models.CharField(max_length=LENGTH_IDEMPOTENCY_KEY, null=False, blank=False)
+    user = models.ForeignKey('users.User', null=False, blank=False, on_delete=models.CASCADE)
+    request_hash = models.CharField(max_length=64, null=False, blank=False)
+    response_status = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_data = JSONField(null=True, blank=True)
+    creation_time = models.DateTimeField(auto_now=False, auto_now_add=True)
+
+    class Meta:
+        db_table = 'idempotency_keys'
+        unique_together = ('user', 'key')
+
+
+class Tombstone(models.Model):
+    # Keys that left a synced collection, see bos.sync, or a superset reading table
+    ATHLETES = 'athletes'
+    HIERARCHY = 'hierarchy'
+    RESOURCES = 'resources'
+    GROUPS = 'groups'
+    MEASUREMENTS = 'measurements'
+    EVALUATION_RESOURCES = 'evaluation_resources'
+    READINGS = 'readings'
+    COLLECTIONS = (
+        (ATHLETES, 'Athletes'),
+        (HIERARCHY, 'Hierarchy'),
+        (RESOURCES, 'Resources'),
+        (GROUPS, 'Groups'),
+        (MEASUREMENTS, 'Measurements'),
+        (EVALUATION_RESOURCES, 'Evaluation resources'),
+        (READINGS, 'Readings'),
+    )
+
+    collection = models.CharField(max_length=50, choices=COLLECTIONS, null=False, blank=False)
+    object_key = models.CharField(max_length=50, null=False, blank=False)
+    ngo = models.ForeignKey('ngos.NGO', null=True, blank=False, on_delete=models.CASCADE)
+    deletion_time = models.DateTimeField(auto_now=False, auto_now_add=True)
+
+    class Meta:
+        db_table = 'tombstones'
+        indexes = [
+            models.Index(fields=['ngo', 'collection', 'deletion_time'], name='tombstones_ngo_collection_idx'),
+        ]
+
+
+def record_tombstones(collection, ngo_id, object_keys):
+    Tombstone.objects.bulk_create([Tombstone(collection=collection, object_key=object_key, ngo_id=ngo_id)
+                                   for object_key in set(object_keys)])
+
+
+@receiver(post_delete, sender=User)
+def record_user_tombstone(sender, instance, **kwargs):
+    if instance.role == User.ATHLETE:
+        record_tombstones(Tombstone.ATHLETES, instance.ngo_id, [instance.key])
+
+
+@receiver(post_delete, sender=UserReading)
+def record_user_reading_tombstone(sender, instance, **kwargs):
+    record_tombstones(Tombstone.READINGS, instance.ngo_id, [instance.key])
+
+
+@receiver(post_delete, sender=Measurement)
+def record_measurement_tombstone(sender, instance, **kwargs):
+    record_tombstones(Tombstone.MEASUREMENTS, instance.ngo_id, [instance.key])
+
+
+@receiver(post_delete, sender=Resource)
+def record_resource_tombstone(sender, instance, **kwargs):
+    record_tombstones(Tombstone.RESOURCES, instance.ngo_id, [instance.key])
+
+
+@receiver(post_delete, sender=UserResource)
+@receiver(post_delete, sender=NGORegistrationResource)
+def record_resource_link_tombstone(sender, instance, **kwargs):
+    # The resource may only have been visible through the deleted link
+    resource = Resource.objects.filter(id=instance.resource_id).values('key', 'ngo_id').first()
+    if resource:
+        record_tombstones(Tombstone.RESOURCES, resource['ngo_id'], [resource['key']])
+
+
+@receiver(post_delete, sender=EvaluationResource)
+def record_evaluation_resource_tombstone(sender, instance, **kwargs):
+    record_tombstones(Tombstone.EVALUATION_RESOURCES, instance.ngo_id, [instance.key])
+
+
+@receiver(pre_delete, sender=UserGroup)
+def record_user_group_tombstone(sender, instance, **kwargs):
+    # Memberships are deleted along with the group without m2m_changed, so resources are read beforehand
+    record_tombstones(Tombstone.GROUPS, instance.ngo_id, [instance.key])
+    record_tombstones(Tombstone.RESOURCES, instance.ngo_id, instance.resources.values_list('key', flat=True))
+
+
+@receiver(m2m_changed, sender=UserGroup.users.through)
+@receiver(m2m_changed, sender=UserGroup.resources.through)
+def record_user_group_changes(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Bumps last_modification_time of the groups whose users or resources change, so
+    they are synced again, and records tombstones for what members may lose access to.
+    """
+    if action not in ('post_add', 'pre_remove', 'pre_clear'):
+        return
+    if not reverse:
+        user_group_ids = [instance.id]
+    elif pk_set is not None:
+        user_group_ids = list(pk_set)
+    else:
+        user_group_ids = list(sender.objects.filter(**{instance._meta.model_name + '_id': instance.id})
+                              .values_list('usergroup_id', flat=True))
+    user_groups = UserGroup.objects.filter(id__in=user_group_ids)
+    user_groups.update(last_modification_time=timezone.now())
+    if action == 'post_add':
+        return
+
+    user_group_keys = defaultdict(set)
+    resource_keys = defaultdict(set)
+    for ngo_id, user_group_key, resource_key in user_groups.values_list('ngo_id', 'key', 'resources__key'):
+        user_group_keys[ngo_id].add(user_group_key)
+        if resource_key is not None:
+            resource_keys[ngo_id].add(resource_key)
+    if sender is UserGroup.users.through:
+        for ngo_id, keys in user_group_keys.items():
+            record_tombstones(Tombstone.GROUPS, ngo_id, keys)
+    for ngo_id, keys in resource_keys.items():
+        record_tombstones(Tombstone.RESOURCES, ngo_id, keys)
+
+
+@receiver(post_save, sender=Measurement)
+@receiver(post_delete, sender=Measurement)
+def bump_measurements_version(sender, instance, **kwargs):
+    bump_collection_version(COLLECTION_MEASUREMENTS, instance.ngo_id)
+
+
+@receiver(m2m_changed, sender=Measurement.types.through)
+def bump_measurement_types_of_measurements_version(sender, instance, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_collection_version(COLLECTION_MEASUREMENTS, instance.ngo_id)
+
+
+@receiver(post_save, sender=MeasurementType)
+@receiver(post_delete, sender=MeasurementType)
+def bump_measurement_types_version(sender, instance, **kwargs):
+    # Measurements are serialized along with their types
+    bump_collection_version(COLLECTION_MEASUREMENT_TYPES, instance.ngo_id)
+    bump_collection_version(COLLECTION_MEASUREMENTS, instance.ngo_id)
+
+
+@receiver(post_save, sender=Resource)
+@receiver(post_delete, sender=Resource)
+@receiver(post_save, sender=NGORegistrationResource)
+@receiver(post_delete, sender=NGORegistrationResource)
+def bump_resources_version(sender, instance, **kwargs):
+    bump_collection_version(COLLECTION_RESOURCES, instance.ngo_id)
+
+
+@receiver(post_save, sender=NGO)
+@receiver(post_delete, sender=NGO)
+def bump_ngos_version(sender, instance, **kwargs):
+    bump_collection_version(COLLECTION_NGOS)
+
+
+@receiver(post_save, sender=Permission)
+@receiver(post_delete, sender=Permission)
+def bump_permissions_version(sender, **kwargs):
+    bump_collection_version(COLLECTION_PERMISSIONS)
+
+
+@receiver(post_migrate)
+def bump_permissions_version_after_migrate(sender, using, plan=None, **kwargs):
+    # Permissions are created in bulk by migrate, which sends no post_save
+    if plan and CollectionVersion._meta.db_table in connections[using].introspection.table_names():
+        bump_collection_version(COLLECTION_PERMISSIONS)
@@ -15,9 +15,9 @@
 #
 
 from django.contrib.auth.models import Group, Permission
-from rest_framework.fields import CharField, BooleanField
+from rest_framework.fields import CharField, BooleanField, DateTimeField, UUIDField
 from rest_framework.relations import SlugRelatedField
-from rest_framework.serializers import ModelSerializer
+from rest_framework.serializers import ModelSerializer, Serializer
 
 from measurements.models import Measurement
 from measurements.serializers import MeasurementSerializer
@@ -26,6 +26,17 @@ from resources.models import Resource
 from resources.serializers import ResourceSerializer, ResourceDetailSerializer
 from users.models import User, UserHierarchy, generate_username, UserReading, UserResource, UserGroup, UserRequest
 
+USER_READING_SLUG_RELATIONS = ('user', 'by_user', 'entered_by', 'ngo', 'measurement')
+
+
+def select_user_reading_relations(queryset):
+    # Joins the related rows rendered as slugs and loads only their keys, so a page of readings is one query
+    fields = [field.attname for field in UserReading._meta.concrete_fields]
+    fields += ['%s__key' % relation for relation in USER_READING_SLUG_RELATIONS]
+    # Read by UserReading.save when an updated reading is saved
+    fields.append('measurement__input_type')
+    return queryset.select_related(*USER_READING_SLUG_RELATIONS).only(*fields)
+
 
 class UserSerializer(ModelSerializer):
     lookup_field = 'key'
@@ -131,6 +142,11 @@ class UserReadingSerializer(ModelSerializer):
     class Meta:
         model = UserReading
         exclude = ('id',)
+        read_only_fields = ('numeric_value', 'boolean_value', 'text_value')
+
+    @staticmethod
+    def setup_eager_loading(queryset):
+        return select_user_reading_relations(queryset)
 
 
 class UserReadingWriteOnlySerializer(ModelSerializer):
@@ -147,6 +163,19 @@ class UserReadingWriteOnlySerializer(ModelSerializer):
     class Meta:
         model = UserReading
         exclude = ('id',)
+        read_only_fields = ('numeric_value', 'boolean_value', 'text_value')
+
+
+class UserReadingBulkWriteOnlySerializer(Serializer):
+    # Keys are resolved by the caller in bulk, so no field here hits the database
+    user = CharField()
+    ngo = CharField()
+    measurement = CharField()
+    training_session_uuid = UUIDField(required=False, allow_null=True)
+    evaluation_resource_uuid = UUIDField(required=False, allow_null=True)
+    value = CharField(max_length=50)
+    recorded_at = DateTimeField()
+    is_active = BooleanField(default=True)
 
 
 class UserReadingReadOnlySerializer(ModelSerializer):
@@ -163,6 +192,10 @@ class UserReadingReadOnlySerializer(ModelSerializer):
         model = UserReading
         exclude = ('id',)
 
+    @staticmethod
+    def setup_eager_loading(queryset):
+        return select_user_reading_relations(queryset)
+
 
 class UserGroupReadOnlySerializer(ModelSerializer):
     lookup_field = 'key'
@@ -259,6 +292,16 @@ class UserGroupDetailSerializer(ModelSerializer):
         exclude = ('id',)
 
 
+class UserGroupSyncSerializer(ModelSerializer):
+    users = SlugRelatedField(slug_field='key', many=True, read_only=True)
+    resources = SlugRelatedField(slug_field='key', many=True, read_only=True)
+    ngo = SlugRelatedField(slug_field='key', read_only=True)
+
+    class Meta:
+        model = UserGroup
+        exclude = ('id',)
+
+
 class UserRequestReadOnlySerializer(ModelSerializer):
     lookup_field = 'key'
     pk_field = 'key'
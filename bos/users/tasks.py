@@ -0,0 +1,106 @@
+#  Copyright (c) 2019 Maverick Labs
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as,
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+from datetime import timedelta
+
+from celery import shared_task
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from kombu.exceptions import OperationalError
+
+from bos.sync import TOMBSTONE_RETENTION_DAYS
+from bos.utils import open_superset_session_and_create_user
+from users.models import OutboxEvent, IdempotencyKey, Tombstone
+
+OUTBOX_MAX_ATTEMPTS = getattr(settings, "OUTBOX_MAX_ATTEMPTS", 10)
+OUTBOX_RETRY_DELAY = getattr(settings, "OUTBOX_RETRY_DELAY", 30)
+OUTBOX_LEASE_SECONDS = getattr(settings, "OUTBOX_LEASE_SECONDS", 300)
+IDEMPOTENCY_KEY_RETENTION_DAYS = getattr(settings, "IDEMPOTENCY_KEY_RETENTION_DAYS", 7)
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_EVENT_HANDLERS = {
+    OutboxEvent.SUPERSET_CREATE_USER: open_superset_session_and_create_user,
+}
+
+
+def _claim_next_outbox_event():
+    with transaction.atomic():
+        # Locked rows are skipped, so concurrent workers never claim the same event
+        event = OutboxEvent.objects.select_for_update(skip_locked=True, of=('self',)) \
+            .select_related('user', 'user__ngo') \
+            .filter(processed_at__isnull=True, attempts__lt=OUTBOX_MAX_ATTEMPTS, available_at__lte=timezone.now()) \
+            .order_by('available_at').first()
+        if not event:
+            return None
+
+        # The lease hands the event to another worker only when this one dies before recording the result
+        event.attempts += 1
+        event.available_at = timezone.now() + timedelta(seconds=OUTBOX_LEASE_SECONDS)
+        event.save(update_fields=['attempts', 'available_at', 'last_modification_time'])
+        return event
+
+
+def _process_next_outbox_event():
+    event = _claim_next_outbox_event()
+    if not event:
+        return False
+
+    # The claim is committed, the handler runs without holding a transaction or row locks
+    try:
+        is_successful = OUTBOX_EVENT_HANDLERS[event.event_type](event.user)
+        error = None if is_successful else 'Handler failed'
+    except Exception as e:
+        error = repr(e)
+
+    if error:
+        event.last_error = error
+        event.available_at = timezone.now() + timedelta(seconds=OUTBOX_RETRY_DELAY * 2 ** (event.attempts - 1))
+        event.save(update_fields=['last_error', 'available_at', 'last_modification_time'])
+    else:
+        event.processed_at = timezone.now()
+        event.save(update_fields=['processed_at', 'last_modification_time'])
+    return True
+
+
+@shared_task
+def process_outbox_events():
+    while _process_next_outbox_event():
+        pass
+
+
+def enqueue_outbox_processing():
+    # Events stay in the outbox when the broker is down, the periodic run picks them up
+    try:
+        process_outbox_events.delay()
+    except OperationalError as e:
+        logger.warning('Could not enqueue outbox processing: %s', e)
+
+
+@shared_task
+def purge_idempotency_keys():
+    # Retries come within minutes, keys only have to outlive the longest time a device stays offline
+    IdempotencyKey.objects.filter(
+        creation_time__lt=timezone.now() - timedelta(days=IDEMPOTENCY_KEY_RETENTION_DAYS)).delete()
+
+
+@shared_task
+def purge_tombstones():
+    # Syncs from older watermarks are rejected, so their tombstones are never read again
+    Tombstone.objects.filter(
+        deletion_time__lt=timezone.now() - timedelta(days=TOMBSTONE_RETENTION_DAYS)).delete()
@@ -1,3 +1,433 @@
-from django.test import TestCase
+import json
+import threading
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
+from urllib.parse import urlsplit, parse_qs
 
-# Create your tests here.
+from django.contrib.auth.models import update_last_login, Group, Permission
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection, transaction, IntegrityError
+from django.test import TestCase, RequestFactory
+from django.urls import resolve
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from bos.authentication import MobileAuthentication
+from bos.cache import mobile_token_cache, _mobile_token_cache_key
+from bos.instrumentation import route_metrics
+from bos.permissions import get_permissions_version, get_permission_bits, PERMISSION_BITS, \
+    PERMISSION_CAN_VIEW_ATHLETE
+from bos.utils import open_superset_session_and_create_user, open_superset_session_and_update_password
+from ngos.models import NGO
+from users.management.commands import superset_api
+from users.management.commands.superset_api import SUPERSET_BASE_TABLE_NAME, GAMMA_ROLE, RetryingSession, get_users, \
+    create_superset_user
+from measurements.models import Measurement
+from users.models import User, MobileAuthToken, UserReading, OutboxEvent, Tombstone
+from users.tasks import process_outbox_events, purge_tombstones, OUTBOX_EVENT_HANDLERS
+
+
+class MobileAuthenticationTestCase(TestCase):
+
+    def setUp(self):
+        mobile_token_cache.clear()
+        self.ngo = NGO.objects.create(name='Test ngo')
+        self.user = User.objects.create(username='coach', first_name='coach', last_name='coach', ngo=self.ngo,
+                                        role=User.COACH, gender=User.MALE)
+        self.token = MobileAuthToken.objects.create(user=self.user,
+                                                    expiry_date=timezone.now() + timedelta(days=1)).token
+
+    def authenticate(self, token=None):
+        request = RequestFactory().get('/', HTTP_AUTHORIZATION='Token ' + (token or self.token))
+        return MobileAuthentication().authenticate(request)[0]
+
+    def test_cached_user_is_not_shared(self):
+        user = self.authenticate()
+        user.first_name = 'changed'
+        user._perm_cache = set()
+
+        with self.assertNumQueries(0):
+            cached_user = self.authenticate()
+        self.assertIsNot(cached_user, user)
+        self.assertEqual(cached_user.first_name, 'coach')
+        self.assertFalse(hasattr(cached_user, '_perm_cache'))
+        with self.assertNumQueries(0):
+            self.assertEqual(cached_user.ngo.key, self.ngo.key)
+        self.assertIsNot(self.authenticate().ngo, cached_user.ngo)
+
+    def test_only_relevant_user_changes_invalidate(self):
+        self.authenticate()
+        update_last_login(None, self.user)
+        with self.assertNumQueries(0):
+            self.authenticate()
+
+        self.user.is_active = False
+        self.user.save()
+        with self.assertNumQueries(1):
+            self.assertFalse(self.authenticate().is_active)
+
+    def test_shared_cache_is_the_only_tier(self):
+        with mock.patch('bos.cache.MOBILE_TOKEN_CACHE_BACKEND', 'default'):
+            caches['default'].clear()
+            self.authenticate()
+            with self.assertNumQueries(0):
+                self.authenticate()
+            self.assertIsNone(mobile_token_cache.get(_mobile_token_cache_key(self.token)))
+
+            response = APIClient().post('/mobile_logout', HTTP_AUTHORIZATION='Token ' + self.token)
+            self.assertEqual(response.status_code, 200)
+            self.assertIsNone(self.authenticate())
+
+    def test_inactive_user_is_not_cached(self):
+        self.user.is_active = False
+        self.user.save()
+        self.authenticate()
+        with self.assertNumQueries(1):
+            self.assertFalse(self.authenticate().is_active)
+
+    def test_refreshed_token_expires(self):
+        self.authenticate()
+        client = APIClient()
+        response = client.post('/refresh_mobile_token', HTTP_AUTHORIZATION='Token ' + self.token)
+        self.assertEqual(response.status_code, 200)
+
+        self.assertIsNone(self.authenticate())
+        self.assertEqual(self.authenticate(response.data['token']).id, self.user.id)
+
+
+class PermissionCacheTestCase(TestCase):
+
+    @mock.patch('bos.permissions.PERMISSION_CACHE_BACKEND', 'default')
+    def test_permissions_version_changes_on_commit(self):
+        user = User.objects.create(username='coach', first_name='coach', last_name='coach', role=User.COACH,
+                                   gender=User.MALE)
+        permissions_version = get_permissions_version()
+        user.groups.add(Group.objects.create(name='coaches'))
+        self.assertEqual(permissions_version, get_permissions_version())
+
+        # The test transaction is never committed, run its commit callbacks
+        for savepoint_ids, callback in connection.run_on_commit:
+            callback()
+        self.assertNotEqual(permissions_version, get_permissions_version())
+
+    def test_permissions_are_not_cached_without_shared_backend(self):
+        user = User.objects.create(username='coach', first_name='coach', last_name='coach', role=User.COACH,
+                                   gender=User.MALE)
+        self.assertEqual(get_permission_bits(user), 0)
+        group = Group.objects.create(name='coaches')
+        group.permissions.add(Permission.objects.get(codename=PERMISSION_CAN_VIEW_ATHLETE[0]))
+        # No commit callback runs, the change is still seen
+        user.groups.add(group)
+        self.assertEqual(get_permission_bits(user), PERMISSION_BITS[PERMISSION_CAN_VIEW_ATHLETE[2]])
+
+
+class ReadingQueryBudgetTestCase(TestCase):
+    # Queries per request, whatever the number of readings
+
+    def setUp(self):
+        self.ngo = NGO.objects.create(name='Test ngo')
+        self.admin = User.objects.create(username='admin', first_name='admin', last_name='admin', ngo=self.ngo,
+                                         role=User.ADMIN, gender=User.MALE, is_superuser=True)
+        self.athlete = User.objects.create(username='athlete', first_name='athlete', last_name='athlete',
+                                           ngo=self.ngo, role=User.ATHLETE, gender=User.MALE)
+        measurement = Measurement.objects.create(label='Push ups', input_type=Measurement.NUMERIC, ngo=self.ngo)
+        self.user_readings = [UserReading.objects.create(user=self.athlete, ngo=self.ngo, by_user=self.admin,
+                                                         entered_by=self.admin, measurement=measurement,
+                                                         value=str(index), recorded_at=timezone.now())
+                              for index in range(10)]
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def test_list(self):
+        with self.assertNumQueries(2):
+            response = self.client.get('/readings/?page_size=100')
+        self.assertEqual(len(response.data['results']), 10)
+
+    def test_list_serializer_is_timed(self):
+        metrics = route_metrics[(resolve('/readings/').view_name, 'GET')]
+        serializer_time = metrics.serializer_time
+
+        self.client.get('/readings/?page_size=100')
+        self.assertGreater(metrics.serializer_time, serializer_time)
+
+    def test_user_readings(self):
+        with self.assertNumQueries(3):
+            response = self.client.get('/users/%s/readings/' % self.athlete.key)
+        self.assertEqual(len(response.data), 10)
+
+    def test_retrieve(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('/readings/%s/' % self.user_readings[0].key)
+        self.assertEqual(response.data['measurement'], self.user_readings[0].measurement.key)
+
+    def test_update(self):
+        with self.assertNumQueries(2):
+            response = self.client.put('/readings/%s/' % self.user_readings[0].key, {'value': '20', 'is_active': True},
+                                       format='json')
+        self.assertEqual(response.data['value'], '20')
+
+
+class ReadingBulkTestCase(TestCase):
+
+    def test_readings_of_other_ngos_are_rejected(self):
+        ngo = NGO.objects.create(name='Test ngo')
+        other_ngo = NGO.objects.create(name='Other ngo')
+        coach = User.objects.create(username='coach', first_name='coach', last_name='coach', ngo=ngo,
+                                    role=User.COACH, gender=User.MALE, is_superuser=True)
+        other_athlete = User.objects.create(username='athlete', first_name='athlete', last_name='athlete',
+                                            ngo=other_ngo, role=User.ATHLETE, gender=User.MALE)
+        other_measurement = Measurement.objects.create(label='Push ups', input_type=Measurement.NUMERIC,
+                                                       ngo=other_ngo)
+        client = APIClient()
+        client.force_authenticate(coach)
+
+        response = client.post('/readings/bulk/', [{'user': other_athlete.key, 'ngo': other_ngo.key,
+                                                    'measurement': other_measurement.key, 'value': '10',
+                                                    'recorded_at': timezone.now().isoformat()}], format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data[0]['status'], 403)
+        self.assertIn('ngo', response.data[0]['errors'])
+        self.assertFalse(UserReading.objects.exists())
+
+
+class UserReadingPartitionsTestCase(TestCase):
+
+    def test_partition_takes_rows_from_default_partition(self):
+        ngo = NGO.objects.create(name='Test ngo')
+        user = User.objects.create(username='coach', first_name='coach', last_name='coach', ngo=ngo,
+                                   role=User.COACH, gender=User.MALE)
+        measurement = Measurement.objects.create(label='Push ups', input_type=Measurement.NUMERIC, ngo=ngo)
+        call_command('user_reading_partitions', '--convert', '--months-ahead', '0')
+
+        # Lands in the default partition, as its month has no partition yet
+        recorded_at = timezone.now().replace(day=15) + timedelta(days=62)
+        user_reading = UserReading.objects.create(user=user, ngo=ngo, by_user=user, entered_by=user,
+                                                  measurement=measurement, value='10', recorded_at=recorded_at)
+        call_command('user_reading_partitions', '--months-ahead', '3')
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT tableoid::regclass::text FROM user_readings WHERE id = %s", [user_reading.id])
+            self.assertEqual(cursor.fetchone()[0], 'user_readings_p%04d_%02d' % (recorded_at.year,
+                                                                                 recorded_at.month))
+
+        # The moved reading kept its key, in any partition
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            UserReading.objects.create(key=user_reading.key, user=user, ngo=ngo, by_user=user, entered_by=user,
+                                       measurement=measurement, value='10', recorded_at=timezone.now())
+        user_reading.delete()
+        UserReading.objects.create(key=user_reading.key, user=user, ngo=ngo, by_user=user, entered_by=user,
+                                   measurement=measurement, value='10', recorded_at=timezone.now())
+
+
+class ReadingExportTestCase(TestCase):
+
+    def test_export_without_ngo(self):
+        superuser = User.objects.create(username='admin', first_name='admin', last_name='admin', role=User.ADMIN,
+                                        gender=User.MALE, is_superuser=True)
+        client = APIClient()
+        client.force_authenticate(superuser)
+        self.assertEqual(client.get('/readings/export/').status_code, 400)
+
+    def test_streamed_export_is_measured(self):
+        ngo = NGO.objects.create(name='Test ngo')
+        superuser = User.objects.create(username='admin', first_name='admin', last_name='admin', role=User.ADMIN,
+                                        gender=User.MALE, is_superuser=True, ngo=ngo)
+        client = APIClient()
+        client.force_authenticate(superuser)
+        metrics = route_metrics[(resolve('/readings/export/').view_name, 'GET')]
+        count, query_count = metrics.count, metrics.query_count
+
+        response = client.get('/readings/export/')
+        self.assertTrue(response.streaming)
+        self.assertEqual(metrics.count, count)
+        b''.join(response.streaming_content)
+        self.assertEqual(metrics.count, count + 1)
+        self.assertGreater(metrics.query_count, query_count)
+
+
+class SupersetInitTestCase(TestCase):
+
+    def test_deleted_reading_is_removed(self):
+        ngo = NGO.objects.create(name='Test ngo')
+        user = User.objects.create(username='coach', first_name='coach', last_name='coach', ngo=ngo,
+                                   role=User.COACH, gender=User.MALE)
+        measurement = Measurement.objects.create(label='Push ups', input_type=Measurement.NUMERIC, ngo=ngo)
+        user_readings = [UserReading.objects.create(user=user, ngo=ngo, by_user=user, entered_by=user,
+                                                    measurement=measurement, value=str(index),
+                                                    recorded_at=timezone.now()) for index in range(2)]
+        call_command('superset_init')
+        user_readings[0].delete()
+        call_command('superset_init')
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT key FROM %s" % connection.ops.quote_name(SUPERSET_BASE_TABLE_NAME % ngo.key))
+            self.assertEqual([row[0] for row in cursor.fetchall()], [user_readings[1].key])
+
+
+class FakeSupersetHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        return
+
+    def respond(self, status, data=None):
+        body = json.dumps(data or {}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self, method):
+        server = self.server
+        url = urlsplit(self.path)
+        form = parse_qs(self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode())
+        server.requests.append((method, url.path))
+        if server.failures:
+            server.failures -= 1
+            return self.respond(503)
+        if url.path == '/login/':
+            return self.respond(200)
+        if url.path == '/roles/api/read':
+            return self.respond(200, {'result': [{'name': name, 'permissions': []} for name in server.roles],
+                                      'pks': list(server.roles.values())})
+        if url.path == '/users/api/read':
+            return self.respond(200, {'result': list(server.users.values()), 'pks': list(server.users)})
+        if url.path == '/users/api/create':
+            server.users[len(server.users) + 1] = {'username': form['username'][0], 'email': form['email'][0],
+                                                   'first_name': form['first_name'][0],
+                                                   'last_name': form['last_name'][0], 'active': True,
+                                                   'roles': [int(pk) for pk in form['roles']]}
+            server.passwords[len(server.users)] = form['password'][0]
+            return self.respond(200)
+        if url.path.startswith('/users/edit/'):
+            server.users[int(url.path.rsplit('/', 1)[1])]['first_name'] = form['first_name'][0]
+            return self.respond(200)
+        if url.path == '/resetpassword/form':
+            server.passwords[int(parse_qs(url.query)['pk'][0])] = form['password'][0]
+            return self.respond(200)
+        return self.respond(404)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+
+class SupersetApiTestCase(TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), FakeSupersetHandler)
+        self.server.requests = []
+        self.server.failures = 0
+        self.server.roles = {GAMMA_ROLE: 1}
+        self.server.users = {}
+        self.server.passwords = {}
+        self.server_url = 'http://127.0.0.1:%s/' % self.server.server_port
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        patcher = mock.patch.object(superset_api, 'SUPERSET_API_URL', self.server_url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        ngo = NGO.objects.create(name='Test ngo')
+        self.server.roles[ngo.key] = 2
+        self.admin = User.objects.create(username='admin', first_name='admin', last_name='admin', ngo=ngo,
+                                         role=User.ADMIN, gender=User.MALE, email='admin@example.com')
+
+    def test_create_user(self):
+        self.assertTrue(open_superset_session_and_create_user(self.admin))
+
+        self.assertEqual(self.server.requests[0], ('POST', '/login/'))
+        self.assertEqual([user['username'] for user in self.server.users.values()], ['admin'])
+        self.assertEqual(sorted(self.server.users[1]['roles']), [1, 2])
+
+    def test_update_user(self):
+        open_superset_session_and_create_user(self.admin)
+        self.admin.first_name = 'changed'
+
+        self.assertTrue(open_superset_session_and_create_user(self.admin))
+        self.assertIn(('POST', '/users/edit/1'), self.server.requests)
+        self.assertEqual(self.server.users[1]['first_name'], 'changed')
+        self.assertEqual(len(self.server.users), 1)
+
+    def test_update_password(self):
+        self.assertTrue(open_superset_session_and_update_password(self.admin, 'first password'))
+        self.assertEqual(self.server.passwords, {1: 'first password'})
+
+        self.assertTrue(open_superset_session_and_update_password(self.admin, 'second password'))
+        self.assertIn(('POST', '/resetpassword/form'), self.server.requests)
+        self.assertEqual(self.server.passwords, {1: 'second password'})
+
+    def test_server_errors_are_retried(self):
+        self.server.failures = 2
+        with RetryingSession() as session:
+            self.assertEqual(get_users(session), (True, []))
+        self.assertEqual(self.server.requests, [('GET', '/users/api/read')] * 3)
+
+    def test_posts_are_not_retried_once_sent(self):
+        self.server.failures = 1
+        with RetryingSession() as session:
+            self.assertFalse(create_superset_user(self.admin, [], session))
+        self.assertEqual(self.server.requests, [('POST', '/users/api/create')])
+
+    def test_created_users_without_password_are_logged(self):
+        with self.assertLogs(superset_api.logger, 'WARNING') as logs:
+            self.assertTrue(open_superset_session_and_create_user(self.admin))
+        self.assertIn('admin', logs.output[0])
+
+
+class OutboxEventTestCase(TestCase):
+
+    def setUp(self):
+        ngo = NGO.objects.create(name='Test ngo')
+        admin = User.objects.create(username='admin', first_name='admin', last_name='admin', ngo=ngo,
+                                    role=User.ADMIN, gender=User.MALE)
+        self.event = OutboxEvent.objects.create(event_type=OutboxEvent.SUPERSET_CREATE_USER, user=admin)
+
+    def process(self, handler):
+        with mock.patch.dict(OUTBOX_EVENT_HANDLERS, {OutboxEvent.SUPERSET_CREATE_USER: handler}):
+            process_outbox_events()
+        self.event.refresh_from_db()
+
+    def test_event_is_leased_while_handled(self):
+        def handler(user):
+            event = OutboxEvent.objects.get(id=self.event.id)
+            self.assertEqual(event.attempts, 1)
+            self.assertGreater(event.available_at, timezone.now())
+            return True
+
+        self.process(handler)
+        self.assertIsNotNone(self.event.processed_at)
+
+    def test_failed_event_is_retried_later(self):
+        self.process(lambda user: False)
+
+        self.assertIsNone(self.event.processed_at)
+        self.assertEqual(self.event.attempts, 1)
+        self.assertEqual(self.event.last_error, 'Handler failed')
+        self.assertGreater(self.event.available_at, timezone.now())
+
+
+class SyncTestCase(TestCase):
+
+    def setUp(self):
+        self.ngo = NGO.objects.create(name='Test ngo')
+        self.coach = User.objects.create(username='coach', first_name='coach', last_name='coach', ngo=self.ngo,
+                                         role=User.COACH, gender=User.MALE)
+        self.client = APIClient()
+        self.client.force_authenticate(self.coach)
+
+    def test_sync_requires_view_athlete_permission(self):
+        self.assertEqual(self.client.get('/sync/').status_code, 403)
+
+    def test_purge_tombstones(self):
+        Tombstone.objects.create(collection=Tombstone.ATHLETES, object_key='old', ngo=self.ngo)
+        Tombstone.objects.update(deletion_time=timezone.now() - timedelta(days=365))
+        Tombstone.objects.create(collection=Tombstone.ATHLETES, object_key='new', ngo=self.ngo)
+
+        purge_tombstones()
+        self.assertEqual(list(Tombstone.objects.values_list('object_key', flat=True)), ['new'])
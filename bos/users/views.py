@@ -13,6 +13,7 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import uuid
 from datetime import timedelta, timezone, datetime
 
 from django.contrib.auth import authenticate, login, logout
@@ -23,6 +24,7 @@ from django.core.exceptions import ValidationError
 from django.db import transaction, DatabaseError, IntegrityError
 from django.db.models import Q
 from django.db.models.deletion import ProtectedError
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.utils.translation import gettext as _
 from rest_framework.decorators import action, api_view, permission_classes
@@ -30,10 +32,15 @@ from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
 from rest_framework.viewsets import ViewSet
 
+from bos.authentication import get_mobile_token
+from bos.cache import invalidate_mobile_tokens
 from bos.constants import METHOD_GET
 from bos.constants import METHOD_POST
+from bos.constants import BULK_READINGS_MAX_COUNT, BULK_CREATE_BATCH_SIZE, EXPORT_FORMAT_CSV, EXPORT_FORMAT_PARQUET
 from bos.defaults import DEFAULT_PERMISSIONS_BLACKLIST
 from bos.exceptions import ValidationException
+from bos.export import stream_csv, stream_parquet, EXPORT_BATCH_SIZE, EXPORT_STRING, EXPORT_FLOAT, EXPORT_BOOLEAN, \
+    EXPORT_TIMESTAMP
 from bos.pagination import BOSPageNumberPagination
 from bos.permissions import has_permission, PERMISSION_CAN_VIEW_ADMIN, PERMISSION_CAN_ADD_ADMIN, \
     PERMISSION_CAN_DESTROY_ADMIN, PERMISSION_CAN_CHANGE_ADMIN, PERMISSION_CAN_VIEW_ATHLETE, PERMISSION_CAN_ADD_ATHLETE, \
@@ -43,24 +50,30 @@ from bos.permissions import has_permission, PERMISSION_CAN_VIEW_ADMIN, PERMISSIO
     PERMISSION_CAN_CHANGE_CUSTOM_USER_GROUP, PERMISSION_CAN_DESTROY_CUSTOM_USER_GROUP, \
     PERMISSION_CAN_VIEW_PERMISSION_GROUP, PERMISSION_CAN_DESTROY_PERMISSION_GROUP, \
     PERMISSION_CAN_CHANGE_PERMISSION_GROUP, PERMISSION_CAN_ADD_PERMISSION_GROUP, PERMISSION_CAN_VIEW_READING, \
-    PERMISSION_CAN_DESTROY_READING, PERMISSION_CAN_ADD_READING, CanViewPermissionGroup, CanChangeCoach
+    PERMISSION_CAN_DESTROY_READING, PERMISSION_CAN_ADD_READING, CanViewPermissionGroup, CanChangeCoach, \
+    CanViewAthlete
+from bos.search import autocomplete
+from bos.sync import sync_collections
+from bos.versions import conditional_on_collections, COLLECTION_PERMISSIONS
 from bos.utils import user_filters_from_request, get_ngo_group_name, user_group_filters_from_request, \
     convert_validation_error_into_response_error, error_400_json, request_user_belongs_to_user_ngo, error_403_json, \
-    request_user_belongs_to_user_group_ngo, find_athletes_under_user, \
+    request_user_belongs_to_user_group_ngo, find_athletes_under_user, add_user_hierarchy_closure, \
     user_reading_filters_from_request, request_status, request_user_belongs_to_reading, error_checkone, \
-    user_request_filters_from_request, request_user_belongs_to_user_request_ngo, open_superset_session_and_create_user, \
-    error_file_extension_json, error_protected_user, error_protected_group, convert_message_error
+    user_request_filters_from_request, request_user_belongs_to_user_request_ngo, \
+    open_superset_session_and_update_password, build_user_readings, \
+    error_file_extension_json, error_protected_user, error_protected_group, convert_message_error, \
+    resource_fields_from_request, project_resources
 from measurements.models import Measurement
 from resources.models import Resource, EvaluationResource
-from resources.serializers import ResourceDetailSerializer, EvaluationResourceDetailSerializer
-from users.management.commands.superset_api import update_superset_user_password
-from users.models import User, UserGroup, UserResource, MobileAuthToken, UserReading, UserRequest
+from resources.serializers import ResourceProjectionSerializer, EvaluationResourceDetailSerializer
+from users.models import User, UserGroup, UserResource, MobileAuthToken, UserReading, UserRequest, OutboxEvent
 from users.serializers import UserSerializer, PermissionGroupDetailSerializer, PermissionSerializer, AthleteSerializer, \
     UserReadingSerializer, CoachSerializer, PermissionGroupSerializer, \
     UserGroupReadOnlySerializer, AdminSerializer, UserResourceSerializer, UserResourceDetailSerializer, \
     UserGroupDetailSerializer, UserReadingWriteOnlySerializer, UserReadingReadOnlySerializer, \
-    UserHierarchyWriteSerializer, \
+    UserHierarchyWriteSerializer, UserReadingBulkWriteOnlySerializer, \
     UserEditRestrictedDetailSerializer, UserRequestReadOnlySerializer, UserRequestWriteOnlySerializer
+from users.tasks import enqueue_outbox_processing
 
 
 class UserViewSet(ViewSet):
@@ -70,10 +83,15 @@ class UserViewSet(ViewSet):
             user = User.objects.get(key=pk)
         except User.DoesNotExist:
             return Response(status=404)
-        queryset = Resource.objects.filter(Q(is_active=True) & (
+        try:
+            fields = resource_fields_from_request(request.GET)
+        except ValidationException as e:
+            return Response(status=400, data=e.errors)
+
+        queryset = project_resources(Resource.objects.filter(Q(is_active=True) & (
                 Q(userresource__user=user) | Q(ngoregistrationresource__ngo=request.user.ngo) |
-                Q(usergroup__users__in=[user]))).distinct()
-        serializer = ResourceDetailSerializer(queryset, many=True)
+                Q(usergroup__users__in=[user]))).distinct(), fields)
+        serializer = ResourceProjectionSerializer(queryset, many=True, fields=fields)
         return Response(data=serializer.data)
 
     @action(detail=True, methods=[METHOD_GET], permission_classes=[IsAuthenticated])
@@ -113,7 +131,7 @@ class UserViewSet(ViewSet):
             user.save()
 
             if user.role == User.ADMIN:
-                if not update_superset_user_password(user):
+                if not open_superset_session_and_update_password(user, password):
                     raise ValidationException([{'message': 'Superset user password update failed'}])
             return Response(status=201)
         except ValidationError as e:
@@ -143,7 +161,7 @@ class UserViewSet(ViewSet):
             user.save()
 
             if user.role == User.ADMIN:
-                if not update_superset_user_password(user):
+                if not open_superset_session_and_update_password(user, password):
                     raise ValidationException([{'message': 'Superset user password update failed'}])
             return Response(status=201)
         except ValidationError as e:
@@ -179,7 +197,7 @@ class UserViewSet(ViewSet):
         if not request_user_belongs_to_user_ngo(request, user):
             return Response(status=403, data=error_403_json())
 
-        queryset = UserReading.objects.filter(user=user)
+        queryset = UserReadingReadOnlySerializer.setup_eager_loading(UserReading.objects.filter(user=user))
         serializer = UserReadingReadOnlySerializer(queryset, many=True)
         return Response(data=serializer.data)
 
@@ -245,10 +263,9 @@ class AdminViewSet(ViewSet):
                     group = Group.objects.get(id=group_id, name__startswith=request.user.ngo.key)
                     admin.groups.add(group)
 
-                # Create user in superset
-
-                if not open_superset_session_and_create_user(admin):
-                    raise ValidationException([{'message': 'Superset user creation failed'}])
+                # Superset user is created by the outbox worker once the admin is committed
+                OutboxEvent.objects.create(event_type=OutboxEvent.SUPERSET_CREATE_USER, user=admin)
+                transaction.on_commit(enqueue_outbox_processing)
                 return Response(serializer.data, status=201)
         except ValidationException as e:
             return Response(e.errors, status=400)
@@ -335,6 +352,18 @@ class AthleteViewSet(ViewSet):
         serializer = UserSerializer(result, many=True)
         return paginator.get_paginated_response(serializer.data)
 
+    @action(detail=False, methods=[METHOD_GET])
+    def autocomplete(self, request):
+        if not has_permission(request, PERMISSION_CAN_VIEW_ATHLETE):
+            return Response(status=403, data=error_403_json())
+
+        query = request.GET.get('q', '').strip()
+        if not query:
+            return Response(data=[])
+        queryset = User.objects.filter(ngo=request.user.ngo, role=User.ATHLETE, is_active=True)
+        athletes = autocomplete(queryset, ['first_name', 'last_name'], query).values('key', 'first_name', 'last_name')
+        return Response(data=list(athletes))
+
     def create(self, request):
         if not has_permission(request, PERMISSION_CAN_ADD_ATHLETE):
             return Response(status=403, data=error_403_json())
@@ -358,6 +387,7 @@ class AthleteViewSet(ViewSet):
                     if not user_hierarchy_serializer.is_valid():
                         raise ValidationException(user_hierarchy_serializer.errors)
                     user_hierarchy_serializer.save()
+                    add_user_hierarchy_closure(request.user, athlete)
 
                 baselines = create_data.get("baselines", [])
                 for baseline in baselines:
@@ -480,6 +510,18 @@ class CoachViewSet(ViewSet):
         serializer = UserSerializer(result, many=True)
         return paginator.get_paginated_response(serializer.data)
 
+    @action(detail=False, methods=[METHOD_GET])
+    def autocomplete(self, request):
+        if not has_permission(request, PERMISSION_CAN_VIEW_COACH):
+            return Response(status=403, data=error_403_json())
+
+        query = request.GET.get('q', '').strip()
+        if not query:
+            return Response(data=[])
+        queryset = User.objects.filter(ngo=request.user.ngo, role=User.COACH, is_active=True)
+        coaches = autocomplete(queryset, ['first_name', 'last_name'], query).values('key', 'first_name', 'last_name')
+        return Response(data=list(coaches))
+
     def create(self, request):
         if not has_permission(request, PERMISSION_CAN_ADD_COACH):
             return Response(status=403, data=error_403_json())
@@ -850,6 +892,7 @@ class PermissionGroupViewSet(ViewSet):
         return Response(status=204)
 
     @action(methods=['GET'], detail=False, permission_classes=[CanViewPermissionGroup])
+    @conditional_on_collections([COLLECTION_PERMISSIONS])
     def all_permissions(self, request):
         queryset = Permission.objects.all().exclude(codename__in=DEFAULT_PERMISSIONS_BLACKLIST)
         serializer = PermissionSerializer(queryset, many=True, read_only=True)
@@ -880,7 +923,8 @@ class UserReadingViewSet(ViewSet):
         }
         filters = {**common_filters, **user_reading_filters}
 
-        queryset = UserReading.objects.filter(search_filters, **filters)
+        queryset = UserReadingReadOnlySerializer.setup_eager_loading(
+            UserReading.objects.filter(search_filters, **filters))
         if ordering:
             queryset = queryset.order_by(ordering)
         paginator = BOSPageNumberPagination()
@@ -918,18 +962,78 @@ class UserReadingViewSet(ViewSet):
         except ValidationException as e:
             return Response(e.errors, status=400)
 
+    @action(detail=False, methods=[METHOD_POST])
+    def bulk(self, request):
+        if not has_permission(request, PERMISSION_CAN_ADD_READING):
+            return Response(status=403, data=error_403_json())
+
+        readings_data = request.data
+        if type(readings_data) != list or len(readings_data) == 0 or len(readings_data) > BULK_READINGS_MAX_COUNT:
+            return Response(status=400, data=error_400_json())
+
+        results = []
+        user_readings = []
+        for index, user_reading_data in enumerate(readings_data):
+            serializer = UserReadingBulkWriteOnlySerializer(data=user_reading_data)
+            if serializer.is_valid():
+                results.append({'index': index, 'status': 201})
+                user_readings.append((index, serializer.validated_data))
+            else:
+                results.append({'index': index, 'status': 400, 'errors': serializer.errors})
+
+        user_readings_to_create = build_user_readings(request.user, user_readings, results)
+
+        with transaction.atomic():
+            UserReading.objects.bulk_create([user_reading for _, user_reading in user_readings_to_create],
+                                            batch_size=BULK_CREATE_BATCH_SIZE)
+
+        for index, user_reading in user_readings_to_create:
+            results[index]['key'] = user_reading.key
+
+        if len(user_readings_to_create) == len(results):
+            return Response(status=201, data=results)
+        if len(user_readings_to_create) == 0:
+            return Response(status=400, data=results)
+        return Response(status=207, data=results)
+
+    @action(detail=False, methods=[METHOD_GET])
+    def export(self, request):
+        if not has_permission(request, PERMISSION_CAN_VIEW_READING):
+            return Response(status=403, data=error_403_json())
+
+        export_format = request.GET.get('export_format', EXPORT_FORMAT_CSV)
+        # Readings are exported per ngo, users without one, such as superusers, have nothing to export
+        if export_format not in (EXPORT_FORMAT_CSV, EXPORT_FORMAT_PARQUET) or request.user.ngo is None:
+            return Response(status=400, data=error_400_json())
+
+        user_reading_filters, search_filters = user_reading_filters_from_request(request.GET)
+        filters = {**user_reading_filters, 'ngo': request.user.ngo}
+        queryset = UserReading.objects.filter(search_filters, **filters).order_by('recorded_at', 'id') \
+            .values_list(*[field for _, field, _ in READING_EXPORT_COLUMNS])
+        # iterator() reads through a server side cursor, one chunk at a time
+        rows = (export_reading_row(row) for row in queryset.iterator(chunk_size=EXPORT_BATCH_SIZE))
+        columns = [(name, column_type) for name, _, column_type in READING_EXPORT_COLUMNS]
+
+        if export_format == EXPORT_FORMAT_PARQUET:
+            response = StreamingHttpResponse(stream_parquet(columns, rows), content_type='application/octet-stream')
+        else:
+            response = StreamingHttpResponse(stream_csv(columns, rows), content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="readings_%s.%s"' % (request.user.ngo.key,
+                                                                                     export_format)
+        return response
+
     def retrieve(self, request, pk=None):
         if not has_permission(request, PERMISSION_CAN_VIEW_READING):
             return Response(status=403, data=error_403_json())
 
-        queryset = UserReading.objects.all()
+        queryset = UserReadingSerializer.setup_eager_loading(UserReading.objects.all())
         item = get_object_or_404(queryset, key=pk)
         serializer = UserReadingSerializer(item)
         return Response(serializer.data)
 
     def update(self, request, pk=None):
         try:
-            user_reading = UserReading.objects.get(key=pk)
+            user_reading = UserReadingSerializer.setup_eager_loading(UserReading.objects.all()).get(key=pk)
 
         except UserReading.DoesNotExist:
             return Response(status=404)
@@ -956,6 +1060,40 @@ class UserReadingViewSet(ViewSet):
         return Response(status=204)
 
 
+READING_EXPORT_COLUMNS = [
+    ('key', 'key', EXPORT_STRING),
+    ('athlete', 'user__key', EXPORT_STRING),
+    ('athlete_first_name', 'user__first_name', EXPORT_STRING),
+    ('athlete_last_name', 'user__last_name', EXPORT_STRING),
+    ('measurement', 'measurement__key', EXPORT_STRING),
+    ('measurement_label', 'measurement__label', EXPORT_STRING),
+    ('measurement_uom', 'measurement__uom', EXPORT_STRING),
+    ('value', 'value', EXPORT_STRING),
+    ('numeric_value', 'numeric_value', EXPORT_FLOAT),
+    ('boolean_value', 'boolean_value', EXPORT_BOOLEAN),
+    ('training_session_uuid', 'training_session_uuid', EXPORT_STRING),
+    ('evaluation_resource_uuid', 'evaluation_resource_uuid', EXPORT_STRING),
+    ('is_active', 'is_active', EXPORT_BOOLEAN),
+    ('recorded_at', 'recorded_at', EXPORT_TIMESTAMP),
+    ('creation_time', 'creation_time', EXPORT_TIMESTAMP),
+]
+
+
+def export_reading_row(row):
+    return [str(value) if isinstance(value, uuid.UUID) else value for value in row]
+
+
+class SyncViewSet(ViewSet):
+    # The mobile app of coaches syncs the athletes under them along with the rest
+    permission_classes = [IsAuthenticated, CanViewAthlete]
+
+    def list(self, request):
+        try:
+            return Response(data=sync_collections(request.user, request.GET))
+        except ValidationException as e:
+            return Response(e.errors, status=400)
+
+
 class UserRequestViewSet(ViewSet):
 
     def list(self, request):
@@ -1185,6 +1323,10 @@ def login_mobile_view(request):
 @api_view(['POST'])
 def logout_mobile_view(request):
     if request.user and request.user.is_authenticated:
+        token = get_mobile_token(request)
+        if token:
+            MobileAuthToken.objects.filter(token=token).update(expiry_date=datetime.now(tz=timezone.utc))
+            invalidate_mobile_tokens([token])
         logout(request)
         return Response(status=200)
     else:
@@ -1196,8 +1338,13 @@ def refresh_mobile_token_view(request):
     if request.user and request.user.is_authenticated:
         expiry_date = datetime.now(tz=timezone.utc) + timedelta(days=30)
         auth_token = MobileAuthToken.objects.create(user=request.user, expiry_date=expiry_date)
+        token = get_mobile_token(request)
+        if token:
+            # The refreshed token is replaced by the new one
+            MobileAuthToken.objects.filter(token=token).update(expiry_date=datetime.now(tz=timezone.utc))
+            invalidate_mobile_tokens([token])
         return Response(status=200, data={
             'token': auth_token.token,
             'expiry_date': auth_token.expiry_date,
         })
-    return Resource
+    return Response(data=error_403_json(), status=403)